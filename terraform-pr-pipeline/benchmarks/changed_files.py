@@ -0,0 +1,108 @@
+"""
+Benchmarks the streaming changed-files engine against the regex scan it
+replaced on synthetic diffs
+
+Usage: python benchmarks/changed_files.py [file_count ...]
+"""
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'common'))
+from changed_files import parse_diff, modified_directories  # noqa: E402
+
+hunk = [
+    '@@ -1,3 +1,4 @@',
+    ' resource "aws_s3_bucket" "bucket" {',
+    '-  acl = "private"',
+    '+  acl    = "private"',
+    '+  bucket = "${var.name}"',
+    ' }',
+]
+
+
+def synthetic_diff(file_count):
+    """
+    Yields the lines of a diff touching file_count files spread over
+    file_count / 10 directories, including renames and deletions
+    """
+    for i in range(file_count):
+        path = 'stack_{}/module_{}/main_{}.tf'.format(
+            i // 10 % 50, i // 10, i)
+        yield 'diff --git a/{0} b/{0}'.format(path)
+        if i % 20 == 0:
+            yield 'deleted file mode 100644'
+            yield '--- a/{}'.format(path)
+            yield '+++ /dev/null'
+        elif i % 20 == 1:
+            yield 'similarity index 100%'
+            yield 'rename from old/{}'.format(path)
+            yield 'rename to {}'.format(path)
+            continue
+        else:
+            yield 'index 83db48f..bf269f4 100644'
+            yield '--- a/{}'.format(path)
+            yield '+++ b/{}'.format(path)
+        for line in hunk:
+            yield line
+
+
+def regex_modified_directories(diff_bytes):
+    """
+    The regex scan over str(bytes) used before the streaming engine
+    """
+    expression = r'( b\/[^\s][^\\]*)+'
+    files_modified = []
+    for obj in re.finditer(expression, '{}'.format(diff_bytes)):
+        if '.tf' in obj.group(1):
+            files_modified.append(obj.group(1)[3:])
+    files_modified = list(dict.fromkeys(files_modified))
+    dirs = []
+    test_dirs = []
+    for file in files_modified:
+        dir_only = file.split('/')[:-1]
+        dirs.append('/'.join(dir_only))
+        test_dirs.append('{}/tests'.format('/'.join(dir_only)))
+    return {
+        'dirs': list(dict.fromkeys(dirs)),
+        'test_dirs': list(dict.fromkeys(test_dirs))
+    }
+
+
+def measure(function, *args):
+    """
+    Returns (result, seconds, peak bytes) of calling function
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def main(file_counts):
+    print('{:>8} {:>12} {:>12} {:>12} {:>12} {:>6}'.format(
+        'files', 'stream s', 'stream MB', 'regex s', 'regex MB', 'dirs'))
+    for file_count in file_counts:
+        streamed, stream_seconds, stream_peak = measure(
+            lambda: modified_directories(
+                parse_diff(synthetic_diff(file_count))))
+        # The regex scan needs the whole response body up front
+        diff_bytes = '\n'.join(synthetic_diff(file_count)).encode('utf-8')
+        _, regex_seconds, regex_peak = measure(
+            regex_modified_directories, diff_bytes)
+        print('{:>8} {:>12.3f} {:>12.2f} {:>12.3f} {:>12.2f} {:>6}'.format(
+            file_count,
+            stream_seconds,
+            stream_peak / 1024.0 / 1024.0,
+            regex_seconds,
+            (regex_peak + len(diff_bytes)) / 1024.0 / 1024.0,
+            len(streamed['dirs'])))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [1000, 10000, 50000])
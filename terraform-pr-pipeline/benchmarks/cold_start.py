@@ -0,0 +1,146 @@
+"""
+Measures the cold start cost of every function: the time a fresh
+interpreter takes to import its handler module, whether boto3 was loaded
+by the import, and the size of its bundle built like setup.sh does. The
+shared modules of each bundle are read from setup.sh, so the script can be
+pointed at a checkout of an older commit to compare against.
+
+Usage: python benchmarks/cold_start.py [repeats] [tree]
+"""
+import os
+import re
+import sys
+import json
+import shutil
+import zipfile
+import tempfile
+import statistics
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from handlers import environment  # noqa: E402
+
+function_names = [
+    'poller-create', 'poller-delete', 'pipeline-create', 'pipeline-delete']
+
+# Imports a handler module in a fresh interpreter and prints the seconds it
+# took and whether boto3 got imported along the way
+probe = '''
+import sys
+import json
+import time
+import logging
+import importlib.util
+
+logging.basicConfig()
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location('handler', sys.argv[1])
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+print(json.dumps({
+    'seconds': time.perf_counter() - start,
+    'boto3': 'boto3' in sys.modules
+}))
+'''
+
+
+def shared_modules(tree):
+    """
+    Returns a dict mapping every function to the shared modules setup.sh
+    copies into its bundle, including the commented out pipeline-delete
+    lines
+    """
+    modules = {name: [] for name in function_names}
+    with open(os.path.join(tree, 'setup.sh'), 'r') as setupfile:
+        for line in setupfile:
+            match = re.match(
+                r'^#?cp -R common/(\S+\.py) \.lambda-zip/(\S+)-resources/',
+                line.strip())
+            if match and match.group(2) in modules:
+                modules[match.group(2)].append(match.group(1))
+    return modules
+
+
+def import_seconds(tree, name, modules, repeats):
+    """
+    Returns the median seconds importing the function took over repeats
+    fresh interpreters and whether boto3 was imported
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        shutil.copy(os.path.join(tree, name, name + '.py'), directory)
+        for module in modules:
+            shutil.copy(os.path.join(tree, 'common', module), directory)
+        env = dict(os.environ)
+        env.update(environment)
+        env['GITHUB_API_URL'] = 'https://api.github.com'
+        env['GITHUB_REPO_NAMES'] = 'owner/repo'
+        env['GITHUB_REPO_NAME'] = 'owner/repo'
+        env['PYTHONPATH'] = directory
+        env['PYTHONDONTWRITEBYTECODE'] = '1'
+        runs = [
+            json.loads(subprocess.check_output(
+                [sys.executable, '-c', probe,
+                 os.path.join(directory, name + '.py')],
+                cwd=directory, env=env).decode('utf-8'))
+            for _ in range(repeats)
+        ]
+    finally:
+        shutil.rmtree(directory)
+    return statistics.median(run['seconds'] for run in runs), \
+        runs[0]['boto3']
+
+
+def bundle_size(tree, name, modules):
+    """
+    Returns the (zipped, unzipped) bytes of the function's bundle with its
+    requirements installed, or None if pip could not install them
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        requirements = os.path.join(tree, name, 'requirements.txt')
+        with open(requirements, 'r') as requirementsfile:
+            has_requirements = requirementsfile.read().strip() != ''
+        if has_requirements and subprocess.call(
+                [sys.executable, '-m', 'pip', 'install', '--quiet',
+                 '--target', directory, '-r', requirements],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) != 0:
+            return None
+        shutil.copy(os.path.join(tree, name, name + '.py'), directory)
+        for module in modules:
+            shutil.copy(os.path.join(tree, 'common', module), directory)
+        unzipped = 0
+        archive = os.path.join(tempfile.mkdtemp(), name + '.zip')
+        with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as bundle:
+            for path, _, files in os.walk(directory):
+                for file in files:
+                    unzipped += os.path.getsize(os.path.join(path, file))
+                    bundle.write(
+                        os.path.join(path, file),
+                        os.path.relpath(os.path.join(path, file), directory))
+        zipped = os.path.getsize(archive)
+        shutil.rmtree(os.path.dirname(archive))
+    finally:
+        shutil.rmtree(directory)
+    return zipped, unzipped
+
+
+def main(repeats, tree):
+    modules = shared_modules(tree)
+    print('{:>16} {:>10} {:>7} {:>11} {:>13}'.format(
+        'function', 'import ms', 'boto3', 'bundle KB', 'unzipped KB'))
+    for name in function_names:
+        seconds, boto3 = import_seconds(tree, name, modules[name], repeats)
+        size = bundle_size(tree, name, modules[name])
+        print('{:>16} {:>10.1f} {:>7} {:>11} {:>13}'.format(
+            name,
+            seconds * 1000,
+            'yes' if boto3 else 'no',
+            size[0] // 1024 if size else 'n/a',
+            size[1] // 1024 if size else 'n/a'))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5,
+         sys.argv[2] if len(sys.argv) > 2 else
+         os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
@@ -0,0 +1,246 @@
+"""
+Local fake of the GitHub API endpoints used by the pipeline functions,
+serving synthetic repositories from a background process
+
+Repositories are named bench/prs-N and have N open PRs, so a single server
+covers every scale. Every PR modifies diff_files directories of a repo of
+stacks whose tests use the stack module, and every zipball is padded to
+archive_kb KB.
+
+Usage: python benchmarks/fake_github.py [port] [diff_files] [archive_kb]
+"""
+import io
+import re
+import sys
+import json
+import zipfile
+import hashlib
+import socketserver
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Open PRs listed per page, the largest page size GitHub allows
+page_size = 100
+
+# Number of stacks in every synthetic repository
+stack_count = 50
+
+repo_expression = re.compile(r'^/repos/(bench/prs-(\d+))(/.*)?$')
+
+
+def head_sha(repo, pr_number):
+    """
+    Returns the synthetic head commit of a PR
+    """
+    return hashlib.sha1('{}#{}'.format(repo, pr_number).encode(
+        'utf-8')).hexdigest()
+
+
+def base_sha(repo):
+    """
+    Returns the synthetic commit every PR of repo is based on
+    """
+    return hashlib.sha1(repo.encode('utf-8')).hexdigest()
+
+
+def pull_request(base_url, repo, pr_number, pr_json_kb):
+    """
+    Returns the JSON of an open PR, with a body padding it to roughly
+    pr_json_kb KB like the many URLs and nested users of real responses
+    """
+    pr_url = '{}/repos/{}/pulls/{}'.format(base_url, repo, pr_number)
+    return {
+        'number': pr_number,
+        'state': 'open',
+        'title': 'Change stacks for PR {}'.format(pr_number),
+        'user': {'login': 'developer{}'.format(pr_number % 10)},
+        'url': pr_url,
+        'html_url': 'https://github.example.com/{}/pull/{}'.format(
+            repo, pr_number),
+        'body': 'x' * (pr_json_kb * 1024),
+        'head': {
+            'sha': head_sha(repo, pr_number),
+            'ref': 'feature-{}'.format(pr_number),
+            'repo': {
+                'full_name': repo,
+                'archive_url': '{}/repos/{}/{{archive_format}}{{/ref}}'.format(
+                    base_url, repo)
+            }
+        },
+        'base': {'sha': base_sha(repo), 'ref': 'master'}
+    }
+
+
+def diff(pr_number, diff_files):
+    """
+    Returns a unified diff modifying diff_files stacks, starting at a stack
+    picked from the PR number
+    """
+    lines = []
+    for i in range(diff_files):
+        path = 'stacks/stack{}/main.tf'.format(
+            (pr_number + i) % stack_count)
+        lines.extend([
+            'diff --git a/{0} b/{0}'.format(path),
+            'index 1111111..2222222 100644',
+            '--- a/{}'.format(path),
+            '+++ b/{}'.format(path),
+            '@@ -1,3 +1,3 @@',
+            ' resource "null_resource" "main" {',
+            '-  count = 1',
+            '+  count = 2',
+            ' }',
+        ])
+    return '\n'.join(lines + ['']).encode('utf-8')
+
+
+def zipball(repo, sha, archive_kb):
+    """
+    Returns a zipball of stacks using a shared module and their tests,
+    padded with an incompressible file to archive_kb KB
+    """
+    top_dir = '{}-{}'.format(repo.replace('/', '-'), sha[:7])
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as repo_zip:
+        repo_zip.writestr('{}/modules/stack/main.tf'.format(top_dir),
+                          'variable "name" {}\n')
+        for i in range(stack_count):
+            repo_zip.writestr(
+                '{}/stacks/stack{}/main.tf'.format(top_dir, i),
+                'module "stack" {\n  source = "../../modules/stack"\n}\n')
+            repo_zip.writestr(
+                '{}/stacks/stack{}/tests/main.tf'.format(top_dir, i),
+                'module "test" {\n  source = "../"\n}\n')
+        padding = b''
+        while len(padding) < archive_kb * 1024:
+            padding += hashlib.sha512(padding[-64:] + b'.').digest()
+        repo_zip.writestr(zipfile.ZipInfo('{}/padding.bin'.format(top_dir)),
+                          padding[:archive_kb * 1024])
+    return archive.getvalue()
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeGitHubHandler(BaseHTTPRequestHandler):
+    """
+    Answers the pulls, diff and zipball endpoints of bench/prs-N repos.
+    Listings carry ETags and answer matching conditional requests with
+    304, like GitHub.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, which Nagle's algorithm
+    # would hold back on keep-alive connections
+    disable_nagle_algorithm = True
+    diff_files = 3
+    archive_kb = 64
+    pr_json_kb = 4
+    zipballs = {}
+
+    def log_message(self, format, *args):
+        pass
+
+    def base_url(self):
+        return 'http://{}:{}'.format(*self.server.server_address[:2])
+
+    def send_body(self, body, content_type, headers=None):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_status(self, status, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        match = repo_expression.match(url.path)
+        if match is None:
+            return self.send_status(404)
+        repo, open_prs, path = match.group(1), int(match.group(2)), \
+            match.group(3) or ''
+        if path == '/pulls':
+            return self.list_pulls(repo, open_prs, parse_qs(url.query))
+        match = re.match(r'^/pulls/(\d+)$', path)
+        if match and 1 <= int(match.group(1)) <= open_prs:
+            pr_number = int(match.group(1))
+            if 'diff' in self.headers.get('Accept', ''):
+                return self.send_body(
+                    diff(pr_number, self.diff_files), 'text/plain')
+            return self.send_body(json.dumps(pull_request(
+                self.base_url(), repo, pr_number, self.pr_json_kb)).encode(
+                'utf-8'), 'application/json')
+        match = re.match(r'^/zipball/(.+)$', path)
+        if match:
+            return self.send_body(
+                self.zipball(repo, match.group(1)), 'application/zip')
+        return self.send_status(404)
+
+    def list_pulls(self, repo, open_prs, query):
+        page = int(query.get('page', ['1'])[0])
+        per_page = min(int(query.get('per_page', ['30'])[0]), page_size)
+        numbers = range(
+            (page - 1) * per_page + 1, min(page * per_page, open_prs) + 1)
+        body = json.dumps([
+            pull_request(self.base_url(), repo, number, self.pr_json_kb)
+            for number in numbers
+        ]).encode('utf-8')
+        headers = {'ETag': '"{}"'.format(hashlib.sha1(body).hexdigest())}
+        if page * per_page < open_prs:
+            headers['Link'] = '<{}/repos/{}/pulls?state=open&per_page={}' \
+                '&page={}>; rel="next"'.format(
+                    self.base_url(), repo, per_page, page + 1)
+        if self.headers.get('If-None-Match') == headers['ETag']:
+            return self.send_status(304, headers)
+        return self.send_body(body, 'application/json', headers)
+
+    def zipball(self, repo, ref):
+        if (repo, ref) not in self.zipballs:
+            self.zipballs[(repo, ref)] = zipball(repo, ref, self.archive_kb)
+        return self.zipballs[(repo, ref)]
+
+
+def serve(port, diff_files, archive_kb, pr_json_kb, ready=None):
+    """
+    Serves the fake API on localhost until the process is terminated.
+    Puts the bound port on the ready queue once listening.
+    """
+    FakeGitHubHandler.diff_files = diff_files
+    FakeGitHubHandler.archive_kb = archive_kb
+    FakeGitHubHandler.pr_json_kb = pr_json_kb
+    server = ThreadingHTTPServer(('127.0.0.1', port), FakeGitHubHandler)
+    if ready is not None:
+        ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start(diff_files=3, archive_kb=64, pr_json_kb=4):
+    """
+    Starts the fake API in a child process so that its CPU time and memory
+    are not counted against the functions under test. Returns the process
+    and the API URL.
+    """
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(
+        target=serve, args=(0, diff_files, archive_kb, pr_json_kb, ready),
+        daemon=True)
+    process.start()
+    return process, 'http://127.0.0.1:{}'.format(ready.get(timeout=10))
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    port, diff_files, archive_kb = args + [8000, 3, 64][len(args):]
+    print('Serving bench/prs-N repositories on http://127.0.0.1:{}'.format(
+        port))
+    serve(port, diff_files, archive_kb, 4)
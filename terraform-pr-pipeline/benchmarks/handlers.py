@@ -0,0 +1,359 @@
+"""
+Runs the lambda_handler of every function against the fake GitHub API of
+fake_github.py and in-memory S3, CodeBuild, CodePipeline and PR state
+stand-ins, and reports the wall time, API calls and peak memory of each at
+several scales of open PRs
+
+At every scale poller-create syncs all open PRs into an empty bucket,
+pipeline-create reconciles the pipeline of each uploaded archive with the
+builds of one finishing before the next, poller-delete removes the objects
+of closed_percent% as many closed PRs, and pipeline-delete tears down the
+pipelines of the open PRs after their archives are removed. Peak memory
+includes the objects, pipelines and projects the stand-ins hold, but not
+the fake API, which runs in its own process.
+
+Results can be saved as a baseline; runs compared against a baseline flag
+functions that make more API calls or got more than tolerance slower or
+larger, and exit with status 1.
+
+Usage: python benchmarks/handlers.py [--scales 10,100,500,2000]
+           [--diff-files N] [--archive-kb N] [--pr-json-kb N]
+           [--closed-percent N] [--save FILE] [--baseline FILE]
+           [--tolerance FRACTION]
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import importlib.util
+import tracemalloc
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(root, 'common'))
+import fake_github  # noqa: E402
+from local_s3 import LocalS3, LocalPaginator  # noqa: E402
+from local_pipeline import LocalCodeBuild, LocalCodePipeline  # noqa: E402
+from github_client import S3Cache  # noqa: E402
+from admission import (  # noqa: E402
+    AdmissionScheduler, S3AdmissionStore, DrainLock, drain_lock_key)
+from supersession import SupersessionController  # noqa: E402
+from pr_state import MemoryPRState  # noqa: E402
+from repositories import archive_key, archive_name  # noqa: E402
+
+bucket = 'bench-terraform-pr-pipeline'
+kms_key = 'arn:aws:kms:us-east-1:123456789012:key/bench'
+
+# Environment the functions read at import, as set by their terraform
+environment = {
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'AWS_ACCESS_KEY_ID': 'bench',
+    'AWS_SECRET_ACCESS_KEY': 'bench',
+    'GITHUB_REPO_NAMES': '',
+    'BUCKET_NAME': bucket,
+    'KMS_KEY_ID': kms_key,
+    'KMS_KEY': kms_key,
+    'PROJECT_NAME': 'bench',
+    'CODE_BUILD_IMAGE': 'aws/codebuild/standard:4.0',
+    'TERRAFORM_DOWNLOAD_URL': 'https://releases.hashicorp.com/terraform/'
+                              '0.11.14/terraform_0.11.14_linux_amd64.zip',
+    'CODEBUILD_SERVICE_ROLE': 'arn:aws:iam::123456789012:role/codebuild',
+    'CODEPIPELINE_SERVICE_ROLE': 'arn:aws:iam::123456789012:role/pipeline',
+}
+
+function_names = [
+    'poller-create', 'pipeline-create', 'poller-delete', 'pipeline-delete']
+
+# Differences smaller than these are run to run noise and never flagged
+noise = {
+    'seconds': 0.05,
+    'peak_bytes': 1024 * 1024
+}
+
+
+class Recorded:
+    """
+    Wraps a local stand-in so that its calls are recorded in the metrics of
+    a function, like the calls of its instrumented boto clients
+    """
+
+    def __init__(self, client, metrics, service):
+        self.client = client
+        self.metrics = metrics
+        self.service = service
+        self.exceptions = client.exceptions
+
+    def get_paginator(self, name):
+        return LocalPaginator(getattr(self, name))
+
+    def __getattr__(self, name):
+        method = getattr(self.client, name)
+        api = '{}.{}'.format(self.service, ''.join(
+            part.capitalize() for part in name.split('_')))
+
+        def recorded(*args, **kwargs):
+            start = time.perf_counter()
+            error = True
+            try:
+                result = method(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                self.metrics.record(
+                    api, time.perf_counter() - start, error=error)
+        return recorded
+
+
+def load_function(name):
+    """
+    Imports the module of a function from its directory
+    """
+    spec = importlib.util.spec_from_file_location(
+        name.replace('-', '_'), os.path.join(root, name, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_functions(api_url):
+    """
+    Returns the modules of every function, configured to call api_url
+    """
+    for name, value in environment.items():
+        os.environ.setdefault(name, value)
+    os.environ['GITHUB_API_URL'] = api_url
+    os.environ.pop('GITHUB_CACHE_DIR', None)
+    logging.basicConfig()
+    functions = {name: load_function(name) for name in function_names}
+    # The functions log every PR at INFO, which would dominate the timings
+    logging.getLogger().setLevel(logging.WARNING)
+    return functions
+
+
+def wire(functions, repo):
+    """
+    Points the functions at fresh stand-ins and at repo. Returns the
+    stand-ins.
+    """
+    s3 = LocalS3(discard_suffixes=['/' + archive_name])
+    codebuild = LocalCodeBuild()
+    codepipeline = LocalCodePipeline(codebuild)
+    pr_state = MemoryPRState()
+
+    for name in ['poller-create', 'poller-delete']:
+        function = functions[name]
+        function.repos = [repo]
+        function.s3 = Recorded(s3, function.api_metrics, 's3')
+        function.github.cache = S3Cache(function.s3, bucket, kms_key)
+    functions['poller-create'].pr_state = pr_state
+
+    for name in ['pipeline-create', 'pipeline-delete']:
+        function = functions[name]
+        function.s3 = Recorded(s3, function.api_metrics, 's3')
+        function.codebuild = Recorded(
+            codebuild, function.api_metrics, 'codebuild')
+        function.codepipeline = Recorded(
+            codepipeline, function.api_metrics, 'codepipeline')
+        function.pr_state = pr_state
+    function = functions['pipeline-create']
+    function.scheduler = AdmissionScheduler(
+        S3AdmissionStore(function.s3, bucket, kms_key),
+        function.codepipeline,
+        SupersessionController(function.codepipeline, function.codebuild),
+        max_running_builds=function.max_concurrent_builds,
+        builds_per_execution=len(function.codebuild_projects),
+        lock=DrainLock(pr_state),
+        sleep=lambda seconds: None)
+    return s3, codebuild, codepipeline, pr_state
+
+
+def s3_event(key):
+    """
+    Returns the S3 notification of an object created or removed at key
+    """
+    return {'Records': [{'s3': {'object': {'key': key}}}]}
+
+
+def measure(function, events, between=None):
+    """
+    Returns (seconds, peak bytes, calls per API) of invoking the function's
+    lambda_handler with every event, calling between after each one
+    """
+    calls = {}
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            for event in events:
+                function.lambda_handler(event, None)
+                for api, summary in function.api_metrics.summary().items():
+                    calls[api] = calls.get(api, 0) + summary['Calls']
+                if between is not None:
+                    between()
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+            sys.stdout = stdout
+    return seconds, peak, calls
+
+
+def result(prs, invocations, measured):
+    """
+    Returns the saved form of a measurement
+    """
+    seconds, peak, calls = measured
+    return {
+        'prs': prs,
+        'invocations': invocations,
+        'seconds': round(seconds, 3),
+        'peak_bytes': peak,
+        'api_calls': sum(calls.values()),
+        'github_calls': sum(
+            count for api, count in calls.items()
+            if api.split('.')[0] not in ['s3', 'codebuild', 'codepipeline']),
+        'calls': calls
+    }
+
+
+def run_scale(functions, prs, closed_percent):
+    """
+    Runs every function against a repo with prs open PRs. Returns a dict
+    mapping function names to their results.
+    """
+    repo = 'bench/prs-{}'.format(prs)
+    s3, codebuild, codepipeline, pr_state = wire(functions, repo)
+    results = {}
+
+    results['poller-create'] = result(
+        prs, 1, measure(functions['poller-create'], [{}]))
+
+    def finish_builds():
+        for build in list(codebuild.builds.values()):
+            codebuild.complete_build(build['id'])
+
+    archive_keys = [archive_key(repo, number) for number in range(1, prs + 1)]
+    cwd = os.getcwd()
+    # Buildspecs are read relative to the function's directory
+    os.chdir(os.path.join(root, 'pipeline-create'))
+    try:
+        results['pipeline-create'] = result(prs, prs, measure(
+            functions['pipeline-create'],
+            [s3_event(key) for key in archive_keys],
+            finish_builds))
+    finally:
+        os.chdir(cwd)
+
+    closed = prs * closed_percent // 100
+    for number in range(prs + 1, prs + closed + 1):
+        s3.put_object(Bucket=bucket, Key=archive_key(repo, number))
+    results['poller-delete'] = result(
+        prs, 1, measure(functions['poller-delete'], [{}]))
+
+    for key in archive_keys:
+        s3.delete_object(Bucket=bucket, Key=key)
+    results['pipeline-delete'] = result(prs, prs, measure(
+        functions['pipeline-delete'],
+        [s3_event(key) for key in archive_keys]))
+
+    if codepipeline.pipelines:
+        raise Exception('{} pipelines left after pipeline-delete'.format(
+            len(codepipeline.pipelines)))
+    left = [key for key in pr_state.records if key != drain_lock_key]
+    if left:
+        raise Exception('{} PR records left after pipeline-delete'.format(
+            len(left)))
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    """
+    Returns a description of every function and scale that makes more API
+    calls than the baseline or takes more than tolerance more time or
+    memory, ignoring differences within noise
+    """
+    found = []
+    for scale, functions in sorted(results.items(), key=lambda s: int(s[0])):
+        for name, current in sorted(functions.items()):
+            previous = baseline.get(scale, {}).get(name)
+            if previous is None:
+                continue
+            if current['api_calls'] > previous['api_calls']:
+                found.append('{} at {} PRs: {} API calls, was {}'.format(
+                    name, scale, current['api_calls'],
+                    previous['api_calls']))
+            for metric in ['seconds', 'peak_bytes']:
+                if current[metric] > previous[metric] * (1 + tolerance) and \
+                        current[metric] - previous[metric] > noise[metric]:
+                    found.append('{} at {} PRs: {} {}, was {}'.format(
+                        name, scale, metric, current[metric],
+                        previous[metric]))
+    return found
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the lambda handlers against local fakes')
+    parser.add_argument('--scales', default='10,100,500,2000')
+    parser.add_argument('--diff-files', type=int, default=3)
+    parser.add_argument('--archive-kb', type=int, default=64)
+    parser.add_argument('--pr-json-kb', type=int, default=4)
+    parser.add_argument('--closed-percent', type=int, default=10)
+    parser.add_argument('--save', help='file to save the results to')
+    parser.add_argument('--baseline', help='results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    options = parser.parse_args(args)
+
+    workload = {
+        'diff_files': options.diff_files,
+        'archive_kb': options.archive_kb,
+        'pr_json_kb': options.pr_json_kb,
+        'closed_percent': options.closed_percent
+    }
+    server, api_url = fake_github.start(
+        options.diff_files, options.archive_kb, options.pr_json_kb)
+    try:
+        functions = load_functions(api_url)
+        print('{:>16} {:>6} {:>11} {:>9} {:>9} {:>7} {:>9}'.format(
+            'function', 'PRs', 'invocations', 'seconds', 'API calls',
+            'GitHub', 'peak MB'))
+        results = {}
+        for prs in [int(scale) for scale in options.scales.split(',')]:
+            results[str(prs)] = run_scale(
+                functions, prs, options.closed_percent)
+            for name in function_names:
+                current = results[str(prs)][name]
+                print('{:>16} {:>6} {:>11} {:>9.3f} {:>9} {:>7} '
+                      '{:>9.2f}'.format(
+                          name, prs, current['invocations'],
+                          current['seconds'], current['api_calls'],
+                          current['github_calls'],
+                          current['peak_bytes'] / 1024.0 / 1024.0))
+    finally:
+        server.terminate()
+
+    if options.save:
+        with open(options.save, 'w') as resultfile:
+            json.dump({'workload': workload, 'results': results},
+                      resultfile, indent=2, sort_keys=True)
+        print('Saved results to {}'.format(options.save))
+    if options.baseline:
+        with open(options.baseline, 'r') as baselinefile:
+            baseline = json.load(baselinefile)
+        if baseline['workload'] != workload:
+            print('Baseline was run with {}, not comparing'.format(
+                baseline['workload']))
+            return 1
+        found = regressions(results, baseline['results'], options.tolerance)
+        for regression in found:
+            print('REGRESSION {}'.format(regression))
+        if found:
+            return 1
+        print('No regressions against {}'.format(options.baseline))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
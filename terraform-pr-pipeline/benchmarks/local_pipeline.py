@@ -0,0 +1,302 @@
+"""
+Local stand-ins for the parts of the AWS CodePipeline and CodeBuild clients
+used by the pipeline functions, for running them without an AWS account
+"""
+import json
+import time
+import uuid
+import datetime
+
+
+def timestamp(seconds):
+    """
+    Returns seconds since the epoch as the datetime boto returns for times
+    """
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc)
+
+
+class LocalExceptions:
+    """
+    Exceptions raised by the stand-ins, named after their boto counterparts
+    """
+
+    class PipelineNotFoundException(Exception):
+        pass
+
+    class PipelineExecutionNotFoundException(Exception):
+        pass
+
+    class PipelineExecutionNotStoppableException(Exception):
+        pass
+
+    class PipelineNameInUseException(Exception):
+        pass
+
+    class ResourceAlreadyExistsException(Exception):
+        pass
+
+    class ResourceNotFoundException(Exception):
+        pass
+
+    class ThrottlingException(Exception):
+        response = {'Error': {'Code': 'ThrottlingException'}}
+
+
+class LocalCodeBuild:
+    """
+    Keeps builds in memory. Builds run until they are stopped or completed
+    with complete_build.
+    """
+
+    exceptions = LocalExceptions
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.projects = {}
+        self.builds = {}
+
+    def create_project(self, **project):
+        if project['name'] in self.projects:
+            raise self.exceptions.ResourceAlreadyExistsException(
+                project['name'])
+        self.projects[project['name']] = project
+        return {'project': project}
+
+    def update_project(self, **project):
+        if project['name'] not in self.projects:
+            raise self.exceptions.ResourceNotFoundException(project['name'])
+        self.projects[project['name']] = project
+        return {'project': project}
+
+    def delete_project(self, name):
+        self.projects.pop(name, None)
+
+    def batch_get_projects(self, names):
+        return {
+            'projects': [
+                self.projects[n] for n in names if n in self.projects],
+            'projectsNotFound': [n for n in names if n not in self.projects]
+        }
+
+    def start_build(self, projectName, environmentVariablesOverride=(),
+                    **kwargs):
+        build_id = '{}:{}'.format(projectName, uuid.uuid4())
+        project = self.projects.get(projectName, {})
+        variables = dict(
+            (variable['name'], variable)
+            for variable in project.get('environment', {}).get(
+                'environmentVariables', []))
+        for variable in environmentVariablesOverride:
+            variables[variable['name']] = variable
+        self.builds[build_id] = {
+            'id': build_id,
+            'projectName': projectName,
+            'buildStatus': 'IN_PROGRESS',
+            'startTime': timestamp(self.clock()),
+            'environment': {
+                'environmentVariables': list(variables.values())
+            }
+        }
+        return {'build': dict(self.builds[build_id])}
+
+    def stop_build(self, id):
+        if id not in self.builds:
+            raise self.exceptions.ResourceNotFoundException(id)
+        build = self.builds[id]
+        if build['buildStatus'] == 'IN_PROGRESS':
+            build['buildStatus'] = 'STOPPED'
+            build['endTime'] = timestamp(self.clock())
+        return {'build': dict(build)}
+
+    def batch_get_builds(self, ids):
+        return {
+            'builds': [dict(self.builds[i]) for i in ids if i in self.builds],
+            'buildsNotFound': [i for i in ids if i not in self.builds]
+        }
+
+    def complete_build(self, build_id, status='SUCCEEDED'):
+        """
+        Finishes a running build with the given status
+        """
+        build = self.builds[build_id]
+        if build['buildStatus'] == 'IN_PROGRESS':
+            build['buildStatus'] = status
+            build['endTime'] = timestamp(self.clock())
+
+
+class LocalCodePipeline:
+    """
+    Keeps pipelines and their executions in memory. Every execution starts
+    the pipeline's CodeBuild actions at once on the given LocalCodeBuild.
+    Like the real API, creating a pipeline starts an execution and results
+    are returned newest first, page_size at a time. Setting throttles makes
+    that many of the following start_pipeline_execution calls fail with a
+    ThrottlingException.
+    """
+
+    exceptions = LocalExceptions
+
+    def __init__(self, codebuild, clock=time.time, page_size=10):
+        self.codebuild = codebuild
+        self.clock = clock
+        self.page_size = page_size
+        self.pipelines = {}
+        self.executions = {}
+        self.throttles = 0
+
+    def _pipeline(self, name):
+        if name not in self.pipelines:
+            raise self.exceptions.PipelineNotFoundException(name)
+        return self.pipelines[name]
+
+    def _execution(self, name, execution_id):
+        for execution in self.executions.get(name, []):
+            if execution['pipelineExecutionId'] == execution_id:
+                return execution
+        raise self.exceptions.PipelineExecutionNotFoundException(execution_id)
+
+    def _page(self, items, key, max_results, next_token):
+        start = int(next_token or 0)
+        end = start + min(max_results or self.page_size, self.page_size)
+        response = {key: items[start:end]}
+        if end < len(items):
+            response['nextToken'] = str(end)
+        return response
+
+    def get_pipeline(self, name):
+        return {'pipeline': self._pipeline(name)}
+
+    def create_pipeline(self, pipeline):
+        if pipeline['name'] in self.pipelines:
+            raise self.exceptions.PipelineNameInUseException(
+                pipeline['name'])
+        self.pipelines[pipeline['name']] = pipeline
+        self.executions[pipeline['name']] = []
+        self.start_pipeline_execution(name=pipeline['name'])
+        return {'pipeline': pipeline}
+
+    def update_pipeline(self, pipeline):
+        self._pipeline(pipeline['name'])
+        self.pipelines[pipeline['name']] = pipeline
+        return {'pipeline': pipeline}
+
+    def delete_pipeline(self, name):
+        self._pipeline(name)
+        del self.pipelines[name]
+        del self.executions[name]
+
+    def start_pipeline_execution(self, name, **kwargs):
+        if self.throttles > 0:
+            self.throttles -= 1
+            raise self.exceptions.ThrottlingException('Rate exceeded')
+        actions = []
+        for stage in self._pipeline(name)['stages']:
+            for action in stage['actions']:
+                if action['actionTypeId']['provider'] != 'CodeBuild':
+                    continue
+                build = self.codebuild.start_build(
+                    projectName=action['configuration']['ProjectName'],
+                    environmentVariablesOverride=json.loads(
+                        action['configuration'].get(
+                            'EnvironmentVariables', '[]')))
+                actions.append({
+                    'actionName': action['name'],
+                    'input': {'actionTypeId': action['actionTypeId']},
+                    'output': {
+                        'executionResult': {
+                            'externalExecutionId': build['build']['id']
+                        }
+                    }
+                })
+        execution_id = str(uuid.uuid4())
+        self.executions[name].insert(0, {
+            'pipelineExecutionId': execution_id,
+            'status': 'InProgress',
+            'startTime': timestamp(self.clock()),
+            'actions': actions
+        })
+        return {'pipelineExecutionId': execution_id}
+
+    def stop_pipeline_execution(self, pipelineName, pipelineExecutionId,
+                                abandon=False, reason=''):
+        execution = self._execution(pipelineName, pipelineExecutionId)
+        self.refresh(pipelineName)
+        if execution['status'] != 'InProgress':
+            raise self.exceptions.PipelineExecutionNotStoppableException(
+                pipelineExecutionId)
+        execution['status'] = 'Stopped' if abandon else 'Stopping'
+        execution['statusSummary'] = reason
+        return {'pipelineExecutionId': pipelineExecutionId}
+
+    def get_pipeline_execution(self, pipelineName, pipelineExecutionId):
+        self._pipeline(pipelineName)
+        self.refresh(pipelineName)
+        execution = self._execution(pipelineName, pipelineExecutionId)
+        return {
+            'pipelineExecution': {
+                'pipelineName': pipelineName,
+                'pipelineExecutionId': pipelineExecutionId,
+                'status': execution['status']
+            }
+        }
+
+    def list_pipeline_executions(self, pipelineName, maxResults=None,
+                                 nextToken=None):
+        self._pipeline(pipelineName)
+        self.refresh(pipelineName)
+        summaries = [
+            {
+                'pipelineExecutionId': execution['pipelineExecutionId'],
+                'status': execution['status'],
+                'startTime': execution['startTime']
+            }
+            for execution in self.executions[pipelineName]
+        ]
+        return self._page(
+            summaries, 'pipelineExecutionSummaries', maxResults, nextToken)
+
+    def list_action_executions(self, pipelineName, filter=None,
+                               maxResults=None, nextToken=None):
+        self._pipeline(pipelineName)
+        self.refresh(pipelineName)
+        details = []
+        for execution in self.executions[pipelineName]:
+            if filter and filter.get('pipelineExecutionId') not in [
+                    None, execution['pipelineExecutionId']]:
+                continue
+            for action in execution['actions']:
+                detail = dict(action)
+                detail['pipelineExecutionId'] = \
+                    execution['pipelineExecutionId']
+                detail['status'] = self.action_status(action)
+                details.append(detail)
+        return self._page(
+            details, 'actionExecutionDetails', maxResults, nextToken)
+
+    def action_status(self, action):
+        """
+        Returns the status of an action from the status of its build
+        """
+        build_id = action['output']['executionResult']['externalExecutionId']
+        return {
+            'IN_PROGRESS': 'InProgress',
+            'SUCCEEDED': 'Succeeded',
+            'STOPPED': 'Abandoned'
+        }.get(self.codebuild.builds[build_id]['buildStatus'], 'Failed')
+
+    def refresh(self, name):
+        """
+        Completes the executions whose builds all finished
+        """
+        for execution in self.executions[name]:
+            statuses = [
+                self.action_status(action) for action in execution['actions']
+            ]
+            if 'InProgress' in statuses:
+                continue
+            if execution['status'] == 'Stopping':
+                execution['status'] = 'Stopped'
+            elif execution['status'] == 'InProgress':
+                execution['status'] = 'Succeeded' if all(
+                    status == 'Succeeded' for status in statuses) \
+                    else 'Failed'
@@ -0,0 +1,161 @@
+"""
+Local stand-in for the parts of the AWS S3 client used by the pipeline
+functions, for running them without an AWS account
+"""
+import io
+import uuid
+import hashlib
+import datetime
+from urllib.parse import parse_qsl
+
+
+class LocalS3Exceptions:
+    """
+    Exceptions raised by the stand-in, named after their boto counterparts
+    """
+
+    class ClientError(Exception):
+        response = {'Error': {'Code': '404'}}
+
+    class NoSuchKey(ClientError):
+        response = {'Error': {'Code': 'NoSuchKey'}}
+
+    class NoSuchUpload(ClientError):
+        response = {'Error': {'Code': 'NoSuchUpload'}}
+
+
+class LocalPaginator:
+    """
+    Pages through a list_objects_v2 style method using continuation tokens
+    """
+
+    def __init__(self, method):
+        self.method = method
+
+    def paginate(self, **kwargs):
+        while True:
+            page = self.method(**kwargs)
+            yield page
+            if not page.get('IsTruncated'):
+                return
+            kwargs['ContinuationToken'] = page['NextContinuationToken']
+
+
+class LocalS3:
+    """
+    Keeps objects and their tags in memory, page_size keys per listing.
+    Objects whose key ends with one of discard_suffixes only keep their
+    size, so that archives can be uploaded without holding them in memory;
+    reading them back raises a ValueError.
+    """
+
+    exceptions = LocalS3Exceptions
+
+    def __init__(self, page_size=1000, discard_suffixes=()):
+        self.page_size = page_size
+        self.discard_suffixes = tuple(discard_suffixes)
+        self.objects = {}
+        self.uploads = {}
+
+    def _store(self, bucket, key, body, tagging=None):
+        body = bytes(body)
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        self.objects[(bucket, key)] = {
+            'Body': None if key.endswith(self.discard_suffixes) else body,
+            'ContentLength': len(body),
+            'ETag': etag,
+            'LastModified': datetime.datetime.now(datetime.timezone.utc),
+            'TagSet': [
+                {'Key': name, 'Value': value}
+                for name, value in parse_qsl(tagging or '')
+            ]
+        }
+        return {'ETag': etag}
+
+    def _object(self, bucket, key):
+        if (bucket, key) not in self.objects:
+            raise self.exceptions.NoSuchKey(key)
+        return self.objects[(bucket, key)]
+
+    def put_object(self, Bucket, Key, Body=b'', Tagging=None, **kwargs):
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        return self._store(Bucket, Key, Body, Tagging)
+
+    def get_object(self, Bucket, Key):
+        obj = self._object(Bucket, Key)
+        if obj['Body'] is None:
+            raise ValueError('Body of {} was dropped'.format(Key))
+        return {
+            'Body': io.BytesIO(obj['Body']),
+            'ContentLength': obj['ContentLength'],
+            'ETag': obj['ETag']
+        }
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self.exceptions.ClientError(Key)
+        obj = self.objects[(Bucket, Key)]
+        return {'ContentLength': obj['ContentLength'], 'ETag': obj['ETag']}
+
+    def get_object_tagging(self, Bucket, Key):
+        return {'TagSet': list(self._object(Bucket, Key)['TagSet'])}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete):
+        for obj in Delete['Objects']:
+            self.objects.pop((Bucket, obj['Key']), None)
+        return {'Deleted': [{'Key': obj['Key']} for obj in Delete['Objects']]}
+
+    def list_objects_v2(self, Bucket, Prefix='', ContinuationToken=None,
+                        MaxKeys=None):
+        keys = sorted(
+            key for bucket, key in self.objects
+            if bucket == Bucket and key.startswith(Prefix))
+        start = int(ContinuationToken or 0)
+        end = start + min(MaxKeys or self.page_size, self.page_size)
+        response = {
+            'Contents': [
+                {
+                    'Key': key,
+                    'ETag': self.objects[(Bucket, key)]['ETag'],
+                    'Size': self.objects[(Bucket, key)]['ContentLength'],
+                    'LastModified': self.objects[(Bucket, key)][
+                        'LastModified']
+                }
+                for key in keys[start:end]
+            ],
+            'IsTruncated': end < len(keys)
+        }
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = str(end)
+        return response
+
+    def get_paginator(self, name):
+        return LocalPaginator(getattr(self, name))
+
+    def create_multipart_upload(self, Bucket, Key, Tagging=None, **kwargs):
+        upload_id = str(uuid.uuid4())
+        self.uploads[upload_id] = {'tagging': Tagging, 'parts': {}}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if UploadId not in self.uploads:
+            raise self.exceptions.NoSuchUpload(UploadId)
+        self.uploads[UploadId]['parts'][PartNumber] = bytes(Body)
+        return {'ETag': '"{}"'.format(hashlib.md5(Body).hexdigest())}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId,
+                                  MultipartUpload):
+        upload = self.uploads.pop(UploadId)
+        body = b''.join(
+            upload['parts'][part['PartNumber']]
+            for part in MultipartUpload['Parts'])
+        return self._store(Bucket, Key, body, upload['tagging'])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+        return {}
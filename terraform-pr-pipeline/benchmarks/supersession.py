@@ -0,0 +1,225 @@
+"""
+Simulates a PR receiving several pushes in quick succession against the
+local CodePipeline and CodeBuild stand-ins, and compares the build minutes
+and outdated commit statuses of letting every execution run with
+superseding older executions. Every finished or stopped execution is
+sent to pipeline-create as its state change event, stopped ones while their
+builds are still being stopped, and the build history samples it recorded
+are reported.
+
+Usage: python benchmarks/supersession.py [pushes] [interval] [duration]
+"""
+import os
+import sys
+import json
+import logging
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'common'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import handlers  # noqa: E402
+from local_s3 import LocalS3  # noqa: E402
+from local_pipeline import LocalCodeBuild, LocalCodePipeline  # noqa: E402
+from supersession import SupersessionController  # noqa: E402
+from admission import (  # noqa: E402
+    AdmissionScheduler, S3AdmissionStore, DrainLock)
+from pr_state import MemoryPRState  # noqa: E402
+from repositories import archive_key  # noqa: E402
+
+repo = 'example/repo'
+
+
+def load_pipeline_create():
+    """
+    Imports pipeline-create with the environment of the handler benchmarks
+    """
+    for name, value in handlers.environment.items():
+        os.environ.setdefault(name, value)
+    os.environ.setdefault('GITHUB_API_URL', 'http://127.0.0.1:1')
+    logging.basicConfig()
+    pipeline_create = handlers.load_function('pipeline-create')
+    logging.getLogger().setLevel(logging.WARNING)
+    return pipeline_create
+
+
+pipeline_create = load_pipeline_create()
+
+pipeline = {
+    'name': 'example-terraform-pr-pipeline-1',
+    'stages': [
+        {
+            'name': 'source',
+            'actions': [
+                {
+                    'name': 'source',
+                    'actionTypeId': {
+                        'category': 'Source',
+                        'owner': 'AWS',
+                        'provider': 'S3',
+                        'version': '1'
+                    },
+                    'configuration': {
+                        'S3Bucket': handlers.bucket,
+                        'S3ObjectKey': archive_key(repo, 1)
+                    }
+                }
+            ]
+        },
+        {
+            'name': 'pull-request-tests',
+            'actions': [
+                {
+                    'name': project['action'],
+                    'actionTypeId': {
+                        'category': project['category'],
+                        'owner': 'AWS',
+                        'provider': 'CodeBuild',
+                        'version': '1'
+                    },
+                    'configuration': {
+                        'ProjectName': 'example-terraform-pr-{}-1'.format(
+                            project['name']),
+                        'EnvironmentVariables': json.dumps([
+                            {
+                                'name': name,
+                                'value': 'network compute',
+                                'type': 'PLAINTEXT'
+                            }
+                            for name in ['MODIFIED_DIRS', 'MODIFIED_TEST_DIRS']
+                        ])
+                    }
+                }
+                for project in pipeline_create.codebuild_projects
+            ]
+        }
+    ]
+}
+
+
+class Clock:
+    """
+    Simulated time in seconds
+    """
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def execution_event(execution_id, state):
+    """
+    Returns the state change event of a pipeline execution
+    """
+    return {
+        'source': 'aws.codepipeline',
+        'detail': {
+            'pipeline': pipeline['name'],
+            'execution-id': execution_id,
+            'state': state
+        }
+    }
+
+
+def simulate(pushes, interval, duration, supersede):
+    """
+    Returns (build minutes, builds of outdated commits that ran to the end,
+    build history samples recorded)
+    """
+    interval, duration = interval * 60, duration * 60
+    clock = Clock()
+    s3 = LocalS3()
+    codebuild = LocalCodeBuild(clock=clock)
+    codepipeline = LocalCodePipeline(codebuild, clock=clock)
+    controller = SupersessionController(codepipeline, codebuild)
+    pipeline_create.s3 = s3
+    pipeline_create.codebuild = codebuild
+    pipeline_create.codepipeline = codepipeline
+    pipeline_create.scheduler = AdmissionScheduler(
+        S3AdmissionStore(s3, handlers.bucket, handlers.kms_key),
+        codepipeline,
+        controller,
+        max_running_builds=pipeline_create.max_concurrent_builds,
+        builds_per_execution=len(pipeline_create.codebuild_projects),
+        lock=DrainLock(MemoryPRState()),
+        sleep=lambda seconds: None)
+    latest = None
+    stop_pipeline_execution = codepipeline.stop_pipeline_execution
+
+    def stop_and_notify(**kwargs):
+        # Abandoned executions are STOPPED as soon as they are stopped,
+        # before the controller stops their builds
+        response = stop_pipeline_execution(**kwargs)
+        pipeline_create.lambda_handler(execution_event(
+            kwargs['pipelineExecutionId'], 'STOPPED'), None)
+        return response
+    codepipeline.stop_pipeline_execution = stop_and_notify
+
+    def finish_builds():
+        # Completes the builds due by now at the time they were due
+        now = clock.now
+        for build in list(codebuild.builds.values()):
+            due = build['startTime'].timestamp() + duration
+            if due <= now:
+                clock.now = due
+                codebuild.complete_build(build['id'])
+        clock.now = now
+
+    codepipeline.create_pipeline(pipeline)
+    for push in range(1, pushes):
+        clock.now = push * interval
+        finish_builds()
+        if supersede:
+            latest = controller.supersede(
+                pipeline['name'], 'sha{}'.format(push))['started_execution']
+        else:
+            latest = codepipeline.start_pipeline_execution(
+                name=pipeline['name'])['pipelineExecutionId']
+    clock.now += duration
+    finish_builds()
+    codepipeline.refresh(pipeline['name'])
+    for execution in codepipeline.executions[pipeline['name']]:
+        if execution['status'] in ['Succeeded', 'Failed']:
+            pipeline_create.lambda_handler(execution_event(
+                execution['pipelineExecutionId'],
+                execution['status'].upper()), None)
+
+    latest_builds = set(
+        action['output']['executionResult']['externalExecutionId']
+        for execution in codepipeline.executions[pipeline['name']]
+        if execution['pipelineExecutionId'] == latest
+        for action in execution['actions'])
+    minutes = sum(
+        (build['endTime'] - build['startTime']).total_seconds() / 60
+        for build in codebuild.builds.values())
+    outdated = len([
+        build for build in codebuild.builds.values()
+        if build['id'] not in latest_builds and
+        build['buildStatus'] == 'SUCCEEDED'])
+    samples = sum(
+        len(pipeline_create.load_build_history(repo, project['name']).get(
+            'network', []))
+        for project in pipeline_create.codebuild_projects)
+    return minutes, outdated, samples
+
+
+def main(pushes, interval, duration):
+    print('{} pushes {} minutes apart, builds take {} minutes'.format(
+        pushes, interval, duration))
+    print('{:>12} {:>14} {:>16} {:>16}'.format(
+        'mode', 'build minutes', 'outdated builds', 'history samples'))
+    for mode, supersede in [('run all', False), ('supersede', True)]:
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                minutes, outdated, samples = simulate(
+                    pushes, interval, duration, supersede)
+            finally:
+                sys.stdout = stdout
+        print('{:>12} {:>14g} {:>16} {:>16}'.format(
+            mode, minutes, outdated, samples))
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:]]
+    main(*(args + [5, 2, 8][len(args):]))
@@ -0,0 +1,202 @@
+"""
+Replays recorded GitHub webhook deliveries against webhook-ingest and
+follows them through the poller-create workers and pipeline-create, on the
+fake GitHub API of fake_github.py and the local S3, CodeBuild and
+CodePipeline stand-ins, and reports how long each delivery took to be
+answered and the archives and pipelines it led to
+
+A recording is a JSON file with the X-GitHub-Event header of a delivery as
+event and its payload as payload, as shown under Recent Deliveries in the
+webhook settings. Its repository is replaced with bench/prs-N, so the PRs
+and branches it names must exist there: PRs 1 to N with head branches
+feature-1 to feature-N. Without recordings, a ping, a pull_request
+synchronize delivery for every PR and a push to the head branch of the
+first PR are replayed.
+
+Usage: python benchmarks/webhook_replay.py [--prs N] [recording.json ...]
+"""
+import os
+import sys
+import hmac
+import json
+import time
+import hashlib
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import handlers  # noqa: E402
+import fake_github  # noqa: E402
+from fanout import LocalQueue  # noqa: E402
+from repositories import parse_archive_key  # noqa: E402
+
+# Secret the replayed deliveries are signed with
+webhook_secret = 'replay'
+
+
+class RecordingQueue:
+    """
+    Stand-in for the SQS queue of the workers that keeps the batches sent
+    by webhook-ingest until they are handed to the workers
+    """
+
+    def __init__(self):
+        self.batches = []
+
+    def send(self, work_batches):
+        self.batches.extend(work_batches)
+        return len(work_batches)
+
+    def take(self):
+        batches, self.batches = self.batches, []
+        return batches
+
+
+def retarget(recording, repo, api_url):
+    """
+    Returns the event and payload of a recording, pointed at repo on the
+    fake API
+    """
+    payload = json.loads(json.dumps(recording['payload']))
+    payload.setdefault('repository', {})['full_name'] = repo
+    pr = payload.get('pull_request')
+    if pr is not None:
+        pr['url'] = '{}/repos/{}/pulls/{}'.format(api_url, repo, pr['number'])
+        if pr['head']['repo'] is not None:
+            pr['head']['repo']['full_name'] = repo
+            pr['head']['repo']['archive_url'] = \
+                '{}/repos/{}/{{archive_format}}{{/ref}}'.format(api_url, repo)
+    return recording['event'], payload
+
+
+def default_recordings(repo, api_url, prs):
+    """
+    Returns a ping, a synchronize delivery for every PR of repo and a push
+    to the head branch of its first PR
+    """
+    recordings = [{'event': 'ping', 'payload': {'zen': 'Keep it simple.'}}]
+    recordings.extend(
+        {
+            'event': 'pull_request',
+            'payload': {
+                'action': 'synchronize',
+                'pull_request': fake_github.pull_request(
+                    api_url, repo, number, 1)
+            }
+        }
+        for number in range(1, prs + 1))
+    recordings.append({
+        'event': 'push',
+        'payload': {'ref': 'refs/heads/feature-1', 'deleted': False}
+    })
+    return recordings
+
+
+def api_gateway_event(event_type, payload, delivery):
+    """
+    Returns the API Gateway proxy event of a signed webhook delivery
+    """
+    body = json.dumps(payload).encode('utf-8')
+    signature = hmac.new(
+        webhook_secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+    return {
+        'headers': {
+            'X-GitHub-Event': event_type,
+            'X-GitHub-Delivery': delivery,
+            'X-Hub-Signature-256': 'sha256={}'.format(signature)
+        },
+        'body': body.decode('utf-8'),
+        'isBase64Encoded': False
+    }
+
+
+def archive_etags(s3):
+    """
+    Returns a dict mapping the archive keys in the bucket to their ETags
+    """
+    return {
+        key: obj['ETag'] for (bucket, key), obj in s3.objects.items()
+        if parse_archive_key(key) is not None
+    }
+
+
+def replay(functions, s3, codepipeline, repo, api_url, recordings):
+    """
+    Replays every recording. Returns one row of results per delivery.
+    """
+    poller_create = functions['poller-create']
+    pipeline_create = functions['pipeline-create']
+    queue = RecordingQueue()
+    poller_create.get_webhook_secret = lambda: webhook_secret
+    poller_create.get_sync_queue = lambda: queue
+    workers = LocalQueue(poller_create.worker_handler)
+
+    rows = []
+    for i, recording in enumerate(recordings):
+        event_type, payload = retarget(recording, repo, api_url)
+        before = archive_etags(s3)
+        start = time.perf_counter()
+        response = poller_create.webhook_handler(api_gateway_event(
+            event_type, payload, 'replay-{}'.format(i)), None)
+        ack = time.perf_counter() - start
+        workers.send(queue.take())
+        uploaded = [
+            key for key, etag in sorted(archive_etags(s3).items())
+            if before.get(key) != etag
+        ]
+        for key in uploaded:
+            pipeline_create.lambda_handler(
+                {'Records': [{'s3': {'object': {'key': key}}}]}, None)
+        rows.append({
+            'event': event_type,
+            'status': response['statusCode'],
+            'ack_ms': ack * 1000,
+            'archives': len(uploaded),
+            'pipelines': len(codepipeline.pipelines)
+        })
+    return rows
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description='Replays webhook deliveries against local fakes')
+    parser.add_argument('--prs', type=int, default=5)
+    parser.add_argument('recordings', nargs='*')
+    options = parser.parse_args(args)
+
+    server, api_url = fake_github.start()
+    try:
+        functions = handlers.load_functions(api_url)
+        repo = 'bench/prs-{}'.format(options.prs)
+        s3, codebuild, codepipeline, pr_state = handlers.wire(
+            functions, repo)
+        recordings = []
+        for path in options.recordings:
+            with open(path) as recording:
+                recordings.append(json.load(recording))
+        if recordings == []:
+            recordings = default_recordings(repo, api_url, options.prs)
+
+        cwd = os.getcwd()
+        # Buildspecs are read relative to the function's directory
+        os.chdir(os.path.join(handlers.root, 'pipeline-create'))
+        with open(os.devnull, 'w') as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                rows = replay(
+                    functions, s3, codepipeline, repo, api_url, recordings)
+            finally:
+                sys.stdout = stdout
+                os.chdir(cwd)
+    finally:
+        server.terminate()
+
+    print('{:>10} {:>14} {:>7} {:>9} {:>9} {:>10}'.format(
+        'delivery', 'event', 'status', 'ack ms', 'archives', 'pipelines'))
+    for i, row in enumerate(rows):
+        print('{:>10} {:>14} {:>7} {:>9.1f} {:>9} {:>10}'.format(
+            i, row['event'], row['status'], row['ack_ms'], row['archives'],
+            row['pipelines']))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,24 @@
+/**
+  Scripts used by the CodeBuild projects, fetched from S3 at build time
+ */
+
+resource "aws_s3_bucket_object" "plan_runner" {
+  bucket = "${aws_s3_bucket.bucket.id}"
+  key    = "terraform-pr-tools/plan-runner.sh"
+  source = "${path.module}/build-tools/plan-runner.sh"
+  etag   = "${md5(file("${path.module}/build-tools/plan-runner.sh"))}"
+}
+
+resource "aws_s3_bucket_object" "install_toolchain" {
+  bucket = "${aws_s3_bucket.bucket.id}"
+  key    = "terraform-pr-tools/install-toolchain.sh"
+  source = "${path.module}/build-tools/install-toolchain.sh"
+  etag   = "${md5(file("${path.module}/build-tools/install-toolchain.sh"))}"
+}
+
+resource "aws_s3_bucket_object" "terrascan_runner" {
+  bucket = "${aws_s3_bucket.bucket.id}"
+  key    = "terraform-pr-tools/terrascan-runner.sh"
+  source = "${path.module}/build-tools/terrascan-runner.sh"
+  etag   = "${md5(file("${path.module}/build-tools/terrascan-runner.sh"))}"
+}
@@ -0,0 +1,67 @@
+#!/bin/bash
+# Installs terraform and jq (plus terrascan when called with "terrascan") into
+# /usr/local/bin. Binaries, apt packages and pip packages are kept under
+# TOOLCHAIN_CACHE_DIR, which the CodeBuild cache restores between builds, so
+# they are only downloaded when the cache is empty or the version changes.
+# Also creates the TF_PLUGIN_CACHE_DIR shared by every terraform init.
+#
+# Usage: install-toolchain.sh [terrascan]
+
+set -e
+
+cache_dir=${TOOLCHAIN_CACHE_DIR:-/root/.terraform-pr-cache}
+jq_download_url=${JQ_DOWNLOAD_URL:-https://github.com/stedolan/jq/releases/download/jq-1.5/jq-linux64}
+
+mkdir -p "$cache_dir/bin" "$cache_dir/terraform" "${TF_PLUGIN_CACHE_DIR:-$cache_dir/plugins}"
+
+# terraform, re-downloaded when TERRAFORM_DOWNLOAD_URL changes
+if [ ! -x "$cache_dir/terraform/terraform" ] || \
+   [ "$(cat "$cache_dir/terraform/url" 2>/dev/null)" != "$TERRAFORM_DOWNLOAD_URL" ]; then
+  echo "Downloading terraform from $TERRAFORM_DOWNLOAD_URL"
+  curl -s -o /tmp/terraform.zip "$TERRAFORM_DOWNLOAD_URL"
+  unzip -o -q /tmp/terraform.zip -d "$cache_dir/terraform"
+  echo "$TERRAFORM_DOWNLOAD_URL" > "$cache_dir/terraform/url"
+else
+  echo "Using cached terraform"
+fi
+cp "$cache_dir/terraform/terraform" /usr/local/bin/
+
+# jq, as a static binary instead of an apt package
+if [ ! -x "$cache_dir/bin/jq" ]; then
+  echo "Downloading jq from $jq_download_url"
+  curl -s -L -o "$cache_dir/bin/jq" "$jq_download_url"
+  chmod +x "$cache_dir/bin/jq"
+else
+  echo "Using cached jq"
+fi
+cp "$cache_dir/bin/jq" /usr/local/bin/
+
+if [ "${1:-}" != "terrascan" ]; then
+  exit 0
+fi
+
+# python3 and pip from apt, reusing cached package lists and archives
+apt_options="-o Dir::Cache::Archives=$cache_dir/apt/archives -o Dir::State::Lists=$cache_dir/apt/lists"
+mkdir -p "$cache_dir/apt/archives/partial" "$cache_dir/apt/lists/partial"
+if ! command -v pip3 > /dev/null; then
+  if [ -z "$(ls "$cache_dir/apt/lists" | grep -v -e partial -e lock)" ]; then
+    apt-get -qq $apt_options update
+  fi
+  apt-get -qq $apt_options install python3 python3-pip || {
+    apt-get -qq $apt_options update
+    apt-get -qq $apt_options install python3 python3-pip
+  }
+fi
+
+# terrascan, installed once into the cache
+if [ ! -d "$cache_dir/terrascan/terrascan" ]; then
+  echo "Installing terrascan"
+  pip3 install -q --target "$cache_dir/terrascan" terrascan
+else
+  echo "Using cached terrascan"
+fi
+cat > /usr/local/bin/terrascan <<EOF
+#!/bin/bash
+PYTHONPATH="$cache_dir/terrascan" exec python3 "$cache_dir/terrascan/bin/terrascan" "\$@"
+EOF
+chmod +x /usr/local/bin/terrascan
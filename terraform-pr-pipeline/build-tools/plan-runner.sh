@@ -0,0 +1,178 @@
+#!/bin/bash
+# Runs terraform init, plan, apply and destroy in every directory given as an
+# argument, PLAN_PARALLELISM directories at a time. Each directory logs to its
+# own file under PLAN_LOG_DIR and the logs are merged into PLAN_REPORT in
+# argument order once all directories finish. A failing directory doesn't
+# stop the others; the runner exits 1 if any of them failed. Directories that
+# don't exist (templates without tests) are reported as skipped. terraform
+# doesn't lock TF_PLUGIN_CACHE_DIR, so inits take turns on a lock file in it
+# while plans, applies and destroys run in parallel.
+#
+# Successful results are cached in S3 under PLAN_CACHE_URL, keyed by the
+# terraform version and the contents of the directory and of every local
+# module it uses. Directories whose key was already planned reuse the cached
+# result instead of running terraform. Set PLAN_CACHE=false to disable.
+# Results are encrypted with the KMS key KMS_KEY_ID, like the rest of the
+# bucket.
+#
+# Usage: plan-runner.sh dir [dir ...]
+
+set -u
+
+parallelism=${PLAN_PARALLELISM:-4}
+log_dir=${PLAN_LOG_DIR:-$(pwd)/.plan-logs}
+report=${PLAN_REPORT:-$(pwd)/results-plan.log}
+plan_cache=${PLAN_CACHE:-true}
+plan_cache_url=${PLAN_CACHE_URL:-s3://${S3_BUCKET:-}/terraform-pr-cache/plan-results}
+repo_dir=$(pwd)
+
+log_name() {
+  echo "$log_dir/$(echo "$1" | tr '/' '_')"
+}
+
+# Prints the directory and every local module directory it uses, directly or
+# through other modules, relative to the repository root
+module_closure() {
+  queue=$(cd "$1" && pwd)
+  seen=""
+  while [ -n "$queue" ]; do
+    set -- $queue
+    current=$1
+    shift
+    queue="$*"
+    case " $seen " in
+      *" $current "*) continue ;;
+    esac
+    seen="$seen $current"
+    for source in $(grep -ho 'source[[:space:]]*=[[:space:]]*"\.\{1,2\}/[^"]*"' "$current"/*.tf 2>/dev/null | sed 's/.*"\(.*\)"/\1/'); do
+      resolved=$(cd "$current/$source" 2>/dev/null && pwd) && queue="$queue $resolved"
+    done
+  done
+  for module_dir in $seen; do
+    if [ "$module_dir" = "$repo_dir" ]; then
+      echo "."
+    else
+      echo "${module_dir#$repo_dir/}"
+    fi
+  done | sort
+}
+
+# Prints the cache key of a directory
+plan_cache_key() {
+  {
+    echo "$TERRAFORM_DOWNLOAD_URL"
+    for module_dir in $(module_closure "$1"); do
+      echo "## $module_dir"
+      (cd "$module_dir" && find . -maxdepth 1 -type f ! -name tfplan | sort | xargs -r sha256sum)
+    done
+  } | sha256sum | cut -d ' ' -f 1
+}
+
+run_dir() {
+  dir=$1
+  log=$(log_name "$dir")
+  start=$(date +%s)
+  if [ ! -d "$dir" ]; then
+    echo "Directory not found, skipping" > "$log.log"
+    echo "skipped 0 -" > "$log.status"
+    return
+  fi
+
+  cache="-"
+  if [ "$plan_cache" != "false" ]; then
+    key=$(plan_cache_key "$dir")
+    mkdir -p "$log.cached"
+    aws s3 cp --quiet --recursive "$plan_cache_url/$key/" "$log.cached/" > /dev/null 2>&1
+    if [ -f "$log.cached/result.log" ] && [ -f "$log.cached/seconds" ]; then
+      printf '\n(cached result %s)\n' "$key" > "$log.log"
+      cat "$log.cached/result.log" >> "$log.log"
+      echo "0 $(cat "$log.cached/seconds") hit" > "$log.status"
+      echo "Reused cached result for $dir"
+      return
+    fi
+    cache="miss"
+  fi
+
+  (
+    set -e
+    cd "$dir"
+    printf '\n### Terraform init\n\n'
+    if [ -n "${TF_PLUGIN_CACHE_DIR:-}" ]; then
+      flock "$TF_PLUGIN_CACHE_DIR/.init.lock" terraform init -input=false -no-color
+    else
+      terraform init -input=false -no-color
+    fi
+    printf '\n### Terraform plan\n\n'
+    terraform plan -input=false -no-color -out=tfplan
+    printf '\n### Terraform apply\n\n'
+    terraform apply -input=false -no-color tfplan
+    printf '\n### Terraform destroy\n\n'
+    terraform destroy -input=false -no-color -force
+  ) > "$log.log" 2>&1
+  status=$?
+  seconds=$(( $(date +%s) - start ))
+  echo "$status $seconds $cache" > "$log.status"
+  echo "Finished $dir with exit code $status"
+
+  # Failures may be transient so only successful results are cached
+  if [ "$cache" = "miss" ] && [ "$status" -eq 0 ]; then
+    mkdir -p "$log.store"
+    cp "$log.log" "$log.store/result.log"
+    echo "$seconds" > "$log.store/seconds"
+    aws s3 cp --quiet --recursive --sse aws:kms ${KMS_KEY_ID:+--sse-kms-key-id "$KMS_KEY_ID"} "$log.store/" "$plan_cache_url/$key/" > /dev/null 2>&1 || \
+      echo "Unable to cache result for $dir"
+  fi
+}
+
+if [ "${1:-}" = "--dir" ]; then
+  run_dir "$2"
+  exit 0
+fi
+
+if [ $# -eq 0 ]; then
+  echo "No directories to plan" | tee -a "$report"
+  exit 0
+fi
+
+mkdir -p "$log_dir"
+printf '%s\n' "$@" | xargs -P "$parallelism" -I{} bash "$0" --dir {}
+
+failed=0
+hits=0
+lookups=0
+saved=0
+summary=""
+for dir in "$@"; do
+  log=$(log_name "$dir")
+  if [ -f "$log.status" ]; then
+    read -r status seconds cache < "$log.status"
+  else
+    status=1
+    seconds=0
+    cache="-"
+  fi
+  if [ "$status" = "skipped" ]; then
+    result="skipped"
+  elif [ "$status" -eq 0 ]; then
+    result="success"
+  else
+    result="failure"
+    failed=1
+  fi
+  if [ "$cache" != "-" ]; then
+    lookups=$(( lookups + 1 ))
+  fi
+  if [ "$cache" = "hit" ]; then
+    hits=$(( hits + 1 ))
+    saved=$(( saved + seconds ))
+  fi
+  printf '\n## Running in - %s (%s)\n' "$dir" "$result" >> "$report"
+  cat "$log.log" >> "$report" 2>/dev/null
+  summary="$summary| $dir | $result | ${seconds}s | $cache |\n"
+done
+
+printf '\n## Summary\n\n| Directory | Result | Time | Cache |\n|---|---|---|---|\n' >> "$report"
+printf '%b' "$summary" >> "$report"
+printf '\nPlan cache: %s of %s directories reused, %ss saved\n' "$hits" "$lookups" "$saved" | tee -a "$report"
+
+exit $failed
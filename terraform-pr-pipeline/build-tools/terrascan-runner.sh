@@ -0,0 +1,90 @@
+#!/bin/bash
+# Runs terrascan on every directory given as an argument and writes the
+# findings of each directory to TERRASCAN_RESULTS as JSON:
+#   [{"directory": ..., "hash": ..., "cached": ..., "passed": ..., "findings": [...],
+#     "output": ...}]
+# along with a readable TERRASCAN_REPORT. Directories are scanned whole, so
+# variables and locals declared in sibling files resolve. Passing results are
+# cached in S3 under TERRASCAN_CACHE_URL, keyed by the terrascan version and
+# the names and contents of the directory's .tf files, so only new or changed
+# directories are scanned. Cached results are encrypted with the KMS key
+# KMS_KEY_ID. Exits 1 if any directory failed.
+#
+# Usage: terrascan-runner.sh dir [dir ...]
+
+set -u
+
+cache_url=${TERRASCAN_CACHE_URL:-s3://${S3_BUCKET:-}/terraform-pr-cache/terrascan}
+results=${TERRASCAN_RESULTS:-$(pwd)/results.json}
+report=${TERRASCAN_REPORT:-$(pwd)/results.log}
+version=$(ls -d "${TOOLCHAIN_CACHE_DIR:-/root/.terraform-pr-cache}"/terrascan/terrascan-*-info 2>/dev/null | xargs -r -n 1 basename)
+work_dir=$(mktemp -d)
+mkdir -p "$work_dir/cached" "$work_dir/new" "$work_dir/scan" "$work_dir/results"
+
+# Hash every directory to scan
+: > "$work_dir/dirs"
+for dir in "$@"; do
+  ls "$dir"/*.tf > /dev/null 2>&1 || continue
+  hash=$( { echo "$version"; for file in "$dir"/*.tf; do echo "${file##*/}"; cat "$file"; done; } | sha256sum | cut -d ' ' -f 1)
+  grep -qxF "$hash ${dir#./}" "$work_dir/dirs" || echo "$hash ${dir#./}" >> "$work_dir/dirs"
+done
+
+if [ ! -s "$work_dir/dirs" ]; then
+  echo "[]" > "$results"
+  echo "No terraform files to scan" | tee -a "$report"
+  exit 0
+fi
+
+# Fetch the cached result of every hash by its key, without listing the cache
+cut -d ' ' -f 1 "$work_dir/dirs" | sort -u | \
+  xargs -P 8 -I {} aws s3 cp --quiet "$cache_url/{}.json" "$work_dir/cached/{}.json" > /dev/null 2>&1
+
+index=0
+while read -r hash dir; do
+  index=$(( index + 1 ))
+  result="$work_dir/results/$(printf '%06d' $index).json"
+  if [ -f "$work_dir/cached/$hash.json" ]; then
+    jq --arg dir "$dir" '.directory = $dir | .cached = true' "$work_dir/cached/$hash.json" > "$result"
+    continue
+  fi
+  if [ -f "$work_dir/new/$hash.json" ]; then
+    jq --arg dir "$dir" '.directory = $dir | .cached = true' "$work_dir/new/$hash.json" > "$result"
+    continue
+  fi
+
+  terrascan -l "$dir" > "$work_dir/scan/$hash.log" 2>&1
+  status=$?
+  # The log is read from stdin rather than passed as an argument, which
+  # large scan output would push past ARG_MAX
+  jq -R -s \
+    --arg dir "$dir" \
+    --arg hash "$hash" \
+    --argjson status "$status" \
+    '. as $output | [split("\n")[] | select(contains("FAILED"))] as $findings | {directory: $dir, hash: $hash, cached: false, passed: ($status == 0 and ($findings | length == 0)), findings: $findings, output: $output}' \
+    < "$work_dir/scan/$hash.log" > "$result"
+  # A run that exited non-zero may have failed for reasons other than its
+  # findings, so only passing runs are cached
+  if [ "$status" -eq 0 ] && [ "$(jq '.passed' "$result")" = "true" ]; then
+    cp "$result" "$work_dir/new/$hash.json"
+  fi
+done < "$work_dir/dirs"
+
+if [ -n "$(ls "$work_dir/new")" ]; then
+  aws s3 cp --quiet --recursive --sse aws:kms ${KMS_KEY_ID:+--sse-kms-key-id "$KMS_KEY_ID"} "$work_dir/new/" "$cache_url/" > /dev/null 2>&1 || \
+    echo "Unable to cache terrascan results"
+fi
+
+jq -s . "$work_dir"/results/*.json > "$results"
+jq -r '.[] | "## Scanning \(.directory)\(if .cached then " (cached)" else "" end)\n\(.output)\n"' "$results" >> "$report"
+
+scanned=$(jq '[.[] | select(.cached | not)] | length' "$results")
+total=$(jq 'length' "$results")
+failed=$(jq '[.[] | select(.passed | not)] | length' "$results")
+printf '\nterrascan: %s of %s directories scanned, %s reused from cache, %s failed\n' \
+  "$scanned" "$total" "$(( total - scanned ))" "$failed" | tee -a "$report"
+
+rm -rf "$work_dir"
+if [ "$failed" -gt 0 ]; then
+  echo "terrascan test failed"
+  exit 1
+fi
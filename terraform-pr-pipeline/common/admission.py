@@ -0,0 +1,406 @@
+import json
+import time
+import uuid
+import random
+import logging
+
+logger = logging.getLogger()
+
+# Objects under this prefix are skipped by poller-delete
+s3_admission_prefix = 'terraform-pr-cache/admission'
+
+# Every this many seconds of waiting counts as one directory less, so large
+# PRs are admitted eventually even while small ones keep arriving
+aging_seconds = 300
+
+# Key of the drain lock record in the PR state table, and how long a drain
+# holds it when the time left to its invocation is unknown
+drain_lock_key = 'admission/drain'
+drain_lock_seconds = 300
+
+# Error codes of throttled CodePipeline and CodeBuild requests
+throttling_error_codes = [
+    'ThrottlingException',
+    'LimitExceededException',
+    'AccountLimitExceededException',
+    'TooManyRequestsException',
+]
+
+
+def is_throttling(error):
+    """
+    Returns True if a boto error was caused by throttling
+    """
+    response = getattr(error, 'response', None) or {}
+    return response.get('Error', {}).get('Code') in throttling_error_codes
+
+
+class S3AdmissionStore:
+    """
+    Stores the queued and running entries of the admission scheduler as one
+    JSON object per PR in the pipeline S3 bucket, so concurrent invocations
+    never overwrite each other's PRs. Entries are cached by ETag, so a warm
+    invocation only downloads the entries that changed since it last saw
+    them.
+    """
+
+    def __init__(self, s3, bucket, kms_key_id=None,
+                 prefix=s3_admission_prefix):
+        self.s3 = s3
+        self.bucket = bucket
+        self.kms_key_id = kms_key_id
+        self.prefix = prefix
+        self.cache = {}
+
+    def _key(self, state, pr_number):
+        return '{}/{}/{}.json'.format(self.prefix, state, pr_number)
+
+    def get(self, state, pr_number):
+        """
+        Returns the entry of the PR in state or None
+        """
+        try:
+            response = self.s3.get_object(
+                Bucket=self.bucket, Key=self._key(state, pr_number))
+        except self.s3.exceptions.NoSuchKey:
+            return None
+        return json.loads(response['Body'].read().decode('utf-8'))
+
+    def entries(self, state):
+        """
+        Returns every entry in state ('queued' or 'running')
+        """
+        prefix = '{}/{}/'.format(self.prefix, state)
+        entries = []
+        listed = set()
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                listed.add(obj['Key'])
+                cached = self.cache.get(obj['Key'])
+                if cached is not None and cached[0] == obj['ETag']:
+                    entries.append(dict(cached[1]))
+                    continue
+                # PR keys may contain slashes, e.g. owner/repo/pr_number
+                entry = self.get(state, obj['Key'][len(prefix):-len('.json')])
+                if entry is not None:
+                    self.cache[obj['Key']] = (obj['ETag'], entry)
+                    entries.append(dict(entry))
+        for key in [key for key in self.cache if key.startswith(prefix)]:
+            if key not in listed:
+                del self.cache[key]
+        return entries
+
+    def put(self, state, entry):
+        """
+        Stores the entry of a PR in state
+        """
+        extra_args = {}
+        if self.kms_key_id is not None:
+            extra_args = {
+                'ServerSideEncryption': 'aws:kms',
+                'SSEKMSKeyId': self.kms_key_id
+            }
+        key = self._key(state, entry['pr_number'])
+        response = self.s3.put_object(
+            Bucket=self.bucket,
+            Key=key,
+            Body=json.dumps(entry).encode('utf-8'),
+            **extra_args
+        )
+        self.cache[key] = (response['ETag'], dict(entry))
+
+    def delete(self, state, pr_number):
+        """
+        Removes the entry of a PR from state
+        """
+        self.s3.delete_object(
+            Bucket=self.bucket, Key=self._key(state, pr_number))
+        self.cache.pop(self._key(state, pr_number), None)
+
+
+class MemoryAdmissionStore:
+    """
+    Local stand-in for S3AdmissionStore that keeps entries in memory
+    """
+
+    def __init__(self):
+        self.states = {'queued': {}, 'running': {}}
+
+    def get(self, state, pr_number):
+        """
+        Returns the entry of the PR in state or None
+        """
+        entry = self.states[state].get(str(pr_number))
+        return dict(entry) if entry is not None else None
+
+    def entries(self, state):
+        """
+        Returns every entry in state ('queued' or 'running')
+        """
+        return [dict(entry) for entry in self.states[state].values()]
+
+    def put(self, state, entry):
+        """
+        Stores the entry of a PR in state
+        """
+        self.states[state][str(entry['pr_number'])] = dict(entry)
+
+    def delete(self, state, pr_number):
+        """
+        Removes the entry of a PR from state
+        """
+        self.states[state].pop(str(pr_number), None)
+
+
+class DrainLock:
+    """
+    Lets one drain run at a time, as a record of a compare-and-set state
+    store such as pr_state. A drain that finds the lock held marks it
+    pending instead of waiting, and the holder drains once more before
+    releasing it, so entries queued meanwhile are never left waiting for
+    the next schedule. A lock whose holder died is taken over once it
+    expires.
+    """
+
+    def __init__(self, state, key=drain_lock_key, clock=time.time):
+        self.state = state
+        self.key = key
+        self.clock = clock
+
+    def acquire(self, seconds):
+        """
+        Takes the lock for seconds. Returns the lock record, or None if
+        another drain holds it and was asked to drain again.
+        """
+        while True:
+            record = self.state.get(self.key)
+            version = record['version'] if record else None
+            if record and record['expires_at'] > self.clock():
+                if record['pending'] or self.state.put(
+                        self.key, dict(record, pending=1), version):
+                    return None
+                continue
+            written = self.state.put(self.key, {
+                'holder': str(uuid.uuid4()),
+                'expires_at': self.clock() + seconds,
+                'pending': 0
+            }, version)
+            if written is not None:
+                return written
+
+    def release(self, lock):
+        """
+        Releases the lock. Returns the lock record, still held, if another
+        drain asked for one more drain meanwhile, or None once released.
+        """
+        while True:
+            record = self.state.get(self.key)
+            if record is None or record['holder'] != lock['holder']:
+                # The lock expired and was taken over
+                return None
+            if record['pending']:
+                written = self.state.put(
+                    self.key, dict(record, pending=0), record['version'])
+                if written is not None:
+                    return written
+            elif self.state.put(
+                    self.key, dict(record, expires_at=0), record['version']):
+                return None
+
+    def abandon(self, lock):
+        """
+        Releases the lock after a failed drain, dropping any drain asked for
+        meanwhile so the next one does not wait for the lock to expire
+        """
+        while True:
+            record = self.state.get(self.key)
+            if record is None or record['holder'] != lock['holder']:
+                return
+            if self.state.put(
+                    self.key, dict(record, expires_at=0, pending=0),
+                    record['version']):
+                return
+
+
+class AdmissionScheduler:
+    """
+    Queues pipeline executions and starts them while fewer than
+    max_running_builds CodeBuild builds are running. Queued PRs are started
+    smallest first, with waiting time counting in favour of older ones.
+    Throttled starts are retried with exponential backoff and left queued
+    for the next drain if they keep failing. With a lock, concurrent drains
+    are serialized so that together they never start more than
+    max_running_builds builds.
+    """
+
+    def __init__(self, store, codepipeline, supersession,
+                 max_running_builds, builds_per_execution,
+                 max_attempts=3, base_delay=0.25, lock=None,
+                 clock=time.time, sleep=time.sleep):
+        self.store = store
+        self.codepipeline = codepipeline
+        self.supersession = supersession
+        self.max_running_builds = max_running_builds
+        self.builds_per_execution = builds_per_execution
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.lock = lock
+        self.clock = clock
+        self.sleep = sleep
+
+    def enqueue(self, pr_number, pipeline_name, sha, directories):
+        """
+        Stops the running executions of the PR's pipeline and queues its
+        latest commit. A PR that was already waiting keeps its place.
+        """
+        self.supersession.stop_running(pipeline_name, sha)
+        self.store.delete('running', pr_number)
+        queued = self.store.get('queued', pr_number)
+        self.store.put('queued', {
+            'pr_number': pr_number,
+            'pipeline_name': pipeline_name,
+            'sha': sha,
+            'directories': directories,
+            'enqueued_at': queued['enqueued_at'] if queued else self.clock()
+        })
+        logger.info('Queued PR #{} ({} directories)'.format(
+            pr_number, directories))
+
+    def priority(self, entry, now):
+        """
+        Returns the priority of a queued entry, lowest first
+        """
+        return entry['directories'] - \
+            (now - entry['enqueued_at']) / float(aging_seconds)
+
+    def running(self):
+        """
+        Returns the running entries whose executions are still in progress
+        and forgets the rest
+        """
+        not_found = (
+            self.codepipeline.exceptions.PipelineNotFoundException,
+            self.codepipeline.exceptions.PipelineExecutionNotFoundException
+        )
+        running = []
+        for entry in self.store.entries('running'):
+            try:
+                status = self.codepipeline.get_pipeline_execution(
+                    pipelineName=entry['pipeline_name'],
+                    pipelineExecutionId=entry['execution_id']
+                )['pipelineExecution']['status']
+            except not_found:
+                status = None
+            if status == 'InProgress':
+                running.append(entry)
+            else:
+                self.store.delete('running', entry['pr_number'])
+        return running
+
+    def start(self, entry, metrics):
+        """
+        Starts the pipeline of a queued entry. Returns the execution id or
+        None if the request was still throttled after max_attempts.
+        """
+        for attempt in range(self.max_attempts):
+            try:
+                return self.codepipeline.start_pipeline_execution(
+                    name=entry['pipeline_name'])['pipelineExecutionId']
+            except Exception as e:
+                if not is_throttling(e):
+                    raise
+                metrics['throttled'] += 1
+                if attempt + 1 < self.max_attempts:
+                    # Full jitter keeps concurrent drains from retrying
+                    # in lockstep
+                    self.sleep(random.uniform(
+                        0, self.base_delay * 2 ** attempt))
+        logger.info('Starting PR #{} was throttled, leaving it queued'.format(
+            entry['pr_number']))
+        return None
+
+    def drain(self, seconds=drain_lock_seconds):
+        """
+        Starts queued PRs in priority order while there is capacity, holding
+        the lock for at most seconds. Returns the queue depth and wait time
+        metrics, or deferred if the drain was handed to the one running.
+        """
+        if self.lock is None:
+            return self.drain_queue()
+        lock = self.lock.acquire(seconds)
+        if lock is None:
+            logger.info('Another drain is running, deferring to it')
+            return {'deferred': 1}
+        metrics = None
+        try:
+            while lock is not None:
+                metrics = self.drain_queue()
+                lock = self.lock.release(lock)
+        except Exception:
+            # Leaves the lock free for the next drain instead of deferring
+            # every drain to this one until the lock expires
+            self.lock.abandon(lock)
+            raise
+        return metrics
+
+    def drain_queue(self):
+        """
+        Starts queued PRs in priority order while there is capacity.
+        Returns the queue depth and wait time metrics.
+        """
+        metrics = {
+            'queue_depth': 0,
+            'running_executions': 0,
+            'running_builds': 0,
+            'admitted': 0,
+            'throttled': 0,
+            'max_wait_seconds': 0,
+            'mean_wait_seconds': 0,
+            'oldest_queued_seconds': 0
+        }
+        running = self.running()
+        now = self.clock()
+        queued = sorted(
+            self.store.entries('queued'),
+            key=lambda entry: self.priority(entry, now))
+        slots = self.max_running_builds // self.builds_per_execution - \
+            len(running)
+
+        waits = []
+        for entry in queued[:max(slots, 0)]:
+            try:
+                execution_id = self.start(entry, metrics)
+            except self.codepipeline.exceptions.PipelineNotFoundException:
+                # The PR was closed while it was waiting
+                self.store.delete('queued', entry['pr_number'])
+                entry['closed'] = True
+                continue
+            if execution_id is None:
+                break
+            wait = self.clock() - entry['enqueued_at']
+            entry['execution_id'] = execution_id
+            entry['admitted_at'] = self.clock()
+            self.store.put('running', entry)
+            self.store.delete('queued', entry['pr_number'])
+            running.append(entry)
+            waits.append(wait)
+            logger.info('Admitted PR #{} after waiting {:.0f}s'.format(
+                entry['pr_number'], wait))
+
+        admitted = set(entry['pr_number'] for entry in running)
+        still_queued = [
+            entry for entry in queued
+            if entry['pr_number'] not in admitted and 'closed' not in entry
+        ]
+        metrics['queue_depth'] = len(still_queued)
+        metrics['running_executions'] = len(running)
+        metrics['running_builds'] = len(running) * self.builds_per_execution
+        metrics['admitted'] = len(waits)
+        if waits != []:
+            metrics['max_wait_seconds'] = round(max(waits), 1)
+            metrics['mean_wait_seconds'] = round(sum(waits) / len(waits), 1)
+        if still_queued != []:
+            metrics['oldest_queued_seconds'] = round(now - min(
+                entry['enqueued_at'] for entry in still_queued), 1)
+        return metrics
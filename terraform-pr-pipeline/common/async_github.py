@@ -0,0 +1,87 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger()
+
+
+class RequestBudgetExceeded(Exception):
+    """
+    Raised when a repository used up its requests for the current run
+    """
+    pass
+
+
+class AsyncGitHubClient:
+    """
+    Runs the requests of a GitHubClient from asyncio coroutines, on a
+    thread pool since requests has no asyncio support. Every repository
+    gets at most concurrency requests in flight and budget requests per
+    run, so one large repository can neither hold up the others nor use
+    up the rate limit they share.
+    """
+
+    def __init__(self, github, concurrency=2, budget=None, max_workers=8):
+        self.github = github
+        self.concurrency = concurrency
+        self.budget = budget
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.spent = {}
+        self._semaphores = {}
+
+    async def _request(self, repo, function, *args):
+        if self.budget is not None and \
+                self.spent.get(repo, 0) >= self.budget:
+            raise RequestBudgetExceeded(
+                '{} used its {} GitHub requests'.format(repo, self.budget))
+        self.spent[repo] = self.spent.get(repo, 0) + 1
+        if repo not in self._semaphores:
+            self._semaphores[repo] = asyncio.Semaphore(self.concurrency)
+        async with self._semaphores[repo]:
+            return await asyncio.get_event_loop().run_in_executor(
+                self.executor, function, *args)
+
+    async def get_json(self, repo, path):
+        """
+        Returns the JSON body for the API path, counted against repo
+        """
+        return await self._request(repo, self.github.get_json, path)
+
+    async def get_paginated(self, repo, path):
+        """
+        Returns the items of every page of the list at the API path, each
+        page counted against repo
+        """
+        url = self.github.url(path)
+        items = []
+        while url is not None:
+            status_code, body, url = await self._request(
+                repo, self.github.get, url)
+            if status_code != 200:
+                logger.error('GH URL status code error: {} {}'.format(
+                    path, status_code))
+                raise Exception('GH URL status code != 200')
+            items.extend(body)
+        return items
+
+    def run(self, requests_by_repo):
+        """
+        Runs the coroutine of every repo in requests_by_repo concurrently
+        on a new event loop with fresh budgets. Returns a dict mapping each
+        repo to its result or to the exception it raised.
+        """
+        repos = list(requests_by_repo)
+
+        async def gather():
+            return await asyncio.gather(
+                *[requests_by_repo[repo] for repo in repos],
+                return_exceptions=True)
+
+        self.spent = {}
+        self._semaphores = {}
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(gather())
+        finally:
+            loop.close()
+        return dict(zip(repos, results))
@@ -0,0 +1,115 @@
+import math
+
+# Samples kept per directory, older ones are dropped
+history_size = 10
+
+# Build statuses recorded and the ones used for estimates. Failed builds
+# often stop early so they would make estimates too optimistic.
+recorded_statuses = ['SUCCEEDED', 'FAILED', 'TIMED_OUT']
+estimated_statuses = ['SUCCEEDED', 'TIMED_OUT']
+
+# Timed out builds only tell that the directory needs more than it got
+timed_out_factor = 2
+
+# Timeouts allow builds to take this many times their estimate
+timeout_margin = 2
+min_timeout_minutes = 5
+max_timeout_minutes = 480
+
+# Compute types from smallest to largest with their vCPUs
+compute_types = [
+    ('BUILD_GENERAL1_SMALL', 2),
+    ('BUILD_GENERAL1_MEDIUM', 4),
+    ('BUILD_GENERAL1_LARGE', 8),
+]
+
+# Builds estimated to take longer than this get the next compute type
+long_build_seconds = 30 * 60
+
+
+def build_concurrency(directory_count, parallelism):
+    """
+    Returns the number of directories a build works on at once
+    """
+    return max(1, min(directory_count, parallelism))
+
+
+def record_build(history, directories, seconds, status, parallelism=1,
+                 build_id=None, ended=0):
+    """
+    Adds a finished build to history, a dict mapping directories to their
+    samples. Each sample is the time the build would have spent on one
+    directory had it worked on one directory at a time. Samples are kept
+    in the order their builds ended and a build already recorded for a
+    directory is skipped, so recording a build twice has no effect.
+    """
+    if status not in recorded_statuses or directories == []:
+        return history
+    concurrency = build_concurrency(len(directories), parallelism)
+    sample = {
+        'seconds': round(float(seconds) * concurrency / len(directories), 1),
+        'status': status,
+        'build': build_id,
+        'ended': ended
+    }
+    for directory in directories:
+        samples = history.setdefault(directory, [])
+        if build_id is not None and any(
+                previous.get('build') == build_id for previous in samples):
+            continue
+        samples.append(sample)
+        samples.sort(key=lambda previous: previous.get('ended', 0))
+        del samples[:-history_size]
+    return history
+
+
+def directory_estimate(samples):
+    """
+    Returns the seconds one directory is expected to take from its samples,
+    or None if none of them can be used
+    """
+    seconds = [
+        sample['seconds'] * (
+            timed_out_factor if sample['status'] == 'TIMED_OUT' else 1)
+        for sample in samples if sample['status'] in estimated_statuses
+    ]
+    if seconds == []:
+        return None
+    # The slowest recent build keeps estimates on the safe side
+    return max(seconds)
+
+
+def estimate_seconds(history, directories, default_seconds, parallelism=1):
+    """
+    Returns the seconds a build of directories is expected to take.
+    Directories without history take default_seconds each.
+    """
+    total = 0.0
+    for directory in directories:
+        estimate = directory_estimate(history.get(directory, []))
+        total += default_seconds if estimate is None else estimate
+    return total / build_concurrency(len(directories), parallelism)
+
+
+def build_settings(history, directories, default_seconds, parallelism=1):
+    """
+    Returns the computeType and timeoutInMinutes for a build of
+    directories. Builds working on more directories at once than the
+    smallest compute type has vCPUs, or expected to run long, get larger
+    compute types.
+    """
+    seconds = estimate_seconds(
+        history, directories, default_seconds, parallelism)
+    concurrency = build_concurrency(len(directories), parallelism)
+    tier = 0
+    while tier < len(compute_types) - 1 and \
+            compute_types[tier][1] < concurrency:
+        tier += 1
+    if seconds > long_build_seconds:
+        tier = min(tier + 1, len(compute_types) - 1)
+    timeout = int(math.ceil(seconds * timeout_margin / 60.0))
+    return {
+        'computeType': compute_types[tier][0],
+        'timeoutInMinutes': max(
+            min_timeout_minutes, min(timeout, max_timeout_minutes))
+    }
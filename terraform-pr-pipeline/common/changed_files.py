@@ -0,0 +1,99 @@
+import posixpath
+from module_graph import affected_directories
+
+
+def parse_diff(lines):
+    """
+    Yields the path of every file added, modified or deleted by a unified
+    diff. Renamed files yield their old and new paths, so the directories
+    a file left are tested as well as the one it moved to.
+    Lines are consumed one at a time so the diff is never held in memory.
+    """
+    path = None
+    old_path = None
+    deleted = False
+    in_header = False
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+        if line.startswith('diff --git '):
+            for changed in diff_paths(path, old_path, deleted):
+                yield changed
+            # Fallback for diffs without ---/+++ lines (binary, pure renames)
+            old_path, path = line[len('diff --git a/'):].rsplit(' b/', 1)
+            deleted = False
+            in_header = True
+        elif not in_header:
+            continue
+        elif line.startswith('@@'):
+            in_header = False
+        elif line.startswith('deleted file mode') or line == '+++ /dev/null':
+            deleted = True
+        elif line.startswith('--- a/'):
+            old_path = line[len('--- a/'):]
+        elif line.startswith('+++ b/'):
+            path = line[len('+++ b/'):]
+        elif line.startswith('rename from '):
+            old_path = line[len('rename from '):]
+        elif line.startswith('rename to '):
+            path = line[len('rename to '):]
+    for changed in diff_paths(path, old_path, deleted):
+        yield changed
+
+
+def diff_paths(path, old_path, deleted):
+    """
+    Returns the paths a file of a diff touched, given its new and old path
+    """
+    if path is None:
+        return []
+    if deleted:
+        return [old_path]
+    if old_path != path:
+        return [path, old_path]
+    return [path]
+
+
+def is_terraform_file(path):
+    """
+    Returns True for terraform templates and variable files
+    """
+    return '.tf' in posixpath.basename(path)
+
+
+def test_directory(directory):
+    """
+    Returns the directory holding the tests of a template directory
+    """
+    if directory == '.':
+        return 'tests'
+    if 'tests' in directory.split('/'):
+        return directory
+    return '{}/tests'.format(directory)
+
+
+def modified_directories(paths, consumers=None):
+    """
+    Returns a dict containing the directories of the modified terraform files
+    (for terraform fmt and terrascan) and the tests directories to plan.
+    When consumers (a reverse module graph) is given, the tests of every
+    directory that uses a modified module are planned as well. Entries keep
+    the order in which they were first seen.
+    """
+    dirs = {}
+    test_dirs = {}
+    for path in paths:
+        if not is_terraform_file(path):
+            continue
+        dir_only = posixpath.dirname(path) or '.'
+        dirs[dir_only] = None
+        test_dirs[test_directory(dir_only)] = None
+
+    if consumers is not None:
+        for directory in affected_directories(list(dirs), consumers):
+            test_dirs.setdefault(test_directory(directory))
+
+    return {
+        'dirs': list(dirs),
+        'test_dirs': list(test_dirs)
+    }
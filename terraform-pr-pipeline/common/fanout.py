@@ -0,0 +1,73 @@
+import json
+import logging
+
+logger = logging.getLogger()
+
+# SQS accepts at most this many messages per send_message_batch call
+sqs_batch_limit = 10
+
+
+def batches(items, size):
+    """
+    Returns items split into lists of at most size items
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+class SQSQueue:
+    """
+    Sends batches of work as JSON messages to an SQS queue consumed by
+    worker invocations
+    """
+
+    def __init__(self, sqs, queue_url):
+        self.sqs = sqs
+        self.queue_url = queue_url
+
+    def send(self, work_batches):
+        """
+        Sends one message per batch. Returns the number of messages sent.
+        """
+        sent = 0
+        for messages in batches(work_batches, sqs_batch_limit):
+            response = self.sqs.send_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[
+                    {
+                        'Id': str(i),
+                        'MessageBody': json.dumps(batch)
+                    }
+                    for i, batch in enumerate(messages)
+                ]
+            )
+            for failed in response.get('Failed', []):
+                logger.error('Failed to queue batch: {}'.format(
+                    failed.get('Message')))
+            sent += len(response.get('Successful', []))
+        return sent
+
+
+class LocalQueue:
+    """
+    In-process stand-in for SQSQueue that hands every batch to the worker
+    handler right away, as an SQS event with a single record
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+
+    def send(self, work_batches):
+        """
+        Runs the worker handler on every batch. Returns the number of
+        batches handled without errors.
+        """
+        handled = 0
+        for batch in work_batches:
+            try:
+                self.handler({'Records': [{'body': json.dumps(batch)}]}, None)
+            except Exception as e:
+                logger.error('Worker failed: {}'.format(e))
+                continue
+            handled += 1
+        return handled
+
@@ -0,0 +1,203 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+import requests
+
+logger = logging.getLogger()
+
+# Objects under this prefix are skipped by poller-delete
+s3_cache_prefix = 'terraform-pr-cache/github'
+
+
+def cache_key(url):
+    """
+    Returns a file and S3 safe name for the given URL
+    """
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+class S3Cache:
+    """
+    Stores GitHub responses as JSON objects in the pipeline S3 bucket
+    """
+
+    def __init__(self, s3, bucket, kms_key_id=None, prefix=s3_cache_prefix):
+        self.s3 = s3
+        self.bucket = bucket
+        self.kms_key_id = kms_key_id
+        self.prefix = prefix
+
+    def get(self, url):
+        """
+        Returns the cached entry for url or None
+        """
+        try:
+            response = self.s3.get_object(
+                Bucket=self.bucket,
+                Key='{}/{}.json'.format(self.prefix, cache_key(url)))
+        except self.s3.exceptions.NoSuchKey:
+            return None
+        return json.loads(response['Body'].read().decode('utf-8'))
+
+    def put(self, url, entry):
+        """
+        Stores the entry for url
+        """
+        extra_args = {}
+        if self.kms_key_id is not None:
+            extra_args = {
+                'ServerSideEncryption': 'aws:kms',
+                'SSEKMSKeyId': self.kms_key_id
+            }
+        self.s3.put_object(
+            Bucket=self.bucket,
+            Key='{}/{}.json'.format(self.prefix, cache_key(url)),
+            Body=json.dumps(entry).encode('utf-8'),
+            **extra_args
+        )
+
+
+class FileCache:
+    """
+    Local stand-in for S3Cache that stores entries in a directory
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, url):
+        """
+        Returns the cached entry for url or None
+        """
+        try:
+            with open(self._path(url), 'r') as cachefile:
+                return json.load(cachefile)
+        except FileNotFoundError:
+            return None
+
+    def put(self, url, entry):
+        """
+        Stores the entry for url
+        """
+        with open(self._path(url), 'w') as cachefile:
+            json.dump(entry, cachefile)
+
+    def _path(self, url):
+        return os.path.join(self.directory, '{}.json'.format(cache_key(url)))
+
+
+def cache_from_environment(s3, bucket, kms_key_id=None):
+    """
+    Returns a FileCache if GITHUB_CACHE_DIR is set, an S3Cache otherwise
+    """
+    cache_dir = os.environ.get('GITHUB_CACHE_DIR')
+    if cache_dir:
+        return FileCache(cache_dir)
+    return S3Cache(s3, bucket, kms_key_id)
+
+
+class GitHubClient:
+    """
+    GitHub API client that sends conditional requests using the ETags of
+    cached responses and follows Link pagination. 304 responses are served
+    from the cache and don't count against the rate limit.
+    """
+
+    def __init__(self, api_url, cache, session=None, token=None):
+        self.api_url = api_url.rstrip('/')
+        self.cache = cache
+        self.session = session or requests.Session()
+        self.token = token
+        self.stats = {
+            'requests': 0,
+            'cache_hits': 0
+        }
+        self._stats_lock = threading.Lock()
+
+    def url(self, path):
+        """
+        Returns the full API URL for path
+        """
+        return '{}/{}'.format(self.api_url, path.lstrip('/'))
+
+    def get(self, url):
+        """
+        Returns (status_code, body, next_url) for url, using the cached
+        body when GitHub responds with 304 Not Modified
+        """
+        headers = {'Accept': 'application/vnd.github.v3+json'}
+        if self.token:
+            headers['Authorization'] = 'token {}'.format(self.token)
+        entry = self.cache.get(url)
+        if entry is not None:
+            headers['If-None-Match'] = entry['etag']
+
+        r = self.session.get(url, headers=headers)
+        with self._stats_lock:
+            self.stats['requests'] += 1
+            if r.status_code == 304:
+                self.stats['cache_hits'] += 1
+
+        if r.status_code == 304:
+            logger.debug('GH cache hit for: {}'.format(url))
+            return 200, entry['body'], entry['next']
+
+        next_url = r.links.get('next', {}).get('url')
+        if r.status_code != 200:
+            return r.status_code, None, None
+        body = r.json()
+        if 'ETag' in r.headers:
+            self.cache.put(url, {
+                'etag': r.headers['ETag'],
+                'body': body,
+                'next': next_url
+            })
+        return r.status_code, body, next_url
+
+    def get_raw(self, path, accept='application/vnd.github.v3.raw'):
+        """
+        Returns the raw bytes of the API path without caching, for
+        immutable content such as blobs
+        """
+        url = self.url(path)
+        headers = {'Accept': accept}
+        if self.token:
+            headers['Authorization'] = 'token {}'.format(self.token)
+        r = self.session.get(url, headers=headers)
+        with self._stats_lock:
+            self.stats['requests'] += 1
+        if r.status_code != 200:
+            logger.error('GH URL status code error: {} {}'.format(
+                url, r.status_code))
+            raise Exception('GH URL status code != 200')
+        return r.content
+
+    def get_json(self, path):
+        """
+        Returns the JSON body for the API path
+        """
+        url = self.url(path)
+        status_code, body, _ = self.get(url)
+        if status_code != 200:
+            logger.error('GH URL status code error: {} {}'.format(
+                url, status_code))
+            raise Exception('GH URL status code != 200')
+        return body
+
+    def get_paginated(self, path):
+        """
+        Returns the items of every page of the list at the API path
+        """
+        url = self.url(path)
+        items = []
+        while url is not None:
+            status_code, body, url = self.get(url)
+            if status_code != 200:
+                logger.error('GH URL status code error: {} {}'.format(
+                    path, status_code))
+                raise Exception('GH URL status code != 200')
+            items.extend(body)
+        return items
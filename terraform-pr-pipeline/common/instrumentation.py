@@ -0,0 +1,246 @@
+import json
+import math
+import time
+import functools
+import threading
+from urllib.parse import urlparse
+
+# CloudWatch namespace of the embedded metric format documents
+metrics_namespace = 'terraform-pr-pipeline'
+
+# Metric names of every API summary with their CloudWatch units
+metric_units = [
+    ('Calls', 'Count'),
+    ('Errors', 'Count'),
+    ('LatencyP50', 'Milliseconds'),
+    ('LatencyP99', 'Milliseconds'),
+    ('BytesDownloaded', 'Bytes'),
+    ('BytesUploaded', 'Bytes'),
+]
+
+
+def percentile(values, fraction):
+    """
+    Returns the nearest-rank percentile of values
+    """
+    ordered = sorted(values)
+    rank = int(math.ceil(fraction * len(ordered)))
+    return ordered[max(rank, 1) - 1]
+
+
+def body_size(body):
+    """
+    Returns the size in bytes of a request body, 0 for streams
+    """
+    if isinstance(body, str):
+        return len(body.encode('utf-8'))
+    if isinstance(body, (bytes, bytearray)):
+        return len(body)
+    return 0
+
+
+def github_api_name(url):
+    """
+    Returns the name GitHub requests are summarized under, e.g.
+    github.pulls for repos/owner/repo/pulls/1 and the host name for
+    requests outside the API such as archive downloads
+    """
+    parsed = urlparse(url)
+    parts = [part for part in parsed.path.split('/') if part]
+    if 'repos' in parts:
+        parts = parts[parts.index('repos') + 3:]
+        name = parts[:2] if parts[:1] == ['git'] else parts[:1]
+        return 'github.{}'.format('.'.join(name) or 'repos')
+    if parsed.hostname and parsed.hostname.startswith('api.'):
+        return 'github.{}'.format(parts[0] if parts else 'root')
+    return parsed.hostname or 'github'
+
+
+class Metrics:
+    """
+    Collects the calls, errors, latencies and bytes of every API used
+    during one invocation. Safe to share between threads.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.depth = 0
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets the calls recorded so far
+        """
+        with self._lock:
+            self.apis = {}
+
+    def _api(self, api):
+        return self.apis.setdefault(api, {
+            'latencies': [],
+            'errors': 0,
+            'bytes_downloaded': 0,
+            'bytes_uploaded': 0
+        })
+
+    def record(self, api, seconds, downloaded=0, uploaded=0, error=False):
+        """
+        Records one call to api
+        """
+        with self._lock:
+            entry = self._api(api)
+            entry['latencies'].append(seconds)
+            entry['errors'] += 1 if error else 0
+            entry['bytes_downloaded'] += downloaded
+            entry['bytes_uploaded'] += uploaded
+
+    def add_downloaded(self, api, size):
+        """
+        Adds bytes read after the call returned, e.g. from a streamed body
+        """
+        with self._lock:
+            self._api(api)['bytes_downloaded'] += size
+
+    def summary(self):
+        """
+        Returns a dict mapping every API called to its call count, error
+        count, p50 and p99 latency in milliseconds and bytes moved
+        """
+        with self._lock:
+            apis = dict(self.apis)
+        summary = {}
+        for api, entry in sorted(apis.items()):
+            latencies = entry['latencies'] or [0]
+            summary[api] = {
+                'Calls': len(entry['latencies']),
+                'Errors': entry['errors'],
+                'LatencyP50': round(percentile(latencies, 0.5) * 1000, 1),
+                'LatencyP99': round(percentile(latencies, 0.99) * 1000, 1),
+                'BytesDownloaded': entry['bytes_downloaded'],
+                'BytesUploaded': entry['bytes_uploaded']
+            }
+        return summary
+
+    def embedded_metrics(self, function_name, namespace=metrics_namespace):
+        """
+        Returns one CloudWatch embedded metric format document per API with
+        the summary of its calls
+        """
+        timestamp = int(self.clock() * 1000)
+        documents = []
+        for api, values in self.summary().items():
+            document = {
+                '_aws': {
+                    'Timestamp': timestamp,
+                    'CloudWatchMetrics': [{
+                        'Namespace': namespace,
+                        'Dimensions': [['FunctionName', 'Api']],
+                        'Metrics': [
+                            {'Name': name, 'Unit': unit}
+                            for name, unit in metric_units
+                        ]
+                    }]
+                },
+                'FunctionName': function_name,
+                'Api': api
+            }
+            document.update(values)
+            documents.append(document)
+        return documents
+
+    def emit(self, function_name, namespace=metrics_namespace):
+        """
+        Prints the embedded metric format documents to stdout. CloudWatch
+        only extracts metrics from log lines that are plain JSON, which the
+        formatted logger lines are not.
+        """
+        for document in self.embedded_metrics(function_name, namespace):
+            print(json.dumps(document, sort_keys=True), flush=True)
+
+
+def instrument_client(client, metrics):
+    """
+    Records every call made by a boto client through its event system.
+    Returns the client.
+    """
+    def before_call(params, context, event_name, **kwargs):
+        context['instrumentation_start'] = metrics.clock()
+        context['instrumentation_uploaded'] = body_size(params.get('body'))
+
+    def after_call(http_response, parsed, context, event_name, **kwargs):
+        if 'instrumentation_start' not in context:
+            return
+        length = http_response.headers.get('content-length') or 0
+        metrics.record(
+            '.'.join(event_name.split('.')[1:]),
+            metrics.clock() - context['instrumentation_start'],
+            downloaded=int(length),
+            uploaded=context['instrumentation_uploaded'],
+            error='Error' in parsed)
+
+    # Registered first so that handlers returning a response early, like
+    # botocore's Stubber, don't keep the call from being timed
+    client.meta.events.register_first('before-call.*.*', before_call)
+    client.meta.events.register('after-call.*.*', after_call)
+    return client
+
+
+def instrument_session(session, metrics, api_name=github_api_name):
+    """
+    Records every request made through a requests session, counting the
+    bytes of streamed responses as they are read. Returns the session.
+    """
+    request = session.request
+
+    def timed_request(method, url, **kwargs):
+        api = api_name(url)
+        start = metrics.clock()
+        try:
+            r = request(method, url, **kwargs)
+        except Exception:
+            metrics.record(api, metrics.clock() - start, error=True)
+            raise
+        uploaded = body_size(kwargs.get('data'))
+        if kwargs.get('stream'):
+            metrics.record(api, metrics.clock() - start, uploaded=uploaded,
+                           error=r.status_code >= 400)
+            iter_content = r.iter_content
+
+            def counted_iter_content(*args, **kwargs):
+                for chunk in iter_content(*args, **kwargs):
+                    metrics.add_downloaded(api, len(chunk))
+                    yield chunk
+
+            r.iter_content = counted_iter_content
+        else:
+            metrics.record(api, metrics.clock() - start,
+                           downloaded=len(r.content), uploaded=uploaded,
+                           error=r.status_code >= 400)
+        return r
+
+    session.request = timed_request
+    return session
+
+
+def instrumented_handler(metrics, function_name):
+    """
+    Decorates a lambda handler so every invocation starts with empty
+    metrics and ends by emitting them. Handlers called from within another
+    instrumented handler add to the metrics of the outer invocation.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(event, context):
+            metrics.depth += 1
+            if metrics.depth == 1:
+                metrics.reset()
+            try:
+                return handler(event, context)
+            finally:
+                metrics.depth -= 1
+                if metrics.depth == 0:
+                    metrics.emit(
+                        getattr(context, 'function_name', None) or
+                        function_name)
+        return wrapper
+    return decorator
@@ -0,0 +1,119 @@
+import re
+import json
+import logging
+import zipfile
+import tempfile
+import posixpath
+from collections import deque
+import requests
+
+logger = logging.getLogger()
+
+# Module graphs are cached per base commit under this prefix
+module_graph_prefix = 'terraform-pr-cache/module-graph'
+archive_chunk_size = 64 * 1024
+
+# Matches the source of module blocks, which terraform convention places
+# before any nested block
+module_source_expression = re.compile(
+    r'module\s+"[^"]*"\s*\{[^}]*?\bsource\s*=\s*"([^"]+)"')
+
+
+def parse_module_sources(text):
+    """
+    Returns the local (./ or ../) sources of the module blocks in text
+    """
+    return [
+        source for source in module_source_expression.findall(text)
+        if source.startswith('./') or source.startswith('../')
+    ]
+
+
+def build_module_graph(archive):
+    """
+    Returns a dict mapping each directory of the zip archive (a path or file
+    object) to the local module directories its templates reference.
+    Paths are relative to the repository root; GitHub zipballs wrap the
+    repository in a single top level directory which is stripped.
+    """
+    graph = {}
+    with zipfile.ZipFile(archive) as repo_zip:
+        for name in repo_zip.namelist():
+            if not name.endswith('.tf'):
+                continue
+            path = name.split('/', 1)[-1]
+            directory = posixpath.dirname(path) or '.'
+            text = repo_zip.read(name).decode('utf-8', 'replace')
+            for source in parse_module_sources(text):
+                module_dir = posixpath.normpath(
+                    posixpath.join(directory, source))
+                if module_dir.startswith('..'):
+                    continue
+                graph.setdefault(directory, set()).add(module_dir)
+    return {
+        directory: sorted(module_dirs)
+        for directory, module_dirs in graph.items()
+    }
+
+
+def load_module_graph(s3, bucket, kms_key_id, archive_url, sha,
+                      session=requests):
+    """
+    Returns the module graph of the repository at sha. Graphs are built
+    from the zipball at archive_url once and then read from the S3 cache.
+    """
+    key = '{}/{}.json'.format(module_graph_prefix, sha)
+    try:
+        response = s3.get_object(Bucket=bucket, Key=key)
+        logger.debug('Module graph cache hit for {}'.format(sha))
+        return json.loads(response['Body'].read().decode('utf-8'))
+    except s3.exceptions.NoSuchKey:
+        pass
+
+    logger.info('Building module graph from: {}'.format(archive_url))
+    with tempfile.TemporaryFile() as archive:
+        with session.get(archive_url, stream=True) as r:
+            if r.status_code != 200:
+                logger.error('GH archive URL status code error: {}'.format(
+                    r.status_code))
+                raise Exception('GH archive URL status code != 200')
+            for chunk in r.iter_content(chunk_size=archive_chunk_size):
+                archive.write(chunk)
+        graph = build_module_graph(archive)
+
+    s3.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=json.dumps(graph).encode('utf-8'),
+        ServerSideEncryption='aws:kms',
+        SSEKMSKeyId=kms_key_id
+    )
+    return graph
+
+
+def reverse_module_graph(graph):
+    """
+    Returns a dict mapping each module directory to the directories that
+    reference it
+    """
+    consumers = {}
+    for directory, module_dirs in graph.items():
+        for module_dir in module_dirs:
+            consumers.setdefault(module_dir, []).append(directory)
+    return consumers
+
+
+def affected_directories(dirs, consumers):
+    """
+    Returns dirs followed by every directory that depends on them, directly
+    or through other modules, in breadth first order
+    """
+    affected = dict.fromkeys(dirs)
+    queue = deque(dirs)
+    while queue:
+        directory = queue.popleft()
+        for consumer in consumers.get(directory, []):
+            if consumer not in affected:
+                affected[consumer] = None
+                queue.append(consumer)
+    return list(affected)
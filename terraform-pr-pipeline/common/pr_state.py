@@ -0,0 +1,240 @@
+import time
+import random
+import logging
+import threading
+
+logger = logging.getLogger()
+
+# Statuses a PR record moves through: poller-create claims the PR with
+# syncing before uploading its archive and marks it synced, or failed so
+# the next poll retries it, and pipeline-create marks it pipeline_created
+statuses = ['syncing', 'synced', 'failed', 'pipeline_created']
+
+# DynamoDB caps batch_get_item at 100 keys per request
+batch_get_size = 100
+
+# Unprocessed keys of a throttled batch_get_item are retried after a
+# jittered exponential backoff from base_delay up to max_delay seconds
+base_delay = 0.05
+max_delay = 2
+
+
+def to_item(record):
+    """
+    Returns a record as DynamoDB attribute values, leaving out None fields
+    """
+    item = {}
+    for name, value in record.items():
+        if value is None:
+            continue
+        if isinstance(value, (int, float)):
+            item[name] = {'N': str(value)}
+        else:
+            item[name] = {'S': str(value)}
+    return item
+
+
+def from_item(item):
+    """
+    Returns the record of a DynamoDB item
+    """
+    record = {}
+    for name, value in item.items():
+        if 'N' in value:
+            number = float(value['N'])
+            record[name] = int(number) if number.is_integer() else number
+        else:
+            record[name] = value['S']
+    return record
+
+
+class DynamoDBPRState:
+    """
+    PR records stored as DynamoDB items keyed by PR key. Every write is a
+    compare-and-set on the version the writer read, so a writer working
+    from an outdated record never overwrites a newer one.
+    """
+
+    def __init__(self, dynamodb, table, clock=time.time, sleep=time.sleep):
+        self.dynamodb = dynamodb
+        self.table = table
+        self.clock = clock
+        self.sleep = sleep
+
+    def get(self, key):
+        """
+        Returns the record of key or None if there is none
+        """
+        response = self.dynamodb.get_item(
+            TableName=self.table,
+            Key={'pr_key': {'S': str(key)}},
+            ConsistentRead=True
+        )
+        if 'Item' not in response:
+            return None
+        return from_item(response['Item'])
+
+    def get_many(self, keys):
+        """
+        Returns a dict mapping the keys that have a record to their record,
+        read 100 keys per request. Keys DynamoDB left unprocessed are
+        requested again after a backoff.
+        """
+        keys = sorted(set(str(key) for key in keys))
+        records = {}
+        for i in range(0, len(keys), batch_get_size):
+            request = {
+                self.table: {
+                    'Keys': [
+                        {'pr_key': {'S': key}}
+                        for key in keys[i:i + batch_get_size]
+                    ],
+                    'ConsistentRead': True
+                }
+            }
+            attempt = 0
+            while request:
+                if attempt > 0:
+                    self.sleep(random.uniform(
+                        0, min(max_delay, base_delay * 2 ** attempt)))
+                response = self.dynamodb.batch_get_item(RequestItems=request)
+                for item in response['Responses'].get(self.table, []):
+                    record = from_item(item)
+                    records[record['pr_key']] = record
+                request = response.get('UnprocessedKeys')
+                attempt += 1
+        return records
+
+    def put(self, key, record, version):
+        """
+        Writes record as the next version of key if the stored version is
+        still version, None meaning no record. Returns the written record
+        or None if another writer changed the record first.
+        """
+        written = dict(
+            record,
+            pr_key=str(key),
+            version=(version or 0) + 1,
+            updated_at=int(self.clock()))
+        if version is None:
+            condition = {
+                'ConditionExpression': 'attribute_not_exists(pr_key)'
+            }
+        else:
+            condition = {
+                'ConditionExpression': '#version = :version',
+                'ExpressionAttributeNames': {'#version': 'version'},
+                'ExpressionAttributeValues': {
+                    ':version': {'N': str(version)}
+                }
+            }
+        try:
+            self.dynamodb.put_item(
+                TableName=self.table,
+                Item=to_item(written),
+                **condition
+            )
+        except self.dynamodb.exceptions.ConditionalCheckFailedException:
+            return None
+        return written
+
+    def delete(self, key, version):
+        """
+        Deletes the record of key if the stored version is still version.
+        Returns False if another writer changed the record first.
+        """
+        try:
+            self.dynamodb.delete_item(
+                TableName=self.table,
+                Key={'pr_key': {'S': str(key)}},
+                ConditionExpression='#version = :version',
+                ExpressionAttributeNames={'#version': 'version'},
+                ExpressionAttributeValues={':version': {'N': str(version)}}
+            )
+        except self.dynamodb.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+
+class MemoryPRState:
+    """
+    Local stand-in for DynamoDBPRState that keeps records in memory
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.records = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns the record of key or None if there is none
+        """
+        with self._lock:
+            record = self.records.get(str(key))
+            return dict(record) if record is not None else None
+
+    def get_many(self, keys):
+        """
+        Returns a dict mapping the keys that have a record to their record
+        """
+        with self._lock:
+            return {
+                str(key): dict(self.records[str(key)])
+                for key in keys if str(key) in self.records
+            }
+
+    def put(self, key, record, version):
+        """
+        Writes record as the next version of key if the stored version is
+        still version, None meaning no record. Returns the written record
+        or None if another writer changed the record first.
+        """
+        with self._lock:
+            stored = self.records.get(str(key))
+            if (stored and stored['version']) != version:
+                return None
+            written = dict(
+                {name: value for name, value in record.items()
+                 if value is not None},
+                pr_key=str(key),
+                version=(version or 0) + 1,
+                updated_at=int(self.clock()))
+            self.records[str(key)] = written
+            return dict(written)
+
+    def delete(self, key, version):
+        """
+        Deletes the record of key if the stored version is still version.
+        Returns False if another writer changed the record first.
+        """
+        with self._lock:
+            stored = self.records.get(str(key))
+            if stored is None or stored['version'] != version:
+                return False
+            del self.records[str(key)]
+            return True
+
+
+def update(state, key, change, attempts=5):
+    """
+    Applies change to the record of key until the compare-and-set write
+    goes through. change is given the current record or None and returns
+    the fields to write, or None to leave the record as it is. Returns the
+    written record, or None if nothing was written.
+    """
+    for _ in range(attempts):
+        record = state.get(key)
+        fields = change(record)
+        if fields is None:
+            return None
+        written = state.put(
+            key,
+            dict(record or {}, **fields),
+            record['version'] if record else None)
+        if written is not None:
+            return written
+        logger.info('PR record {} changed while updating it, retrying'.format(
+            key))
+    raise Exception('Unable to update PR record {} after {} attempts'.format(
+        key, attempts))
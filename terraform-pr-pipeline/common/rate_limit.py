@@ -0,0 +1,238 @@
+import time
+import random
+import logging
+import threading
+import requests
+
+logger = logging.getLogger()
+
+# Share of the GitHub rate limit left for webhooks, CodeBuild comments and
+# anyone else using the same token
+reserve_fraction = 0.1
+
+# Polls are stretched while less than this share of the budget remains
+low_budget_fraction = 0.25
+
+# Server errors retried with exponential backoff
+retry_status_codes = [500, 502, 503, 504]
+
+# Requests let through before a response tells the actual budget
+initial_burst = 100
+initial_rate = 10
+
+# Seconds of an invocation kept free of waits for handling their outcome
+deadline_margin = 5
+
+
+class RateLimitExceeded(Exception):
+    """
+    Raised when a GitHub request would have to wait longer than allowed
+    for the rate limit
+    """
+    pass
+
+
+class TokenBucket:
+    """
+    Lets bursts of up to capacity requests through, refilled at rate
+    requests per second. Safe to share between threads; callers sleep
+    outside the lock.
+    """
+
+    def __init__(self, rate, capacity, clock=time.time, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, max_wait=None):
+        """
+        Takes a token, waiting for it if the bucket is empty. Raises
+        RateLimitExceeded instead of waiting more than max_wait seconds.
+        """
+        with self._lock:
+            self._refill(self.clock())
+            wait = max(1 - self.tokens, 0) / self.rate
+            if max_wait is not None and wait > max_wait:
+                raise RateLimitExceeded(
+                    'Next GitHub request allowed in {:.0f}s'.format(wait))
+            self.tokens -= 1
+        if wait > 0:
+            self.sleep(wait)
+
+    def limit(self, tokens, rate):
+        """
+        Caps the tokens left at tokens and sets the refill rate
+        """
+        with self._lock:
+            self._refill(self.clock())
+            self.tokens = min(self.tokens, tokens)
+            self.rate = rate
+
+
+class GitHubRateLimiter:
+    """
+    Paces the requests of a requests session through a token bucket that
+    follows the X-RateLimit headers of GitHub's responses, so that the
+    remaining budget, less a reserve, lasts until it resets. Rate limited
+    responses are retried after their Retry-After or reset time and server
+    errors after an exponential backoff, as long as no wait is longer than
+    max_wait seconds or runs past the deadline of the invocation.
+    """
+
+    def __init__(self, bucket=None, max_wait=20, max_retries=3,
+                 base_delay=1, clock=time.time, sleep=time.sleep):
+        self.bucket = bucket or TokenBucket(
+            initial_rate, initial_burst, clock=clock, sleep=sleep)
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.clock = clock
+        self.sleep = sleep
+        self.rate_limit = None
+        self.deadline = None
+
+    def set_deadline(self, context, margin=deadline_margin):
+        """
+        Keeps waits from running past the end of the Lambda invocation of
+        context, less margin seconds. Without a context, waits are only
+        bounded by max_wait.
+        """
+        if context is None or \
+                not hasattr(context, 'get_remaining_time_in_millis'):
+            self.deadline = None
+            return
+        self.deadline = self.clock() + \
+            context.get_remaining_time_in_millis() / 1000.0 - margin
+
+    def wait_limit(self):
+        """
+        Returns the longest a request may wait now
+        """
+        if self.deadline is None:
+            return self.max_wait
+        return max(min(self.max_wait, self.deadline - self.clock()), 0)
+
+    def update(self, response):
+        """
+        Adjusts the bucket to the rate limit reported by a response
+        """
+        headers = response.headers
+        if 'X-RateLimit-Remaining' not in headers:
+            return
+        limit = int(headers.get('X-RateLimit-Limit', 0))
+        remaining = int(headers['X-RateLimit-Remaining'])
+        reset = int(headers.get('X-RateLimit-Reset', 0))
+        self.rate_limit = {
+            'limit': limit,
+            'remaining': remaining,
+            'reset': reset
+        }
+        # Once the reserve is reached the next request waits for the reset
+        available = max(remaining - int(limit * reserve_fraction), 0)
+        self.bucket.limit(
+            available, max(available, 1) / max(reset - self.clock(), 1))
+
+    def remaining_fraction(self):
+        """
+        Returns the share of the rate limit left at the last response or
+        None before the first one
+        """
+        if self.rate_limit is None or self.rate_limit['limit'] == 0:
+            return None
+        return self.rate_limit['remaining'] / float(self.rate_limit['limit'])
+
+    def spare_requests(self):
+        """
+        Returns the requests left above the reserve at the last response or
+        None before the first one
+        """
+        if self.rate_limit is None:
+            return None
+        return max(self.rate_limit['remaining'] - int(
+            self.rate_limit['limit'] * reserve_fraction), 0)
+
+    def retry_delay(self, response, attempt):
+        """
+        Returns the seconds to wait before retrying a response or None if
+        it shouldn't be retried
+        """
+        headers = response.headers
+        rate_limited = response.status_code == 429 or (
+            response.status_code == 403 and (
+                headers.get('X-RateLimit-Remaining') == '0' or
+                'Retry-After' in headers))
+        if rate_limited:
+            if 'Retry-After' in headers:
+                return float(headers['Retry-After'])
+            return max(int(headers.get('X-RateLimit-Reset', 0)) -
+                       self.clock(), 0) + 1
+        if response.status_code in retry_status_codes:
+            return random.uniform(0, self.base_delay * 2 ** attempt)
+        return None
+
+    def wrap(self, session, token=None):
+        """
+        Paces and retries every request made through session, sending the
+        PAT returned by token if given. Returns the session.
+        """
+        request = session.request
+
+        def limited_request(method, url, **kwargs):
+            if token is not None:
+                headers = dict(kwargs.get('headers') or {})
+                headers.setdefault(
+                    'Authorization', 'token {}'.format(token()))
+                kwargs['headers'] = headers
+            for attempt in range(self.max_retries + 1):
+                self.bucket.acquire(self.wait_limit())
+                try:
+                    r = request(method, url, **kwargs)
+                except requests.exceptions.ConnectionError:
+                    if attempt == self.max_retries:
+                        raise
+                    self.sleep(random.uniform(
+                        0, self.base_delay * 2 ** attempt))
+                    continue
+                self.update(r)
+                delay = self.retry_delay(r, attempt)
+                if delay is None or attempt == self.max_retries:
+                    return r
+                if delay > self.wait_limit():
+                    raise RateLimitExceeded(
+                        'GitHub asked to wait {:.0f}s before retrying '
+                        '{}'.format(delay, url))
+                logger.info('GitHub answered {} to {}, retrying in '
+                            '{:.1f}s'.format(r.status_code, url, delay))
+                r.close()
+                self.sleep(delay)
+
+        session.request = limited_request
+        return session
+
+
+def poll_interval(previous, base, maximum, changed, remaining_fraction):
+    """
+    Returns the minutes until the next poll: base after a poll that found
+    changed PRs, doubling up to maximum while nothing changes, and
+    stretched in proportion while less than low_budget_fraction of the
+    GitHub rate limit remains
+    """
+    if changed:
+        interval = base
+    else:
+        interval = min(max(previous, base) * 2, maximum)
+    if remaining_fraction is not None and \
+            remaining_fraction < low_budget_fraction:
+        interval = min(
+            interval * low_budget_fraction / max(remaining_fraction, 0.01),
+            maximum)
+    return interval
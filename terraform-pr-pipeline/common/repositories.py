@@ -0,0 +1,55 @@
+import re
+
+# Objects of a PR are stored under owner/repo/pr_number/
+archive_name = 'repo.zip'
+
+
+def repository_names(value):
+    """
+    Returns the owner/repo names of a comma or whitespace separated list
+    """
+    return [name for name in re.split(r'[,\s]+', value or '') if name]
+
+
+def pr_key(repo, pr_number):
+    """
+    Returns the key prefix of a PR, unique across repositories
+    """
+    return '{}/{}'.format(repo, pr_number)
+
+
+def archive_key(repo, pr_number):
+    """
+    Returns the key of the PR's repo.zip object
+    """
+    return '{}/{}'.format(pr_key(repo, pr_number), archive_name)
+
+
+def parse_pr_key(key):
+    """
+    Returns the repo and PR number of an object stored under a PR prefix or
+    None for any other key
+    """
+    parts = key.split('/')
+    if len(parts) < 4 or not parts[2].isdigit():
+        return None
+    return '{}/{}'.format(parts[0], parts[1]), parts[2]
+
+
+def parse_archive_key(key):
+    """
+    Returns the repo and PR number of a repo.zip key or None for any other
+    key
+    """
+    parts = key.split('/')
+    if len(parts) != 4 or parts[3] != archive_name:
+        return None
+    return parse_pr_key(key)
+
+
+def repo_slug(repo):
+    """
+    Returns the owner/repo name in a form allowed in CodePipeline and
+    CodeBuild resource names
+    """
+    return re.sub(r'[^A-Za-z0-9-]', '-', repo.replace('/', '-'))
@@ -0,0 +1,101 @@
+import os
+import logging
+import threading
+from instrumentation import instrument_client
+
+logger = logging.getLogger()
+
+log_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s\n'
+
+# Clients of the current process, kept across warm invocations
+clients = {}
+clients_lock = threading.Lock()
+
+# Decrypted SSM parameters, read once per process
+parameters = {}
+
+
+def configure_logging(level=logging.INFO):
+    """
+    Sets the level and format of the root logger and quiets boto. Adds a
+    handler when there is none, as outside of Lambda. Returns the logger.
+    """
+    if not logger.handlers:
+        logging.basicConfig()
+    logger.setLevel(level)
+    logger.handlers[0].setFormatter(logging.Formatter(log_format))
+    logging.getLogger('boto3').setLevel(logging.ERROR)
+    logging.getLogger('botocore').setLevel(logging.ERROR)
+    return logger
+
+
+def env_bool(name, default='false'):
+    """
+    Returns True if the environment variable is 'true' or '1'
+    """
+    return os.environ.get(name, default).lower() in ['true', '1']
+
+
+def env_int(name, default):
+    """
+    Returns the environment variable as an integer
+    """
+    return int(os.environ.get(name, str(default)))
+
+
+class LazyClient:
+    """
+    Stands in for a boto3 client until it is first used. boto3 is only
+    imported and the client only created then, and instrumented with
+    metrics if given, so that cold starts don't pay for clients the
+    invocation never calls.
+    """
+
+    def __init__(self, service, metrics=None):
+        self.service = service
+        self.metrics = metrics
+        self._client = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Returns the boto3 client, creating it on the first call
+        """
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import boto3
+                    client = boto3.client(self.service)
+                    if self.metrics is not None:
+                        instrument_client(client, self.metrics)
+                    self._client = client
+        return self._client
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+
+def client(service, metrics=None):
+    """
+    Returns the lazily created client of service for this process,
+    recording its calls in metrics
+    """
+    with clients_lock:
+        if (service, metrics) not in clients:
+            clients[(service, metrics)] = LazyClient(service, metrics)
+        return clients[(service, metrics)]
+
+
+def parameter(ssm, name):
+    """
+    Returns the decrypted value of an SSM parameter, read on first use and
+    kept across warm invocations
+    """
+    if name not in parameters:
+        parameters[name] = ssm.get_parameter(
+            Name=name,
+            WithDecryption=True
+        )['Parameter']['Value']
+    return parameters[name]
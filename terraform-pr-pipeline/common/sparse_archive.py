@@ -0,0 +1,159 @@
+import zipfile
+import posixpath
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from changed_files import modified_directories
+from module_graph import parse_module_sources
+
+# The files API lists at most this many files of a pull request
+max_pr_files = 3000
+
+# Above this many files a single zipball request is cheaper than fetching
+# every blob. Callers lower it further to what the rate limit has left.
+max_blobs = 200
+
+# Blobs of a directory fetched at once. Every request still goes through
+# the client's rate limiter.
+blob_workers = 8
+
+# Zip permissions of regular and executable blobs. Symbolic links and
+# submodules are left out.
+blob_modes = {
+    '100644': 0o100644,
+    '100755': 0o100755,
+}
+
+
+def get_tree(github, repo, sha):
+    """
+    Returns a dict mapping the path of every file of the commit to its tree
+    entry (sha, mode and size) or None when GitHub truncated the tree
+    """
+    tree = github.get_json('repos/{}/git/trees/{}?recursive=1'.format(
+        repo, sha))
+    if tree.get('truncated'):
+        return None
+    return {
+        item['path']: item for item in tree['tree']
+        if item['type'] == 'blob' and item['mode'] in blob_modes
+    }
+
+
+def get_changed_paths(github, repo, pr_number):
+    """
+    Returns the paths of the files added, modified or removed by the PR,
+    with the old path of renamed files, like parse_diff, or None when it
+    changes more files than the files API lists
+    """
+    files = github.get_paginated(
+        'repos/{}/pulls/{}/files?per_page=100'.format(repo, pr_number))
+    if len(files) >= max_pr_files:
+        return None
+    paths = []
+    for item in files:
+        paths.append(item['filename'])
+        if 'previous_filename' in item:
+            paths.append(item['previous_filename'])
+    return paths
+
+
+def directory_files(tree, directory):
+    """
+    Returns the paths of the tree under directory, subdirectories included,
+    since modules read templates and policies there through path.module
+    """
+    if directory == '.':
+        return sorted(tree)
+    prefix = directory + '/'
+    return sorted(path for path in tree if path.startswith(prefix))
+
+
+def package_directories(github, repo, tree, directories, archive, top_dir,
+                        max_blobs=max_blobs):
+    """
+    Writes the files of directories and of every local module they use,
+    directly or through other modules, to the zip archive under top_dir,
+    with everything in their subdirectories. The blobs of each directory
+    are fetched concurrently. Returns the packaged directories and their
+    size in bytes, or None when they hold more than max_blobs files.
+    """
+    def get_blob(path):
+        return github.get_raw('repos/{}/git/blobs/{}'.format(
+            repo, tree[path]['sha']))
+
+    packaged = {}
+    written = set()
+    packaged_bytes = 0
+    blobs = 0
+    queue = deque(directories)
+    with ThreadPoolExecutor(max_workers=blob_workers) as executor, \
+            zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as repo_zip:
+        repo_zip.writestr('{}/'.format(top_dir), b'')
+        while queue:
+            directory = queue.popleft()
+            if directory in packaged:
+                continue
+            packaged[directory] = None
+            paths = [
+                path for path in directory_files(tree, directory)
+                if path not in written
+            ]
+            written.update(paths)
+            blobs += len(paths)
+            if blobs > max_blobs:
+                return None
+            for path, content in zip(paths, executor.map(get_blob, paths)):
+                item = tree[path]
+                info = zipfile.ZipInfo('{}/{}'.format(top_dir, path))
+                info.external_attr = blob_modes[item['mode']] << 16
+                info.compress_type = zipfile.ZIP_DEFLATED
+                repo_zip.writestr(info, content)
+                packaged_bytes += item['size']
+                if not path.endswith('.tf'):
+                    continue
+                for source in parse_module_sources(
+                        content.decode('utf-8', 'replace')):
+                    module_dir = posixpath.normpath(posixpath.join(
+                        posixpath.dirname(path) or '.', source))
+                    if not module_dir.startswith('..'):
+                        queue.append(module_dir)
+    return list(packaged), packaged_bytes
+
+
+def build_sparse_archive(github, repo, pr, consumers, archive,
+                         max_blobs=max_blobs):
+    """
+    Writes a zip of the PR head holding only the directories its builds
+    use: the modified directories, the tests directories to plan and the
+    local modules they reference. The top level directory is named like
+    the one of GitHub zipballs so buildspecs find it the same way.
+    Returns a summary of the archive or None when the PR is too large for
+    the trees or files APIs, or its directories hold more than max_blobs
+    files, and the full zipball has to be used.
+    """
+    head_repo = pr['head']['repo']['full_name']
+    sha = pr['head']['sha']
+    tree = get_tree(github, head_repo, sha)
+    if tree is None:
+        return None
+    paths = get_changed_paths(github, repo, pr['number'])
+    if paths is None:
+        return None
+
+    dirs = modified_directories(paths, consumers)
+    packaged = package_directories(
+        github,
+        head_repo,
+        tree,
+        dirs['dirs'] + dirs['test_dirs'],
+        archive,
+        '{}-{}'.format(repo.replace('/', '-'), sha[:7]),
+        max_blobs)
+    if packaged is None:
+        return None
+    directories, packaged_bytes = packaged
+    return {
+        'directories': len(directories),
+        'packaged_bytes': packaged_bytes,
+        'tree_bytes': sum(item['size'] for item in tree.values())
+    }
@@ -0,0 +1,118 @@
+import logging
+
+logger = logging.getLogger()
+
+# In-progress executions are always among the most recent ones, so only the
+# first page of the execution history is scanned
+execution_scan_limit = 25
+
+
+class SupersessionController:
+    """
+    Stops the running executions of a pipeline and the CodeBuild builds they
+    started before running the pipeline against the latest commit, so that
+    builds of outdated commits don't hold on to CodeBuild capacity or post
+    statuses on a commit that is no longer the head of the PR
+    """
+
+    def __init__(self, codepipeline, codebuild):
+        self.codepipeline = codepipeline
+        self.codebuild = codebuild
+
+    def running_executions(self, pipeline_name):
+        """
+        Returns the ids of the pipeline's in-progress executions
+        """
+        response = self.codepipeline.list_pipeline_executions(
+            pipelineName=pipeline_name, maxResults=execution_scan_limit)
+        return [
+            execution['pipelineExecutionId']
+            for execution in response['pipelineExecutionSummaries']
+            if execution['status'] == 'InProgress'
+        ]
+
+    def running_builds(self, pipeline_name, execution_id):
+        """
+        Returns the ids of the in-progress CodeBuild builds started by the
+        pipeline execution
+        """
+        builds = []
+        kwargs = {
+            'pipelineName': pipeline_name,
+            'filter': {'pipelineExecutionId': execution_id}
+        }
+        while True:
+            response = self.codepipeline.list_action_executions(**kwargs)
+            for action in response['actionExecutionDetails']:
+                if action['status'] != 'InProgress':
+                    continue
+                if action['input']['actionTypeId']['provider'] != 'CodeBuild':
+                    continue
+                build_id = action.get('output', {}).get(
+                    'executionResult', {}).get('externalExecutionId')
+                if build_id is not None:
+                    builds.append(build_id)
+            if 'nextToken' not in response:
+                return builds
+            kwargs['nextToken'] = response['nextToken']
+
+    def stop_execution(self, pipeline_name, execution_id, sha):
+        """
+        Stops the pipeline execution and its builds. Returns the ids of the
+        builds that were stopped.
+        """
+        builds = self.running_builds(pipeline_name, execution_id)
+        not_stoppable = self.codepipeline.exceptions.\
+            PipelineExecutionNotStoppableException
+        try:
+            # Abandoning doesn't wait for the running actions, which are
+            # stopped right after
+            self.codepipeline.stop_pipeline_execution(
+                pipelineName=pipeline_name,
+                pipelineExecutionId=execution_id,
+                abandon=True,
+                reason='Superseded by {}'.format(sha))
+        except not_stoppable:
+            logger.info('Execution {} already finished'.format(execution_id))
+
+        stopped = []
+        for build_id in builds:
+            try:
+                self.codebuild.stop_build(id=build_id)
+            except Exception as e:
+                logger.error('Unable to stop build {}: {}'.format(
+                    build_id, e))
+                continue
+            stopped.append(build_id)
+        return stopped
+
+    def stop_running(self, pipeline_name, sha):
+        """
+        Stops every running execution of the pipeline and their builds.
+        Returns a summary of what was stopped.
+        """
+        summary = {
+            'stopped_executions': [],
+            'stopped_builds': []
+        }
+        for execution_id in self.running_executions(pipeline_name):
+            logger.info('Superseding execution {} of {}'.format(
+                execution_id, pipeline_name))
+            summary['stopped_builds'].extend(
+                self.stop_execution(pipeline_name, execution_id, sha))
+            summary['stopped_executions'].append(execution_id)
+        return summary
+
+    def supersede(self, pipeline_name, sha):
+        """
+        Stops every running execution of the pipeline and starts a single
+        new one, which picks up the latest repo.zip. Returns a summary of
+        what was stopped and started.
+        """
+        summary = self.stop_running(pipeline_name, sha)
+        response = self.codepipeline.start_pipeline_execution(
+            name=pipeline_name)
+        summary['started_execution'] = response['pipelineExecutionId']
+        logger.info('Started execution {} of {} for {}'.format(
+            summary['started_execution'], pipeline_name, sha))
+        return summary
@@ -41,6 +41,8 @@ data "aws_iam_policy_document" "codebuild_service" {
       "s3:GetObject",
       "s3:GetObjectVersion",
       "s3:PutObject",
+      "s3:GetBucketAcl",
+      "s3:GetBucketLocation",
     ]
 
     resources = [
@@ -59,6 +61,18 @@ data "aws_iam_policy_document" "codebuild_service" {
       "arn:aws:ssm:${var.aws_region}:${data.aws_caller_identity.current.account_id}:parameter/${var.project_name}-terraform-pr*",
     ]
   }
+
+  statement {
+    sid = "dynamodb"
+
+    actions = [
+      "dynamodb:GetItem",
+    ]
+
+    resources = [
+      "${aws_dynamodb_table.pr_state.arn}",
+    ]
+  }
 }
 
 resource "aws_iam_policy" "codebuild_service" {
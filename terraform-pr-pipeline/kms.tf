@@ -67,6 +67,7 @@ data "aws_iam_policy_document" "pipeline_key" {
         "${aws_iam_role.poller_create.arn}",
         "${aws_iam_role.poller_delete.arn}",
         "${aws_iam_role.pipeline_create.arn}",
+        "${aws_iam_role.webhook_ingest.arn}",
       ]
     }
   }
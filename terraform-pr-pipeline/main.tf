@@ -1,8 +1,8 @@
 /**
   # AWS terraform pull request pipeline
-  Provisions CI/CD pipeline for terraform pull request reviews. A new pipeline (AWS CodePipeline) is created for each new pull request in the given GitHub repository. The solution uses AWS lambda to sync contents of PRs with S3 and to create the pipeline. CodeBuild is used to check for terraform fmt, runs terrascan for static code analysis, and comments results into the PR.
+  Provisions CI/CD pipeline for terraform pull request reviews. A new pipeline (AWS CodePipeline) is created for each new pull request in the given GitHub repository. The solution uses AWS lambda to sync contents of PRs with S3 and to create the pipeline. CodeBuild is used to check for terraform fmt, runs terrascan for static code analysis, and comments results into the PR. Several repositories can be tracked by one deployment by listing them in `github_repo_names`.
 
-  The pipeline will only perform tests on directories that contain modified files only. Testing that terraform plan/apply exesutes without errors will be done on /tests directories assuming that such directory exists on each template directory. Here's an example directory tree:
+  The pipeline will only perform tests on directories that contain modified files only. Testing that terraform plan/apply exesutes without errors will be done on /tests directories assuming that such directory exists on each template directory. Directories that use a modified module through a local `source = "./..."` or `source = "../..."` reference get their /tests directories planned as well. Here's an example directory tree:
 ```
   .
 |-- main.tf
@@ -25,18 +25,26 @@
   Prior to running the terraform templates for the first time. Execute setup.sh to prepopulate required zip files. Before the pipeline gets executed place your GitHub Personal Access Token (PAT) in the SSM parameter store (using a KMS key to encrypt it) at ${PROJECT_NAME}-terraform-pr-pat. Here's an AWS CLI example for PROJECT_NAME=therasec: `aws ssm put-parameter --name therasec-terraform-pr-pat --value THE_TOKEN --type SecureString --key-id THE_KMS_KEY_ID`.
 
   ## poller-create lambda
-  Funtion that is triggered by default every 5 minutes to poll the repository for open pull requets. A zip file of latest commit for each pull request is saved into an S3 bucket.
+  Funtion that is triggered by default every 5 minutes to poll the repository for open pull requets. A zip file of latest commit for each pull request is saved into an S3 bucket by worker invocations fed through an SQS queue.
 
   ## poller-delete lambda
   Function that is triggered by default every 60 minutes to remove zip files from S3 corresponding to pull requests no longer open.
 
+  ## webhook-ingest lambda
+  Triggered by GitHub `pull_request` and `push` webhooks sent to the `webhook_url` output. Queues the affected pull requests for the poller-create workers, so new commits are synced without waiting for the next poll.
+
   ## pipeline-create lambda
-  Triggered each time there's a zip file uploaded to S3. This function creates an AWS CodePipeline pipeline if one doesn't exists yet for that pull request.
+  Triggered each time there's a zip file uploaded to S3. This function creates or updates the AWS CodePipeline pipeline for that pull request and starts it once there is build capacity.
 
   ## pipeline-delete lambda
   Triggered each time there's a zip file deleted from S3. This function deletes the pipeline for closed PRs.
  */
 
+// Every tracked repository, passed to the functions as a comma separated list
+locals {
+  github_repo_names = "${join(",", compact(concat(list(var.github_repo_name), var.github_repo_names)))}"
+}
+
 provider aws {
   profile = "${var.aws_profile}"
   region  = "${var.aws_region}"
@@ -67,6 +75,24 @@ resource "aws_s3_bucket" "bucket" {
   force_destroy = "True"
 }
 
+// Head commit, pipeline and sync status of every PR, written only through
+// compare-and-set on the version attribute
+resource "aws_dynamodb_table" "pr_state" {
+  name           = "${var.project_name}-terraform-pr-state"
+  read_capacity  = 5
+  write_capacity = 5
+  hash_key       = "pr_key"
+
+  attribute {
+    name = "pr_key"
+    type = "S"
+  }
+
+  tags {
+    Name = "${var.project_name}-terraform-pr-state"
+  }
+}
+
 // Allows IAM roles to be assumed by lambda
 data "aws_iam_policy_document" "lambda_assume_role" {
   statement {
@@ -67,3 +67,13 @@ output "poller_delete_lambda" {
 output "poller_delete_iam_role_arn" {
   value = "${aws_iam_role.poller_delete.arn}"
 }
+
+// ARN for webhook-ingest lambda function
+output "webhook_ingest_lambda" {
+  value = "${aws_lambda_function.webhook_ingest.arn}"
+}
+
+// URL to configure as the payload URL of the GitHub webhook
+output "webhook_url" {
+  value = "${aws_api_gateway_deployment.webhook.invoke_url}/webhook"
+}
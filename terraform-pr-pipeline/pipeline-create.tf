@@ -3,7 +3,7 @@
  */
 
 resource "aws_lambda_function" "pipeline_create" {
-  depends_on       = ["null_resource.pipeline_create_dependencies"]
+  depends_on       = ["null_resource.pipeline_create_dependencies", "aws_s3_bucket_object.plan_runner", "aws_s3_bucket_object.install_toolchain", "aws_s3_bucket_object.terrascan_runner"]
   filename         = ".lambda-zip/pipeline-create.zip"
   function_name    = "${var.project_name}-pipeline-create"
   role             = "${aws_iam_role.pipeline_create.arn}"
@@ -11,6 +11,7 @@ resource "aws_lambda_function" "pipeline_create" {
   source_code_hash = "${base64sha256(file("${path.module}/.lambda-zip/pipeline-create.zip"))}"
   runtime          = "python3.6"
   kms_key_arn      = "${aws_kms_key.pipeline_key.arn}"
+  timeout          = 300
 
   tags {
     Name = "${var.project_name}-pipeline-create"
@@ -19,7 +20,6 @@ resource "aws_lambda_function" "pipeline_create" {
   environment {
     variables = {
       GITHUB_API_URL            = "${var.github_api_url}"
-      GITHUB_REPO_NAME          = "${var.github_repo_name}"
       BUCKET_NAME               = "${aws_s3_bucket.bucket.id}"
       PROJECT_NAME              = "${var.project_name}"
       CODE_BUILD_IMAGE          = "${var.code_build_image}"
@@ -27,6 +27,11 @@ resource "aws_lambda_function" "pipeline_create" {
       CODEBUILD_SERVICE_ROLE    = "${aws_iam_role.codebuild.arn}"
       CODEPIPELINE_SERVICE_ROLE = "${aws_iam_role.codepipeline.arn}"
       KMS_KEY                   = "${aws_kms_key.pipeline_key.arn}"
+      PLAN_PARALLELISM          = "${var.plan_parallelism}"
+      SHARED_CODEBUILD_PROJECTS = "${var.shared_codebuild_projects}"
+      MAX_CONCURRENT_BUILDS     = "${var.max_concurrent_builds}"
+      GITHUB_PAT_PARAMETER      = "${var.project_name}-terraform-pr-pat"
+      PR_STATE_TABLE            = "${aws_dynamodb_table.pr_state.name}"
     }
   }
 }
@@ -40,10 +45,75 @@ resource "aws_lambda_permission" "pipeline_create" {
   source_arn    = "${aws_s3_bucket.bucket.arn}"
 }
 
+// Allows cloudwatch to trigger the function to start queued pipelines
+resource "aws_lambda_permission" "pipeline_create_admission" {
+  statement_id  = "admission"
+  action        = "lambda:InvokeFunction"
+  function_name = "${aws_lambda_function.pipeline_create.function_name}"
+  principal     = "events.amazonaws.com"
+  source_arn    = "${aws_cloudwatch_event_rule.pipeline_create_drain_schedule.arn}"
+}
+
+// Allows cloudwatch to trigger the function when a pipeline execution
+// finishes
+resource "aws_lambda_permission" "pipeline_create_execution_finished" {
+  statement_id  = "execution-finished"
+  action        = "lambda:InvokeFunction"
+  function_name = "${aws_lambda_function.pipeline_create.function_name}"
+  principal     = "events.amazonaws.com"
+  source_arn    = "${aws_cloudwatch_event_rule.pipeline_create_execution_finished.arn}"
+}
+
+// Records build durations and starts queued pipelines each time a pipeline
+// execution finishes
+resource "aws_cloudwatch_event_rule" "pipeline_create_execution_finished" {
+  name        = "${var.project_name}-pipeline-create-execution-finished"
+  description = "Triggers pipeline-create when a PR pipeline execution finishes"
+
+  event_pattern = <<PATTERN
+{
+  "source": ["aws.codepipeline"],
+  "detail-type": ["CodePipeline Pipeline Execution State Change"],
+  "detail": {
+    "pipeline": [{"prefix": "${var.project_name}-terraform-pr-pipeline-"}],
+    "state": ["SUCCEEDED", "FAILED", "STOPPED", "SUPERSEDED", "CANCELED"]
+  }
+}
+PATTERN
+}
+
+resource "aws_cloudwatch_event_target" "pipeline_create_execution_finished" {
+  rule = "${aws_cloudwatch_event_rule.pipeline_create_execution_finished.name}"
+  arn  = "${aws_lambda_function.pipeline_create.arn}"
+}
+
+// Retries queued pipelines whose start was throttled
+resource "aws_cloudwatch_event_rule" "pipeline_create_drain_schedule" {
+  name                = "${var.project_name}-pipeline-create-drain-schedule"
+  description         = "Periodically triggers pipeline-create to start queued pipelines"
+  schedule_expression = "rate(5 minutes)"
+}
+
+resource "aws_cloudwatch_event_target" "pipeline_create_drain_schedule" {
+  rule = "${aws_cloudwatch_event_rule.pipeline_create_drain_schedule.name}"
+  arn  = "${aws_lambda_function.pipeline_create.arn}"
+}
+
 // Creates zip file with dependencies every time pipeline-create.py is updated
 resource "null_resource" "pipeline_create_dependencies" {
   triggers {
     lambda_function = "${file("${path.module}/pipeline-create/pipeline-create.py")}"
+    changed_files   = "${file("${path.module}/common/changed_files.py")}"
+    module_graph    = "${file("${path.module}/common/module_graph.py")}"
+    supersession    = "${file("${path.module}/common/supersession.py")}"
+    admission       = "${file("${path.module}/common/admission.py")}"
+    build_history   = "${file("${path.module}/common/build_history.py")}"
+    repositories    = "${file("${path.module}/common/repositories.py")}"
+    instrumentation = "${file("${path.module}/common/instrumentation.py")}"
+    runtime         = "${file("${path.module}/common/runtime.py")}"
+    rate_limit      = "${file("${path.module}/common/rate_limit.py")}"
+    pr_state        = "${file("${path.module}/common/pr_state.py")}"
+    requirements    = "${file("${path.module}/pipeline-create/requirements.txt")}"
   }
 
   provisioner "local-exec" {
@@ -55,7 +125,7 @@ resource "null_resource" "pipeline_create_dependencies" {
   }
 
   provisioner "local-exec" {
-    command = "pip install --target=${path.module}/.lambda-zip/pipeline-create-resources requests"
+    command = "pip install --target=${path.module}/.lambda-zip/pipeline-create-resources -r ${path.module}/pipeline-create/requirements.txt"
   }
 
   provisioner "local-exec" {
@@ -66,6 +136,46 @@ resource "null_resource" "pipeline_create_dependencies" {
     command = "cp -R ${path.module}/pipeline-create/*.yml ${path.module}/.lambda-zip/pipeline-create-resources/."
   }
 
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/changed_files.py ${path.module}/.lambda-zip/pipeline-create-resources/."
+  }
+
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/module_graph.py ${path.module}/.lambda-zip/pipeline-create-resources/."
+  }
+
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/supersession.py ${path.module}/.lambda-zip/pipeline-create-resources/."
+  }
+
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/admission.py ${path.module}/.lambda-zip/pipeline-create-resources/."
+  }
+
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/build_history.py ${path.module}/.lambda-zip/pipeline-create-resources/."
+  }
+
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/repositories.py ${path.module}/.lambda-zip/pipeline-create-resources/."
+  }
+
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/instrumentation.py ${path.module}/.lambda-zip/pipeline-create-resources/."
+  }
+
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/runtime.py ${path.module}/.lambda-zip/pipeline-create-resources/."
+  }
+
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/rate_limit.py ${path.module}/.lambda-zip/pipeline-create-resources/."
+  }
+
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/pr_state.py ${path.module}/.lambda-zip/pipeline-create-resources/."
+  }
+
   provisioner "local-exec" {
     command = "cd ${path.module}/.lambda-zip/pipeline-create-resources/ && zip -r ../pipeline-create.zip ."
   }
@@ -97,7 +207,10 @@ data "aws_iam_policy_document" "pipeline_create" {
 
     actions = [
       "codebuild:CreateProject",
+      "codebuild:UpdateProject",
       "codebuild:BatchGetProjects",
+      "codebuild:StopBuild",
+      "codebuild:BatchGetBuilds",
     ]
 
     resources = [
@@ -111,6 +224,12 @@ data "aws_iam_policy_document" "pipeline_create" {
     actions = [
       "codepipeline:GetPipeline",
       "codepipeline:CreatePipeline",
+      "codepipeline:UpdatePipeline",
+      "codepipeline:GetPipelineExecution",
+      "codepipeline:ListPipelineExecutions",
+      "codepipeline:ListActionExecutions",
+      "codepipeline:StartPipelineExecution",
+      "codepipeline:StopPipelineExecution",
     ]
 
     resources = [
@@ -118,6 +237,57 @@ data "aws_iam_policy_document" "pipeline_create" {
     ]
   }
 
+  statement {
+    sid = "s3"
+
+    actions = [
+      "s3:GetObject",
+      "s3:PutObject",
+    ]
+
+    resources = [
+      "${aws_s3_bucket.bucket.arn}/terraform-pr-cache/*",
+    ]
+  }
+
+  statement {
+    sid = "s3admission"
+
+    actions = [
+      "s3:DeleteObject",
+    ]
+
+    resources = [
+      "${aws_s3_bucket.bucket.arn}/terraform-pr-cache/admission/*",
+      "${aws_s3_bucket.bucket.arn}/terraform-pr-cache/build-history/*",
+    ]
+  }
+
+  statement {
+    sid = "dynamodb"
+
+    actions = [
+      "dynamodb:GetItem",
+      "dynamodb:PutItem",
+    ]
+
+    resources = [
+      "${aws_dynamodb_table.pr_state.arn}",
+    ]
+  }
+
+  statement {
+    sid = "s3list"
+
+    actions = [
+      "s3:ListBucket",
+    ]
+
+    resources = [
+      "${aws_s3_bucket.bucket.arn}",
+    ]
+  }
+
   statement {
     sid = "iam"
 
@@ -130,6 +300,18 @@ data "aws_iam_policy_document" "pipeline_create" {
       "${aws_iam_role.codepipeline.arn}",
     ]
   }
+
+  statement {
+    sid = "SSMAccess"
+
+    actions = [
+      "ssm:GetParameter",
+    ]
+
+    resources = [
+      "arn:aws:ssm:${var.aws_region}:${data.aws_caller_identity.current.account_id}:parameter/${var.project_name}-terraform-pr-pat",
+    ]
+  }
 }
 
 resource "aws_iam_policy" "pipeline_create" {
@@ -1,25 +1,35 @@
 import os
-import logging
-import re
-import boto3
+import json
+import hashlib
+import datetime
 import requests
+from changed_files import parse_diff, modified_directories
+from module_graph import load_module_graph, reverse_module_graph
+from supersession import SupersessionController
+from admission import AdmissionScheduler, S3AdmissionStore, DrainLock
+from build_history import build_settings, record_build, recorded_statuses
+from instrumentation import (
+    Metrics, instrument_session, instrumented_handler)
+from runtime import configure_logging, client, env_bool, env_int, parameter
+from rate_limit import GitHubRateLimiter
+from repositories import pr_key, archive_key, parse_archive_key, repo_slug
+from pr_state import DynamoDBPRState, MemoryPRState, update
 
 # Configuring logger
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-logger.handlers[0].setFormatter(logging.Formatter(
-    '%(asctime)s - %(name)s - %(levelname)s - %(message)s\n'
-))
-logging.getLogger('boto3').setLevel(logging.ERROR)
-logging.getLogger('botocore').setLevel(logging.ERROR)
-
-# Boto clients
-codepipeline = boto3.client('codepipeline')
-codebuild = boto3.client('codebuild')
+logger = configure_logging()
+
+# API calls, latencies and bytes of the current invocation
+api_metrics = Metrics()
+
+# Boto clients, created on first use and kept across warm invocations
+codepipeline = client('codepipeline', api_metrics)
+codebuild = client('codebuild', api_metrics)
+s3 = client('s3', api_metrics)
+ssm = client('ssm', api_metrics)
+dynamodb = client('dynamodb', api_metrics)
 
 # Global vars
 github_api_url = os.environ['GITHUB_API_URL']
-repo = os.environ['GITHUB_REPO_NAME']
 bucket = os.environ['BUCKET_NAME']
 project_name = os.environ['PROJECT_NAME']
 code_build_image = os.environ['CODE_BUILD_IMAGE']
@@ -27,447 +37,850 @@ terraform_download_url = os.environ['TERRAFORM_DOWNLOAD_URL']
 codebuild_service_role = os.environ['CODEBUILD_SERVICE_ROLE']
 codepipeline_service_role = os.environ['CODEPIPELINE_SERVICE_ROLE']
 kms_key = os.environ['KMS_KEY']
+plan_parallelism = os.environ.get('PLAN_PARALLELISM', '4')
+shared_codebuild_projects = env_bool('SHARED_CODEBUILD_PROJECTS')
+max_concurrent_builds = env_int('MAX_CONCURRENT_BUILDS', 15)
+github_pat_parameter = os.environ.get('GITHUB_PAT_PARAMETER')
+pr_state_table = os.environ.get('PR_STATE_TABLE')
+
+# CodeBuild projects run by every pipeline. PR projects are sized from the
+# build history of the directories in their directories variable, which
+# take default_seconds each until they have history. Shared projects use
+# the fixed timeout.
+codebuild_projects = [
+    {
+        'name': 'fmt',
+        'action': 'terraform-fmt',
+        'category': 'Test',
+        'description': 'Checks if code is formatted',
+        'buildspec': 'buildspec-terraform-fmt.yml',
+        'timeout': 5,
+        'directories': 'MODIFIED_DIRS',
+        'default_seconds': 20,
+        'parallel': False
+    },
+    {
+        'name': 'terrascan',
+        'action': 'terrascan',
+        'category': 'Test',
+        'description': 'Runs terrascan against PR',
+        'buildspec': 'buildspec-terrascan.yml',
+        'timeout': 5,
+        'directories': 'MODIFIED_DIRS',
+        'default_seconds': 60,
+        'parallel': False
+    },
+    {
+        'name': 'plan',
+        'action': 'terraform-plan',
+        'category': 'Build',
+        'description': 'Runs terraform plan against PR',
+        'buildspec': 'buildspec-terraform-plan.yml',
+        'timeout': 10,
+        'directories': 'MODIFIED_TEST_DIRS',
+        'default_seconds': 300,
+        'parallel': True
+    },
+]
+
+# Head commit, pipeline and status of every PR, shared with poller-create.
+# Without a state table it only covers this process.
+if pr_state_table:
+    pr_state = DynamoDBPRState(dynamodb, pr_state_table)
+else:
+    pr_state = MemoryPRState()
+
+# Pipeline executions are started by the admission scheduler once there is
+# room for all of their builds. Drains take turns through a lock record in
+# the PR state table.
+scheduler = AdmissionScheduler(
+    S3AdmissionStore(s3, bucket, kms_key),
+    codepipeline,
+    SupersessionController(codepipeline, codebuild),
+    max_running_builds=max_concurrent_builds,
+    builds_per_execution=len(codebuild_projects),
+    lock=DrainLock(pr_state))
+
+
+def github_token():
+    """
+    Returns the GitHub PAT stored in the SSM parameter store
+    """
+    return parameter(ssm, github_pat_parameter)
+
+
+# Session shared by every GitHub call, paced to the rate limit left
+github_limiter = GitHubRateLimiter()
+github_session = github_limiter.wrap(
+    instrument_session(requests.Session(), api_metrics),
+    token=github_token if github_pat_parameter else None)
+
+# Diffs are streamed from GitHub in chunks of this size
+diff_chunk_size = 64 * 1024
 
+# Fingerprints of the reconciled pipeline resources, one object per PR and
+# one for the shared CodeBuild projects
+pipeline_state_prefix = 'terraform-pr-cache/pipelines'
+shared_state_key = '{}/shared-codebuild-projects.json'.format(
+    pipeline_state_prefix)
 
-def pipeline_exists(pr_number):
+# Build durations of every directory, one object per repo and CodeBuild
+# project. Every finished build stores its own sample object under the
+# project's prefix first, so that concurrent executions don't overwrite
+# each other's samples.
+build_history_prefix = 'terraform-pr-cache/build-history'
+build_sample_grace_seconds = 15 * 60
+
+# CodeBuild caches of terraform, jq, terrascan and provider plugins, one per
+# terraform version so that upgrading terraform starts from a clean cache
+toolchain_cache_location = '{}/terraform-pr-cache/codebuild/{}'.format(
+    bucket,
+    hashlib.sha1(terraform_download_url.encode('utf-8')).hexdigest()[:12])
+toolchain_cache_dir = '/root/.terraform-pr-cache'
+
+
+def pipeline_name(repo, pr_number):
+    """
+    Returns the name of the PR's AWS CodePipeline pipeline
+    """
+    return '{}-terraform-pr-pipeline-{}-{}'.format(
+        project_name, repo_slug(repo), pr_number)
+
+
+def pipeline_exists(repo, pr_number):
     """Returns True if AWS CodePipeline pipeline exists"""
     try:
-        codepipeline.get_pipeline(name='{}-terraform-pr-{}'.format(
-            project_name,
-            pr_number))
+        codepipeline.get_pipeline(name=pipeline_name(repo, pr_number))
     except codepipeline.exceptions.PipelineNotFoundException:
         return False
     return True
 
 
-def codebuild_project_exists(pr_number, name):
+def put_codebuild_project(definition, exists):
     """
-    Returns True if AWS CodeBuild project exists
+    Updates the CodeBuild project if it is expected to exist and creates it
+    otherwise, switching to the other call when the project turns out to
+    be missing or already created by someone else
     """
-    results = codebuild.batch_get_projects(names=[
-        '{}-terraform-pr-{}-{}'.format(project_name, name, pr_number)
-    ])
-    if results['projectsNotFound'] == []:
-        return True
-    return False
+    if exists:
+        try:
+            logger.info('Updating codebuild project: {}'.format(
+                definition['name']))
+            codebuild.update_project(**definition)
+            return
+        except codebuild.exceptions.ResourceNotFoundException:
+            pass
+    try:
+        logger.info('Creating codebuild project: {}'.format(
+            definition['name']))
+        codebuild.create_project(**definition)
+    except codebuild.exceptions.ResourceAlreadyExistsException:
+        logger.info('Codebuild project {} was created concurrently, '
+                    'updating it'.format(definition['name']))
+        codebuild.update_project(**definition)
 
 
-def remove_list_duplicates(input_list):
-    """Removes duplicates entries from list"""
-    return list(dict.fromkeys(input_list))
+def put_pipeline(definition, exists):
+    """
+    Updates the pipeline if it is expected to exist and creates it
+    otherwise, switching to the other call when the pipeline turns out to
+    be missing or already created by someone else
+    """
+    if exists:
+        try:
+            logger.info('Updating pipeline')
+            codepipeline.update_pipeline(pipeline=definition)
+            return
+        except codepipeline.exceptions.PipelineNotFoundException:
+            pass
+    try:
+        logger.info('Creating pipeline')
+        codepipeline.create_pipeline(pipeline=definition)
+    except codepipeline.exceptions.PipelineNameInUseException:
+        codepipeline.update_pipeline(pipeline=definition)
 
 
-def get_modified_directories(pr_number):
+def codebuild_project_name(name, repo, pr_number):
     """
-    Returns a dict containing paths to the modified directories from the PR
+    Returns the name of the CodeBuild project used by the PR's pipeline
+    """
+    if shared_codebuild_projects:
+        return '{}-terraform-pr-{}'.format(project_name, name)
+    return '{}-terraform-pr-{}-{}-{}'.format(
+        project_name, name, repo_slug(repo), pr_number)
+
+
+def existing_codebuild_projects(names):
+    """
+    Returns the subset of names that are existing AWS CodeBuild projects
+    """
+    results = codebuild.batch_get_projects(names=names)
+    return set(names) - set(results['projectsNotFound'])
+
+
+def fingerprint(definition):
+    """
+    Returns a hash of a resource definition
+    """
+    return hashlib.sha256(
+        json.dumps(definition, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_head_sha(repo, pr_number):
+    """
+    Returns the commit poller-create recorded for the PR's repo.zip
+    """
+    record = pr_state.get(pr_key(repo, pr_number))
+    return record.get('head_sha') if record is not None else None
+
+
+def record_pipeline(repo, pr_number, name, sha):
+    """
+    Records the PR's pipeline, and that it was created for sha unless a
+    newer commit was synced in the meantime
+    """
+    def change(record):
+        fields = {
+            'repo': repo,
+            'pr_number': int(pr_number),
+            'archive_key': archive_key(repo, pr_number),
+            'pipeline_name': name
+        }
+        if record is not None and record.get('head_sha') == sha:
+            fields['status'] = 'pipeline_created'
+        return fields
+    update(pr_state, pr_key(repo, pr_number), change)
+
+
+def pipeline_state_key(repo, pr_number):
+    """
+    Returns the key of the cached state of the PR's pipeline resources
+    """
+    return '{}/{}.json'.format(pipeline_state_prefix, pr_key(repo, pr_number))
+
+
+def load_pipeline_state(key):
+    """
+    Returns the cached state of the pipeline resources stored at key
+    """
+    try:
+        response = s3.get_object(Bucket=bucket, Key=key)
+    except s3.exceptions.NoSuchKey:
+        return {'sha': None, 'fingerprints': {}}
+    return json.loads(response['Body'].read().decode('utf-8'))
+
+
+def save_pipeline_state(key, state):
+    """
+    Caches the state of pipeline resources at key
+    """
+    s3.put_object(
+        Bucket=bucket,
+        Key=key,
+        Body=json.dumps(state).encode('utf-8'),
+        ServerSideEncryption='aws:kms',
+        SSEKMSKeyId=kms_key
+    )
+
+
+def load_build_history(repo, name):
+    """
+    Returns the build history of the named CodeBuild project in repo
+    """
+    try:
+        response = s3.get_object(
+            Bucket=bucket,
+            Key='{}/{}/{}.json'.format(build_history_prefix, repo, name))
+    except s3.exceptions.NoSuchKey:
+        return {}
+    return json.loads(response['Body'].read().decode('utf-8'))
+
+
+def save_build_sample(repo, name, build_id, sample):
+    """
+    Stores the sample of one finished build of the named CodeBuild project
+    in repo until it is merged into the build history
+    """
+    s3.put_object(
+        Bucket=bucket,
+        Key='{}/{}/{}/{}.json'.format(
+            build_history_prefix, repo, name, build_id),
+        Body=json.dumps(sample, sort_keys=True).encode('utf-8'),
+        ServerSideEncryption='aws:kms',
+        SSEKMSKeyId=kms_key
+    )
+
+
+def merge_build_samples(repo, name):
     """
-    # Get pull request info
-    response = requests.get('https://api.github.com/repos/{}/pulls/{}'.format(
-        repo,
-        pr_number
-    ))
-    # Get Diffs
-    diff_url = response.json()['diff_url']
-    response = requests.get(diff_url)
-
-    # Determine all counts of files modified
-    expression = r'( b\/[^\s][^\\]*)+'
-    files_modified = []
-    for obj in re.finditer(expression, '{}'.format(response.content)):
-        if '.tf' in obj.group(1):
-            files_modified.append(obj.group(1)[3:])
-    files_modified = remove_list_duplicates(files_modified)
-
-    # Get DIRs (for terraform fmt)
-    dirs = []
-    test_dirs = []
-    for file in files_modified:
-        dir_only = file.split('/')[:-1]
-        if dir_only == []:
-            dirs.append('.')
-            test_dirs.append('tests')
+    Merges the stored build samples of the named CodeBuild project in repo
+    into its build history. A merge racing another one can overwrite the
+    history with fewer samples, so samples are only deleted once older
+    than build_sample_grace_seconds and the next merge adds them back.
+    """
+    prefix = '{}/{}/{}/'.format(build_history_prefix, repo, name)
+    objects = []
+    for page in s3.get_paginator('list_objects_v2').paginate(
+            Bucket=bucket, Prefix=prefix):
+        objects.extend(page.get('Contents', []))
+    history = load_build_history(repo, name)
+    for obj in objects:
+        try:
+            response = s3.get_object(Bucket=bucket, Key=obj['Key'])
+        except s3.exceptions.NoSuchKey:
             continue
-        dirs.append('/'.join(dir_only))
-        if 'tests' in file:
-            test_dirs.append('/'.join(dir_only))
-        else:
-            test_dirs.append(
-                '{}/tests'.format(
-                    '/'.join(dir_only)
-                ))
-    dirs = remove_list_duplicates(dirs)
-    test_dirs = remove_list_duplicates(test_dirs)
+        sample = json.loads(response['Body'].read().decode('utf-8'))
+        record_build(
+            history,
+            sample['directories'],
+            sample['seconds'],
+            sample['status'],
+            sample['parallelism'],
+            build_id=sample['build'],
+            ended=sample['ended'])
+    save_build_history(repo, name, history)
 
+    now = datetime.datetime.now(datetime.timezone.utc)
+    expired = [
+        {'Key': obj['Key']} for obj in objects
+        if (now - obj['LastModified']).total_seconds() >
+        build_sample_grace_seconds
+    ]
+    for i in range(0, len(expired), 1000):
+        s3.delete_objects(
+            Bucket=bucket, Delete={'Objects': expired[i:i + 1000]})
+
+
+def save_build_history(repo, name, history):
+    """
+    Stores the build history of the named CodeBuild project in repo
+    """
+    s3.put_object(
+        Bucket=bucket,
+        Key='{}/{}/{}.json'.format(build_history_prefix, repo, name),
+        Body=json.dumps(history, sort_keys=True).encode('utf-8'),
+        ServerSideEncryption='aws:kms',
+        SSEKMSKeyId=kms_key
+    )
+
+
+def project_parallelism(project):
+    """
+    Returns the number of directories the project's builds run at once
+    """
+    return int(plan_parallelism) if project['parallel'] else 1
+
+
+def project_settings(project, repo, dirs, test_dirs):
+    """
+    Returns the computeType and timeoutInMinutes of the PR's project
+    """
+    if shared_codebuild_projects:
+        return {
+            'computeType': 'BUILD_GENERAL1_SMALL',
+            'timeoutInMinutes': project['timeout']
+        }
+    directories = {
+        'MODIFIED_DIRS': dirs,
+        'MODIFIED_TEST_DIRS': test_dirs
+    }[project['directories']]
+    return build_settings(
+        load_build_history(repo, project['name']),
+        directories,
+        project['default_seconds'],
+        project_parallelism(project))
+
+
+def pipeline_repository(pipeline):
+    """
+    Returns the repo and PR number of a pipeline from its source object key,
+    or None if the pipeline was deleted or its key is not an archive key
+    """
+    try:
+        stages = codepipeline.get_pipeline(
+            name=pipeline)['pipeline']['stages']
+    except codepipeline.exceptions.PipelineNotFoundException:
+        return None
+    return parse_archive_key(
+        stages[0]['actions'][0]['configuration']['S3ObjectKey'])
+
+
+def pipeline_execution_builds(pipeline, execution_id):
+    """
+    Returns a dict mapping the CodeBuild actions of the pipeline execution
+    to the builds they ran
+    """
+    build_ids = {}
+    kwargs = {
+        'pipelineName': pipeline,
+        'filter': {'pipelineExecutionId': execution_id}
+    }
+    while True:
+        response = codepipeline.list_action_executions(**kwargs)
+        for action in response['actionExecutionDetails']:
+            build_id = action.get('output', {}).get(
+                'executionResult', {}).get('externalExecutionId')
+            if action['input']['actionTypeId']['provider'] == 'CodeBuild' \
+                    and build_id is not None:
+                build_ids[build_id] = action['actionName']
+        if 'nextToken' not in response:
+            break
+        kwargs['nextToken'] = response['nextToken']
+    if build_ids == {}:
+        return {}
     return {
-        'dirs': dirs,
-        'test_dirs': test_dirs
+        build_ids[build['id']]: build
+        for build in codebuild.batch_get_builds(
+            ids=list(build_ids))['builds']
     }
 
 
-def create_pipeline(pr_number):
+def record_build_history(pipeline, execution_id):
     """
-    Creates pipeline and codebuild resources
+    Adds the duration and outcome of the builds of a finished pipeline
+    execution to the history of their directories. Stopped and superseded
+    executions can still have builds in progress, which are left out.
     """
-    modified_dirs = get_modified_directories(pr_number)
-    dirs = modified_dirs['dirs']
-    test_dirs = modified_dirs['test_dirs']
-    if not codebuild_project_exists(pr_number, 'fmt'):
-        logger.info('Creating terraform-fmt codebuild project')
-        with open('buildspec-terraform-fmt.yml', 'r') as buildspecfile:
-            buildspec = buildspecfile.read()
-        codebuild.create_project(
-            name='{}-terraform-pr-fmt-{}'.format(project_name, pr_number),
-            description='Checks if code is formatted',
-            source={
-                'type': 'CODEPIPELINE',
-                'buildspec': buildspec,
-            },
-            artifacts={
-                'type': 'CODEPIPELINE',
-            },
-            environment={
-                'type': 'LINUX_CONTAINER',
-                'image': code_build_image,
-                'computeType': 'BUILD_GENERAL1_SMALL',
-                'environmentVariables': [
-                    {
-                        'name': 'GITHUB_API_URL',
-                        'value': github_api_url,
-                        'type': 'PLAINTEXT'
-                    },
-                    {
-                        'name': 'GITHUB_PAT',
-                        'value': '{}-terraform-pr-pat'.format(project_name),
-                        'type': 'PARAMETER_STORE'
-                    },
-                    {
-                        'name': 'MODIFIED_DIRS',
-                        'value': ' '.join(dirs),
-                        'type': 'PLAINTEXT'
-                    },
-                    {
-                        'name': 'MODIFIED_TEST_DIRS',
-                        'value': ' '.join(test_dirs),
-                        'type': 'PLAINTEXT'
-                    },
-                    {
-                        'name': 'PR_NUMBER',
-                        'value': pr_number,
-                        'type': 'PLAINTEXT'
-                    },
-                    {
-                        'name': 'REPO',
-                        'value': repo.split('/')[1],
-                        'type': 'PLAINTEXT'
-                    },
-                    {
-                        'name': 'REPO_NAME',
-                        'value': repo.replace('/', '-'),
-                        'type': 'PLAINTEXT'
-                    },
-                    {
-                        'name': 'REPO_OWNER',
-                        'value': repo.split('/')[0],
-                        'type': 'PLAINTEXT'
-                    },
-                    {
-                        'name': 'S3_BUCKET',
-                        'value': bucket,
-                        'type': 'PLAINTEXT'
-                    },
-                    {
-                        'name': 'TERRAFORM_DOWNLOAD_URL',
-                        'value': terraform_download_url,
-                        'type': 'PLAINTEXT'
-                    },
-                    {
-                        'name': 'TF_IN_AUTOMATION',
-                        'value': 'True',
-                        'type': 'PLAINTEXT'
-                    },
-                ]
-            },
-            serviceRole=codebuild_service_role,
-            timeoutInMinutes=5,
-            encryptionKey=kms_key,
-        )
-
-    if not codebuild_project_exists(pr_number, 'terrascan'):
-        logger.info('Creating terrascan codebuild project')
-        with open('buildspec-terrascan.yml', 'r') as buildspecfile:
-            buildspec = buildspecfile.read()
-        codebuild.create_project(
-            name='{}-terraform-pr-terrascan-{}'.format(
-                project_name, pr_number),
-            description='Runs terrascan against PR',
-            source={
-                'type': 'CODEPIPELINE',
-                'buildspec': buildspec,
-            },
-            artifacts={
-                'type': 'CODEPIPELINE',
+    parsed = pipeline_repository(pipeline)
+    if parsed is None:
+        logger.info('Not recording builds of pipeline {}'.format(pipeline))
+        return
+    repo, pr_number = parsed
+    builds = pipeline_execution_builds(pipeline, execution_id)
+    for project in codebuild_projects:
+        build = builds.get(project['action'])
+        if build is None or build['buildStatus'] not in recorded_statuses \
+                or build.get('endTime') is None:
+            continue
+        variables = {
+            variable['name']: variable['value']
+            for variable in build['environment']['environmentVariables']
+        }
+        seconds = (build['endTime'] - build['startTime']).total_seconds()
+        save_build_sample(repo, project['name'], build['id'], {
+            'build': build['id'],
+            'directories': variables.get(project['directories'], '').split(),
+            'seconds': seconds,
+            'status': build['buildStatus'],
+            'parallelism': int(variables.get(
+                'PLAN_PARALLELISM', plan_parallelism))
+            if project['parallel'] else 1,
+            'ended': build['endTime'].timestamp()
+        })
+        merge_build_samples(repo, project['name'])
+        logger.info('Recorded {} build of PR {}#{}: {} in {:.0f}s'.format(
+            project['name'], repo, pr_number, build['buildStatus'], seconds))
+
+
+def get_base_sha(repo, pr_number):
+    """
+    Returns the commit the PR is based on
+    """
+    r = github_session.get('{}/repos/{}/pulls/{}'.format(
+        github_api_url, repo, pr_number))
+    if r.status_code != 200:
+        logger.error('GH pull URL status code error: {}'.format(
+            r.status_code))
+        raise Exception('GH pull URL status code != 200')
+    return r.json()['base']['sha']
+
+
+def get_module_graph(repo, base_sha):
+    """
+    Returns the module graph of the repository at base_sha
+    """
+    archive_url = '{}/repos/{}/zipball/{}'.format(
+        github_api_url, repo, base_sha)
+    return load_module_graph(
+        s3, bucket, kms_key, archive_url, base_sha, session=github_session)
+
+
+def get_module_consumers(repo, pr_number):
+    """
+    Returns the reverse module graph of the PR's base commit or None if it
+    can't be built, in which case only the modified directories are tested
+    """
+    try:
+        return reverse_module_graph(
+            get_module_graph(repo, get_base_sha(repo, pr_number)))
+    except Exception as e:
+        logger.error('Unable to load module graph for PR {}#{}: {}'.format(
+            repo, pr_number, e))
+        return None
+
+
+def get_modified_directories(repo, pr_number):
+    """
+    Returns a dict containing paths to the modified directories from the PR
+    and the tests of every directory that uses a modified module
+    """
+    consumers = get_module_consumers(repo, pr_number)
+    pr_url = '{}/repos/{}/pulls/{}'.format(github_api_url, repo, pr_number)
+    logger.info('Loading diff from: {}'.format(pr_url))
+    with github_session.get(
+            pr_url,
+            headers={'Accept': 'application/vnd.github.v3.diff'},
+            stream=True) as r:
+        if r.status_code != 200:
+            logger.error('GH diff URL status code error: {}'.format(
+                r.status_code))
+            raise Exception('GH diff URL status code != 200')
+        return modified_directories(
+            parse_diff(r.iter_lines(chunk_size=diff_chunk_size)),
+            consumers)
+
+
+def deployment_environment_variables():
+    """
+    Returns the build environment variables shared by every PR
+    """
+    return [
+        {
+            'name': 'GITHUB_API_URL',
+            'value': github_api_url,
+            'type': 'PLAINTEXT'
+        },
+        {
+            'name': 'GITHUB_PAT',
+            'value': '{}-terraform-pr-pat'.format(project_name),
+            'type': 'PARAMETER_STORE'
+        },
+        {
+            'name': 'KMS_KEY_ID',
+            'value': kms_key,
+            'type': 'PLAINTEXT'
+        },
+        {
+            'name': 'PLAN_PARALLELISM',
+            'value': plan_parallelism,
+            'type': 'PLAINTEXT'
+        },
+        {
+            'name': 'PR_STATE_TABLE',
+            'value': pr_state_table or '',
+            'type': 'PLAINTEXT'
+        },
+        {
+            'name': 'S3_BUCKET',
+            'value': bucket,
+            'type': 'PLAINTEXT'
+        },
+        {
+            'name': 'TERRAFORM_DOWNLOAD_URL',
+            'value': terraform_download_url,
+            'type': 'PLAINTEXT'
+        },
+        {
+            'name': 'TF_IN_AUTOMATION',
+            'value': 'True',
+            'type': 'PLAINTEXT'
+        },
+        {
+            'name': 'TF_PLUGIN_CACHE_DIR',
+            'value': '{}/plugins'.format(toolchain_cache_dir),
+            'type': 'PLAINTEXT'
+        },
+        {
+            'name': 'TOOLCHAIN_CACHE_DIR',
+            'value': toolchain_cache_dir,
+            'type': 'PLAINTEXT'
+        },
+    ]
+
+
+def pr_environment_variables(repo, pr_number, dirs, test_dirs):
+    """
+    Returns the build environment variables specific to a PR
+    """
+    return [
+        {
+            'name': 'MODIFIED_DIRS',
+            'value': ' '.join(dirs),
+            'type': 'PLAINTEXT'
+        },
+        {
+            'name': 'MODIFIED_TEST_DIRS',
+            'value': ' '.join(test_dirs),
+            'type': 'PLAINTEXT'
+        },
+        {
+            'name': 'PR_NUMBER',
+            'value': pr_number,
+            'type': 'PLAINTEXT'
+        },
+        {
+            'name': 'REPO',
+            'value': repo.split('/')[1],
+            'type': 'PLAINTEXT'
+        },
+        {
+            'name': 'REPO_NAME',
+            'value': repo.replace('/', '-'),
+            'type': 'PLAINTEXT'
+        },
+        {
+            'name': 'REPO_OWNER',
+            'value': repo.split('/')[0],
+            'type': 'PLAINTEXT'
+        },
+        {
+            'name': 'SOURCE_KEY',
+            'value': archive_key(repo, pr_number),
+            'type': 'PLAINTEXT'
+        },
+    ]
+
+
+def desired_codebuild_project(project, repo, pr_number, dirs, test_dirs):
+    """
+    Returns the definition of the CodeBuild project. Shared projects get the
+    PR specific environment variables from the pipeline action instead.
+    PR projects are sized from the build history of their directories.
+    """
+    settings = project_settings(project, repo, dirs, test_dirs)
+    with open(project['buildspec'], 'r') as buildspecfile:
+        buildspec = buildspecfile.read()
+    environment_variables = deployment_environment_variables()
+    if not shared_codebuild_projects:
+        environment_variables.extend(
+            pr_environment_variables(repo, pr_number, dirs, test_dirs))
+    return {
+        'name': codebuild_project_name(project['name'], repo, pr_number),
+        'description': project['description'],
+        'source': {
+            'type': 'CODEPIPELINE',
+            'buildspec': buildspec,
+        },
+        'artifacts': {
+            'type': 'CODEPIPELINE',
+        },
+        'cache': {
+            'type': 'S3',
+            'location': toolchain_cache_location,
+        },
+        'environment': {
+            'type': 'LINUX_CONTAINER',
+            'image': code_build_image,
+            'computeType': settings['computeType'],
+            'environmentVariables': sorted(
+                environment_variables,
+                key=lambda variable: variable['name'])
+        },
+        'serviceRole': codebuild_service_role,
+        'timeoutInMinutes': settings['timeoutInMinutes'],
+        'encryptionKey': kms_key,
+    }
+
+
+def codebuild_action(project, repo, pr_number, dirs, test_dirs):
+    """
+    Returns the pipeline action that runs the CodeBuild project
+    """
+    configuration = {
+        'ProjectName': codebuild_project_name(
+            project['name'], repo, pr_number)
+    }
+    if shared_codebuild_projects:
+        configuration['EnvironmentVariables'] = json.dumps(
+            pr_environment_variables(repo, pr_number, dirs, test_dirs))
+    return {
+        'name': project['action'],
+        'actionTypeId': {
+            'category': project['category'],
+            'owner': 'AWS',
+            'provider': 'CodeBuild',
+            'version': '1'
+        },
+        'configuration': configuration,
+        'inputArtifacts': [
+            {
+                'name': 'source_zip'
             },
-            environment={
-                'type': 'LINUX_CONTAINER',
-                'image': code_build_image,
-                'computeType': 'BUILD_GENERAL1_SMALL',
-                'environmentVariables': [
-                    {
-                        'name': 'GITHUB_API_URL',
-                        'value': github_api_url,
-                        'type': 'PLAINTEXT'
-                    },
-                    {
-                        'name': 'GITHUB_PAT',
-                        'value': '{}-terraform-pr-pat'.format(project_name),
-                        'type': 'PARAMETER_STORE'
-                    },
-                    {
-                        'name': 'MODIFIED_DIRS',
-                        'value': ' '.join(dirs),
-                        'type': 'PLAINTEXT'
-                    },
-                    {
-                        'name': 'MODIFIED_TEST_DIRS',
-                        'value': ' '.join(test_dirs),
-                        'type': 'PLAINTEXT'
-                    },
-                    {
-                        'name': 'PR_NUMBER',
-                        'value': pr_number,
-                        'type': 'PLAINTEXT'
-                    },
-                    {
-                        'name': 'REPO',
-                        'value': repo.split('/')[1],
-                        'type': 'PLAINTEXT'
-                    },
-                    {
-                        'name': 'REPO_NAME',
-                        'value': repo.replace('/', '-'),
-                        'type': 'PLAINTEXT'
-                    },
-                    {
-                        'name': 'REPO_OWNER',
-                        'value': repo.split('/')[0],
-                        'type': 'PLAINTEXT'
-                    },
-                    {
-                        'name': 'S3_BUCKET',
-                        'value': bucket,
-                        'type': 'PLAINTEXT'
-                    },
-                    {
-                        'name': 'TERRAFORM_DOWNLOAD_URL',
-                        'value': terraform_download_url,
-                        'type': 'PLAINTEXT'
-                    },
-                    {
-                        'name': 'TF_IN_AUTOMATION',
-                        'value': 'True',
-                        'type': 'PLAINTEXT'
+        ]
+    }
+
+
+def desired_pipeline(repo, pr_number, dirs, test_dirs):
+    """
+    Returns the definition of the PR's pipeline
+    """
+    return {
+        'name': pipeline_name(repo, pr_number),
+        'roleArn': codepipeline_service_role,
+        'artifactStore': {
+            'type': 'S3',
+            'location': bucket,
+            'encryptionKey': {
+                'id': kms_key,
+                'type': 'KMS'
+            }
+        },
+        'stages': [
+            {
+                'name': 'receive-pr-source',
+                'actions': [
+                    {
+                        'name': 'pr-repo',
+                        'actionTypeId': {
+                            'category': 'Source',
+                            'owner': 'AWS',
+                            'provider': 'S3',
+                            'version': '1'
+                        },
+                        'configuration': {
+                            'S3Bucket': bucket,
+                            # Executions are started by pipeline-create so
+                            # that older ones can be superseded first
+                            'PollForSourceChanges': 'False',
+                            'S3ObjectKey': archive_key(repo, pr_number)
+                        },
+                        'outputArtifacts': [
+                            {
+                                'name': 'source_zip'
+                            },
+                        ]
                     },
                 ]
             },
-            serviceRole=codebuild_service_role,
-            timeoutInMinutes=5,
-            encryptionKey=kms_key,
-        )
-
-    if not codebuild_project_exists(pr_number, 'plan'):
-        logger.info('Creating tfplan codebuild project')
-        with open('buildspec-terraform-plan.yml', 'r') as buildspecfile:
-            buildspec = buildspecfile.read()
-        codebuild.create_project(
-            name='{}-terraform-pr-plan-{}'.format(project_name, pr_number),
-            description='Runs terraform plan against PR',
-            source={
-                'type': 'CODEPIPELINE',
-                'buildspec': buildspec,
-            },
-            artifacts={
-                'type': 'CODEPIPELINE',
-            },
-            environment={
-                'type': 'LINUX_CONTAINER',
-                'image': code_build_image,
-                'computeType': 'BUILD_GENERAL1_SMALL',
-                'environmentVariables': [
-                    {
-                        'name': 'GITHUB_API_URL',
-                        'value': github_api_url,
-                        'type': 'PLAINTEXT'
-                    },
-                    {
-                        'name': 'GITHUB_PAT',
-                        'value': '{}-terraform-pr-pat'.format(project_name),
-                        'type': 'PARAMETER_STORE'
-                    },
-                    {
-                        'name': 'MODIFIED_DIRS',
-                        'value': ' '.join(dirs),
-                        'type': 'PLAINTEXT'
-                    },
-                    {
-                        'name': 'MODIFIED_TEST_DIRS',
-                        'value': ' '.join(test_dirs),
-                        'type': 'PLAINTEXT'
-                    },
-                    {
-                        'name': 'PR_NUMBER',
-                        'value': pr_number,
-                        'type': 'PLAINTEXT'
-                    },
-                    {
-                        'name': 'REPO',
-                        'value': repo.split('/')[1],
-                        'type': 'PLAINTEXT'
-                    },
-                    {
-                        'name': 'REPO_NAME',
-                        'value': repo.replace('/', '-'),
-                        'type': 'PLAINTEXT'
-                    },
-                    {
-                        'name': 'REPO_OWNER',
-                        'value': repo.split('/')[0],
-                        'type': 'PLAINTEXT'
-                    },
-                    {
-                        'name': 'S3_BUCKET',
-                        'value': bucket,
-                        'type': 'PLAINTEXT'
-                    },
-                    {
-                        'name': 'TERRAFORM_DOWNLOAD_URL',
-                        'value': terraform_download_url,
-                        'type': 'PLAINTEXT'
-                    },
-                    {
-                        'name': 'TF_IN_AUTOMATION',
-                        'value': 'True',
-                        'type': 'PLAINTEXT'
-                    },
+            {
+                'name': 'pull-request-tests',
+                'actions': [
+                    codebuild_action(
+                        project, repo, pr_number, dirs, test_dirs)
+                    for project in codebuild_projects
                 ]
-            },
-            serviceRole=codebuild_service_role,
-            timeoutInMinutes=10,
-            encryptionKey=kms_key,
-        )
-
-    logger.info('Creating pipeline')
-    codepipeline.create_pipeline(
-        pipeline={
-            'name': '{}-terraform-pr-pipeline-{}'.format(
-                project_name,
-                pr_number),
-            'roleArn': codepipeline_service_role,
-            'artifactStore': {
-                'type': 'S3',
-                'location': bucket,
-                'encryptionKey': {
-                    'id': kms_key,
-                    'type': 'KMS'
-                }
-            },
-            'stages': [
-                {
-                    'name': 'receive-pr-source',
-                    'actions': [
-                        {
-                            'name': 'pr-repo',
-                            'actionTypeId': {
-                                'category': 'Source',
-                                'owner': 'AWS',
-                                'provider': 'S3',
-                                'version': '1'
-                            },
-                            'configuration': {
-                                'S3Bucket': bucket,
-                                'PollForSourceChanges': 'True',
-                                'S3ObjectKey': '{}/repo.zip'.format(
-                                    pr_number)
-                            },
-                            'outputArtifacts': [
-                                {
-                                    'name': 'source_zip'
-                                },
-                            ]
-                        },
-                    ]
-                },
-                {
-                    'name': 'pull-request-tests',
-                    'actions': [
-                        {
-                            'name': 'terraform-fmt',
-                            'actionTypeId': {
-                                'category': 'Test',
-                                'owner': 'AWS',
-                                'provider': 'CodeBuild',
-                                'version': '1'
-                            },
-                            'configuration': {
-                                'ProjectName': '{}-terraform-pr-fmt-{}'.format(
-                                    project_name, pr_number)
-                            },
-                            'inputArtifacts': [
-                                {
-                                    'name': 'source_zip'
-                                },
-                            ]
-                        },
-                        {
-                            'name': 'terrascan',
-                            'actionTypeId': {
-                                'category': 'Test',
-                                'owner': 'AWS',
-                                'provider': 'CodeBuild',
-                                'version': '1'
-                            },
-                            'configuration': {
-                                'ProjectName':
-                                    '{}-terraform-pr-terrascan-{}'.format(
-                                        project_name, pr_number)
-                            },
-                            'inputArtifacts': [
-                                {
-                                    'name': 'source_zip'
-                                },
-                            ]
-                        },
-                        {
-                            'name': 'terraform-plan',
-                            'actionTypeId': {
-                                'category': 'Build',
-                                'owner': 'AWS',
-                                'provider': 'CodeBuild',
-                                'version': '1'
-                            },
-                            'configuration': {
-                                'ProjectName':
-                                    '{}-terraform-pr-plan-{}'.format(
-                                        project_name, pr_number)
-                            },
-                            'inputArtifacts': [
-                                {
-                                    'name': 'source_zip'
-                                },
-                            ]
-                        }
-                    ]
-                }
-            ]
+            }
+        ]
+    }
+
+
+def reconcile_pipeline(repo, pr_number):
+    """
+    Creates or updates the pipeline and codebuild resources of the PR so
+    they match its latest commit, then queues the pipeline after stopping
+    the executions of older commits. Nothing is called when the commit was
+    already reconciled, and only resources whose definition changed since
+    the last run are updated. Unchanged resources are checked for in one
+    call each and recreated if they were deleted out of band. Shared
+    CodeBuild projects are fingerprinted once for every PR.
+    """
+    state_key = pipeline_state_key(repo, pr_number)
+    state = load_pipeline_state(state_key)
+    sha = get_head_sha(repo, pr_number)
+    if sha is not None and state['sha'] == sha:
+        logger.info('Pipeline for PR {}#{} is up to date with {}'.format(
+            repo, pr_number, sha))
+        return
+
+    modified_dirs = get_modified_directories(repo, pr_number)
+    dirs = modified_dirs['dirs']
+    test_dirs = modified_dirs['test_dirs']
+    projects = [
+        desired_codebuild_project(project, repo, pr_number, dirs, test_dirs)
+        for project in codebuild_projects
+    ]
+    pipeline = desired_pipeline(repo, pr_number, dirs, test_dirs)
+    # Shared projects are the same for every PR, so their fingerprints are
+    # kept once instead of in the state of each PR
+    if shared_codebuild_projects:
+        project_state = load_pipeline_state(shared_state_key)['fingerprints']
+    else:
+        project_state = state['fingerprints']
+    fingerprints = {
+        definition['name']: fingerprint(definition)
+        for definition in projects + [pipeline]
+    }
+    changed = [
+        definition['name'] for definition in projects
+        if project_state.get(definition['name']) !=
+        fingerprints[definition['name']]
+    ]
+    if state['fingerprints'].get(pipeline['name']) != \
+            fingerprints[pipeline['name']]:
+        changed.append(pipeline['name'])
+
+    unchanged_projects = [
+        definition['name'] for definition in projects
+        if definition['name'] not in changed
+    ]
+    if unchanged_projects != []:
+        existing = existing_codebuild_projects(unchanged_projects)
+        for name in unchanged_projects:
+            if name not in existing:
+                logger.info('Codebuild project {} was deleted'.format(name))
+                changed.append(name)
+    if pipeline['name'] not in changed and \
+            not pipeline_exists(repo, pr_number):
+        logger.info('Pipeline {} was deleted'.format(pipeline['name']))
+        changed.append(pipeline['name'])
+
+    for definition in projects:
+        if definition['name'] in changed:
+            put_codebuild_project(
+                definition, definition['name'] in project_state)
+    if shared_codebuild_projects and \
+            any(definition['name'] in changed for definition in projects):
+        save_pipeline_state(shared_state_key, {
+            'sha': None,
+            'fingerprints': dict(project_state, **{
+                definition['name']: fingerprints[definition['name']]
+                for definition in projects
+            })
+        })
+
+    if pipeline['name'] in changed:
+        put_pipeline(pipeline, pipeline['name'] in state['fingerprints'])
+
+    # Stops the executions of older commits, including the one started by
+    # create_pipeline, and waits for the scheduler to run the latest one
+    scheduler.enqueue(
+        pr_key(repo, pr_number), pipeline['name'], sha, len(test_dirs))
+    record_pipeline(repo, pr_number, pipeline['name'], sha)
+
+    if changed == []:
+        logger.info('Pipeline for PR {}#{} already matches {}'.format(
+            repo, pr_number, sha))
+    save_pipeline_state(state_key, {
+        'sha': sha,
+        'fingerprints': {
+            name: value for name, value in fingerprints.items()
+            if not shared_codebuild_projects or name == pipeline['name']
         }
-    )
+    })
 
 
+@instrumented_handler(api_metrics, 'pipeline-create')
 def lambda_handler(event, context):
     """
-    Creates pipeline when a new repo is uploaded to s3
+    Creates or updates the pipeline when a new repo is uploaded to s3, then
+    starts queued pipelines. Pipeline state changes record the build history
+    of the finished execution and the drain schedule only starts queued
+    pipelines.
     """
-    pr_number = event['Records'][0]['s3']['object']['key'].split('/')[0]
-    logger.info('Changes detected on PR #{}'.format(pr_number))
+    github_limiter.set_deadline(context)
+    if 'Records' in event:
+        key = event['Records'][0]['s3']['object']['key']
+        parsed = parse_archive_key(key)
+        if parsed is None:
+            logger.info('Ignoring object: {}'.format(key))
+        else:
+            repo, pr_number = parsed
+            logger.info('Changes detected on PR {}#{}'.format(
+                repo, pr_number))
+            reconcile_pipeline(repo, pr_number)
+    elif event.get('source') == 'aws.codepipeline':
+        # The drain below is what frees the capacity of the finished
+        # execution, so it runs even if the history can't be recorded
+        try:
+            record_build_history(
+                event['detail']['pipeline'], event['detail']['execution-id'])
+        except Exception as e:
+            logger.error('Unable to record builds of pipeline {}: {}'.format(
+                event['detail']['pipeline'], e))
 
-    if not pipeline_exists(pr_number):
-        create_pipeline(pr_number)
+    if context is None:
+        metrics = scheduler.drain()
+    else:
+        metrics = scheduler.drain(
+            context.get_remaining_time_in_millis() / 1000.0)
+    logger.info('Admission metrics: {}'.format(json.dumps(metrics)))
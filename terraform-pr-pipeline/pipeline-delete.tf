@@ -18,8 +18,10 @@ resource "aws_lambda_function" "pipeline_delete" {
 
   environment {
     variables = {
-      BUCKET_NAME  = "${aws_s3_bucket.bucket.id}"
-      PROJECT_NAME = "${var.project_name}"
+      BUCKET_NAME               = "${aws_s3_bucket.bucket.id}"
+      PROJECT_NAME              = "${var.project_name}"
+      SHARED_CODEBUILD_PROJECTS = "${var.shared_codebuild_projects}"
+      PR_STATE_TABLE            = "${aws_dynamodb_table.pr_state.name}"
     }
   }
 }
@@ -37,6 +39,10 @@ resource "aws_lambda_permission" "pipeline_delete" {
 resource "null_resource" "pipeline_delete_dependencies" {
   triggers {
     lambda_function = "${file("${path.module}/pipeline-delete/pipeline-delete.py")}"
+    repositories    = "${file("${path.module}/common/repositories.py")}"
+    instrumentation = "${file("${path.module}/common/instrumentation.py")}"
+    runtime         = "${file("${path.module}/common/runtime.py")}"
+    pr_state        = "${file("${path.module}/common/pr_state.py")}"
   }
 
   provisioner "local-exec" {
@@ -48,11 +54,23 @@ resource "null_resource" "pipeline_delete_dependencies" {
   }
 
   provisioner "local-exec" {
-    command = "pip install --target=${path.module}/.lambda-zip/pipeline-delete-resources requests"
+    command = "cp -R ${path.module}/pipeline-delete/pipeline-delete.py ${path.module}/.lambda-zip/pipeline-delete-resources/."
   }
 
   provisioner "local-exec" {
-    command = "cp -R ${path.module}/pipeline-delete/pipeline-delete.py ${path.module}/.lambda-zip/pipeline-delete-resources/."
+    command = "cp -R ${path.module}/common/repositories.py ${path.module}/.lambda-zip/pipeline-delete-resources/."
+  }
+
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/instrumentation.py ${path.module}/.lambda-zip/pipeline-delete-resources/."
+  }
+
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/runtime.py ${path.module}/.lambda-zip/pipeline-delete-resources/."
+  }
+
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/pr_state.py ${path.module}/.lambda-zip/pipeline-delete-resources/."
   }
 
   provisioner "local-exec" {
@@ -116,6 +134,32 @@ data "aws_iam_policy_document" "pipeline_delete" {
       "${aws_s3_bucket.bucket.arn}*",
     ]
   }
+
+  statement {
+    sid = "s3state"
+
+    actions = [
+      "s3:DeleteObject",
+    ]
+
+    resources = [
+      "${aws_s3_bucket.bucket.arn}/terraform-pr-cache/pipelines/*",
+      "${aws_s3_bucket.bucket.arn}/terraform-pr-cache/admission/*",
+    ]
+  }
+
+  statement {
+    sid = "dynamodb"
+
+    actions = [
+      "dynamodb:GetItem",
+      "dynamodb:DeleteItem",
+    ]
+
+    resources = [
+      "${aws_dynamodb_table.pr_state.arn}",
+    ]
+  }
 }
 
 resource "aws_iam_policy" "pipeline_delete" {
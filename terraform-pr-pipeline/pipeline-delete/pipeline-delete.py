@@ -1,24 +1,33 @@
 import os
-import logging
-import boto3
+from instrumentation import Metrics, instrumented_handler
+from runtime import configure_logging, client, env_bool
+from repositories import pr_key, parse_archive_key, repo_slug
+from pr_state import DynamoDBPRState, MemoryPRState
 
 # Configuring logger
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-logger.handlers[0].setFormatter(logging.Formatter(
-    '%(asctime)s - %(name)s - %(levelname)s - %(message)s\n'
-))
-logging.getLogger('boto3').setLevel(logging.ERROR)
-logging.getLogger('botocore').setLevel(logging.ERROR)
-
-# Boto clients
-codepipeline = boto3.client('codepipeline')
-codebuild = boto3.client('codebuild')
-s3 = boto3.client('s3')
+logger = configure_logging()
+
+# API calls, latencies and bytes of the current invocation
+api_metrics = Metrics()
+
+# Boto clients, created on first use and kept across warm invocations
+codepipeline = client('codepipeline', api_metrics)
+codebuild = client('codebuild', api_metrics)
+s3 = client('s3', api_metrics)
+dynamodb = client('dynamodb', api_metrics)
 
 # Global vars
 bucket = os.environ['BUCKET_NAME']
 project_name = os.environ['PROJECT_NAME']
+shared_codebuild_projects = env_bool('SHARED_CODEBUILD_PROJECTS')
+pr_state_table = os.environ.get('PR_STATE_TABLE')
+
+# Records of every PR, shared with poller-create and pipeline-create.
+# Without a state table it only covers this process.
+if pr_state_table:
+    pr_state = DynamoDBPRState(dynamodb, pr_state_table)
+else:
+    pr_state = MemoryPRState()
 
 
 def object_exists(key):
@@ -32,6 +41,36 @@ def object_exists(key):
     return True
 
 
+def delete_pipeline_state(repo, pr_number):
+    """
+    Deletes the cached state pipeline-create keeps for the PR's pipeline
+    """
+    s3.delete_object(
+        Bucket=bucket,
+        Key='terraform-pr-cache/pipelines/{}.json'.format(
+            pr_key(repo, pr_number)))
+
+
+def delete_pr_record(record):
+    """
+    Deletes the PR record unless the PR was synced again in the meantime
+    """
+    if not pr_state.delete(record['pr_key'], record['version']):
+        logger.info('Keeping record of PR {}, it changed since read'.format(
+            record['pr_key']))
+
+
+def delete_admission_entries(repo, pr_number):
+    """
+    Removes the PR from the queue and running set of the admission scheduler
+    """
+    for state in ['queued', 'running']:
+        s3.delete_object(
+            Bucket=bucket,
+            Key='terraform-pr-cache/admission/{}/{}.json'.format(
+                state, pr_key(repo, pr_number)))
+
+
 def delete_pipeline(pipeline_name):
     """
     Deletes the specified AWS CodePipeline pipeline
@@ -49,24 +88,38 @@ def delete_codebuild_project(project_name):
     codebuild.delete_project(name=project_name)
 
 
+@instrumented_handler(api_metrics, 'pipeline-delete')
 def lambda_handler(event, context):
     """
     Deletes pipeline resources associated to S3 object that no longer exists
     """
     repo_object = event['Records'][0]['s3']['object']['key']
 
-    if 'repo.zip' in repo_object and not object_exists(repo_object):
-        logger.info('Object no longer exists at: {}'.format(repo_object))
-        pr_number = repo_object.split('/')[0]
-
-        delete_pipeline('{}-terraform-pr-pipeline-{}'.format(
-            project_name, pr_number))
-
-        delete_codebuild_project('{}-terraform-pr-fmt-{}'.format(
-            project_name, pr_number))
+    parsed = parse_archive_key(repo_object)
 
-        delete_codebuild_project('{}-terraform-pr-terrascan-{}'.format(
-            project_name, pr_number))
-
-        delete_codebuild_project('{}-terraform-pr-plan-{}'.format(
-            project_name, pr_number))
+    if parsed is not None and not object_exists(repo_object):
+        logger.info('Object no longer exists at: {}'.format(repo_object))
+        repo, pr_number = parsed
+        slug = repo_slug(repo)
+        record = pr_state.get(pr_key(repo, pr_number)) or {}
+
+        delete_pipeline(record.get('pipeline_name') or
+                        '{}-terraform-pr-pipeline-{}-{}'.format(
+                            project_name, slug, pr_number))
+        delete_pipeline_state(repo, pr_number)
+        delete_admission_entries(repo, pr_number)
+        if record:
+            delete_pr_record(record)
+
+        # Shared projects outlive the PRs that use them
+        if shared_codebuild_projects:
+            return
+
+        delete_codebuild_project('{}-terraform-pr-fmt-{}-{}'.format(
+            project_name, slug, pr_number))
+
+        delete_codebuild_project('{}-terraform-pr-terrascan-{}-{}'.format(
+            project_name, slug, pr_number))
+
+        delete_codebuild_project('{}-terraform-pr-plan-{}-{}'.format(
+            project_name, slug, pr_number))
@@ -11,6 +11,7 @@ resource "aws_lambda_function" "poller_create" {
   source_code_hash = "${base64sha256(file("${path.module}/.lambda-zip/poller-create.zip"))}"
   runtime          = "python3.6"
   kms_key_arn      = "${aws_kms_key.pipeline_key.arn}"
+  timeout          = 120
 
   tags {
     Name = "${var.project_name}-poller-create"
@@ -18,14 +19,84 @@ resource "aws_lambda_function" "poller_create" {
 
   environment {
     variables = {
-      BUCKET_NAME      = "${aws_s3_bucket.bucket.id}"
-      GITHUB_API_URL   = "${var.github_api_url}"
-      GITHUB_REPO_NAME = "${var.github_repo_name}"
-      KMS_KEY_ID       = "${aws_kms_key.pipeline_key.key_id}"
+      BUCKET_NAME               = "${aws_s3_bucket.bucket.id}"
+      GITHUB_API_URL            = "${var.github_api_url}"
+      GITHUB_PAT_PARAMETER      = "${var.project_name}-terraform-pr-pat"
+      GITHUB_REPO_NAMES         = "${local.github_repo_names}"
+      GITHUB_REQUESTS_PER_REPO  = "${var.github_requests_per_repo}"
+      KMS_KEY_ID                = "${aws_kms_key.pipeline_key.key_id}"
+      MAX_POLL_INTERVAL_MINUTES = "${var.poller_create_max_interval}"
+      POLL_INTERVAL_MINUTES     = "${var.poller_create_rate}"
+      PR_STATE_TABLE            = "${aws_dynamodb_table.pr_state.name}"
+      SPARSE_ARCHIVES           = "${var.sparse_archives}"
+      SYNC_BATCH_SIZE           = "${var.poller_create_batch_size}"
+      SYNC_CONCURRENCY          = "${var.poller_create_concurrency}"
+      SYNC_QUEUE_URL            = "${aws_sqs_queue.poller_create_sync.id}"
     }
   }
 }
 
+// Syncs the batches of out of date PRs sent by poller-create
+resource "aws_lambda_function" "poller_create_worker" {
+  depends_on                     = ["null_resource.poller_create_dependencies"]
+  filename                       = ".lambda-zip/poller-create.zip"
+  function_name                  = "${var.project_name}-poller-create-worker"
+  role                           = "${aws_iam_role.poller_create.arn}"
+  handler                        = "poller-create.worker_handler"
+  source_code_hash               = "${base64sha256(file("${path.module}/.lambda-zip/poller-create.zip"))}"
+  runtime                        = "python3.6"
+  kms_key_arn                    = "${aws_kms_key.pipeline_key.arn}"
+  timeout                        = 300
+  reserved_concurrent_executions = "${var.poller_create_workers}"
+
+  tags {
+    Name = "${var.project_name}-poller-create-worker"
+  }
+
+  environment {
+    variables = {
+      BUCKET_NAME          = "${aws_s3_bucket.bucket.id}"
+      GITHUB_API_URL       = "${var.github_api_url}"
+      GITHUB_PAT_PARAMETER = "${var.project_name}-terraform-pr-pat"
+      GITHUB_REPO_NAMES    = "${local.github_repo_names}"
+      KMS_KEY_ID           = "${aws_kms_key.pipeline_key.key_id}"
+      LEASE_SECONDS        = "300"
+      PR_STATE_TABLE       = "${aws_dynamodb_table.pr_state.name}"
+      SPARSE_ARCHIVES      = "${var.sparse_archives}"
+      SYNC_CONCURRENCY     = "${var.poller_create_concurrency}"
+    }
+  }
+}
+
+// Hands one batch of PRs to each worker invocation
+resource "aws_lambda_event_source_mapping" "poller_create_worker" {
+  event_source_arn = "${aws_sqs_queue.poller_create_sync.arn}"
+  function_name    = "${aws_lambda_function.poller_create_worker.arn}"
+  batch_size       = 1
+}
+
+// Batches of out of date PRs waiting for a worker. Batches that keep
+// failing end up in the dead letter queue.
+resource "aws_sqs_queue" "poller_create_sync" {
+  name                       = "${var.project_name}-poller-create-sync"
+  visibility_timeout_seconds = 360
+  kms_master_key_id          = "${aws_kms_key.pipeline_key.arn}"
+  redrive_policy             = "{\"deadLetterTargetArn\":\"${aws_sqs_queue.poller_create_sync_dead_letter.arn}\",\"maxReceiveCount\":3}"
+
+  tags {
+    Name = "${var.project_name}-poller-create-sync"
+  }
+}
+
+resource "aws_sqs_queue" "poller_create_sync_dead_letter" {
+  name              = "${var.project_name}-poller-create-sync-dead-letter"
+  kms_master_key_id = "${aws_kms_key.pipeline_key.arn}"
+
+  tags {
+    Name = "${var.project_name}-poller-create-sync-dead-letter"
+  }
+}
+
 // Allows cloudwatch to trigger the function
 resource "aws_lambda_permission" "poller_create" {
   statement_id  = "schedule"
@@ -39,6 +110,18 @@ resource "aws_lambda_permission" "poller_create" {
 resource "null_resource" "poller_create_dependencies" {
   triggers {
     lambda_function = "${file("${path.module}/poller-create/poller-create.py")}"
+    github_client   = "${file("${path.module}/common/github_client.py")}"
+    changed_files   = "${file("${path.module}/common/changed_files.py")}"
+    module_graph    = "${file("${path.module}/common/module_graph.py")}"
+    sparse_archive  = "${file("${path.module}/common/sparse_archive.py")}"
+    fanout          = "${file("${path.module}/common/fanout.py")}"
+    async_github    = "${file("${path.module}/common/async_github.py")}"
+    repositories    = "${file("${path.module}/common/repositories.py")}"
+    instrumentation = "${file("${path.module}/common/instrumentation.py")}"
+    runtime         = "${file("${path.module}/common/runtime.py")}"
+    rate_limit      = "${file("${path.module}/common/rate_limit.py")}"
+    pr_state        = "${file("${path.module}/common/pr_state.py")}"
+    requirements    = "${file("${path.module}/poller-create/requirements.txt")}"
   }
 
   provisioner "local-exec" {
@@ -50,13 +133,57 @@ resource "null_resource" "poller_create_dependencies" {
   }
 
   provisioner "local-exec" {
-    command = "pip install --target=${path.module}/.lambda-zip/poller-create-resources requests"
+    command = "pip install --target=${path.module}/.lambda-zip/poller-create-resources -r ${path.module}/poller-create/requirements.txt"
   }
 
   provisioner "local-exec" {
     command = "cp -R ${path.module}/poller-create/poller-create.py ${path.module}/.lambda-zip/poller-create-resources/."
   }
 
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/github_client.py ${path.module}/.lambda-zip/poller-create-resources/."
+  }
+
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/changed_files.py ${path.module}/.lambda-zip/poller-create-resources/."
+  }
+
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/module_graph.py ${path.module}/.lambda-zip/poller-create-resources/."
+  }
+
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/sparse_archive.py ${path.module}/.lambda-zip/poller-create-resources/."
+  }
+
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/fanout.py ${path.module}/.lambda-zip/poller-create-resources/."
+  }
+
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/async_github.py ${path.module}/.lambda-zip/poller-create-resources/."
+  }
+
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/repositories.py ${path.module}/.lambda-zip/poller-create-resources/."
+  }
+
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/instrumentation.py ${path.module}/.lambda-zip/poller-create-resources/."
+  }
+
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/runtime.py ${path.module}/.lambda-zip/poller-create-resources/."
+  }
+
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/rate_limit.py ${path.module}/.lambda-zip/poller-create-resources/."
+  }
+
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/pr_state.py ${path.module}/.lambda-zip/poller-create-resources/."
+  }
+
   provisioner "local-exec" {
     command = "cd ${path.module}/.lambda-zip/poller-create-resources/ && zip -r ../poller-create.zip ."
   }
@@ -92,6 +219,36 @@ data "aws_iam_policy_document" "poller_create" {
 
     resources = [
       "arn:aws:logs:*:*:log-group:/aws/lambda/${var.project_name}-poller-create:*",
+      "arn:aws:logs:*:*:log-group:/aws/lambda/${var.project_name}-poller-create-worker:*",
+    ]
+  }
+
+  statement {
+    sid = "sqs"
+
+    actions = [
+      "sqs:SendMessage",
+      "sqs:ReceiveMessage",
+      "sqs:DeleteMessage",
+      "sqs:GetQueueAttributes",
+    ]
+
+    resources = [
+      "${aws_sqs_queue.poller_create_sync.arn}",
+    ]
+  }
+
+  statement {
+    sid = "dynamodbstate"
+
+    actions = [
+      "dynamodb:GetItem",
+      "dynamodb:BatchGetItem",
+      "dynamodb:PutItem",
+    ]
+
+    resources = [
+      "${aws_dynamodb_table.pr_state.arn}",
     ]
   }
 
@@ -100,15 +257,27 @@ data "aws_iam_policy_document" "poller_create" {
 
     actions = [
       "s3:List*",
-      "s3:GetObjectTagging",
+      "s3:GetObject",
       "s3:PutObject",
-      "s3:PutObjectTagging",
+      "s3:AbortMultipartUpload",
     ]
 
     resources = [
       "${aws_s3_bucket.bucket.arn}*",
     ]
   }
+
+  statement {
+    sid = "SSMAccess"
+
+    actions = [
+      "ssm:GetParameter",
+    ]
+
+    resources = [
+      "arn:aws:ssm:${var.aws_region}:${data.aws_caller_identity.current.account_id}:parameter/${var.project_name}-terraform-pr-pat",
+    ]
+  }
 }
 
 resource "aws_iam_policy" "poller_create" {
@@ -1,155 +1,672 @@
 import os
-import logging
+import hmac
+import json
+import base64
+import hashlib
+import time
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 import requests
-import boto3
+from github_client import GitHubClient, cache_from_environment
+from instrumentation import (
+    Metrics, instrument_session, instrumented_handler)
+from runtime import configure_logging, client, env_bool, env_int, parameter
+from rate_limit import GitHubRateLimiter, poll_interval
+from async_github import AsyncGitHubClient
+from repositories import repository_names, pr_key, archive_key
+from module_graph import load_module_graph, reverse_module_graph
+from sparse_archive import build_sparse_archive, max_blobs
+from fanout import batches, SQSQueue, LocalQueue
+from pr_state import DynamoDBPRState, MemoryPRState, update
 
 # Configuring logger
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-logger.handlers[0].setFormatter(logging.Formatter(
-    '%(asctime)s - %(name)s - %(levelname)s - %(message)s\n'
-))
-logging.getLogger('boto3').setLevel(logging.ERROR)
-logging.getLogger('botocore').setLevel(logging.ERROR)
+logger = configure_logging()
+
+# API calls, latencies and bytes of the current invocation
+api_metrics = Metrics()
 
-# Boto clients
-s3 = boto3.client('s3')
+# Boto clients, created on first use and kept across warm invocations
+s3 = client('s3', api_metrics)
+ssm = client('ssm', api_metrics)
+sqs = client('sqs', api_metrics)
+dynamodb = client('dynamodb', api_metrics)
 
 # Global vars
 github_api_url = os.environ['GITHUB_API_URL']
-repo = os.environ['GITHUB_REPO_NAME']
+repos = repository_names(os.environ['GITHUB_REPO_NAMES'])
 bucket = os.environ['BUCKET_NAME']
 kms_key_id = os.environ['KMS_KEY_ID']
+sync_concurrency = env_int('SYNC_CONCURRENCY', 4)
+github_requests_per_repo = env_int('GITHUB_REQUESTS_PER_REPO', 50)
+sparse_archives = env_bool('SPARSE_ARCHIVES')
+sync_batch_size = env_int('SYNC_BATCH_SIZE', 10)
+sync_queue_url = os.environ.get('SYNC_QUEUE_URL')
+lease_seconds = env_int('LEASE_SECONDS', 300)
+pr_state_table = os.environ.get('PR_STATE_TABLE')
+webhook_secret_parameter = os.environ.get('WEBHOOK_SECRET_PARAMETER')
+github_pat_parameter = os.environ.get('GITHUB_PAT_PARAMETER')
+poll_interval_minutes = env_int('POLL_INTERVAL_MINUTES', 0)
+max_poll_interval_minutes = env_int('MAX_POLL_INTERVAL_MINUTES', 60)
+
+# Interval and time of the last poll. The schedule fires every
+# poll_interval_minutes and polls are skipped until the adaptive interval
+# has passed, less some slack for schedules firing early.
+poll_state_key = 'terraform-pr-cache/poller/state.json'
+poll_slack_seconds = 60
+
+# Share of the spare GitHub rate limit the blobs of one sparse archive may
+# use, so a large PR can't starve the other PRs and repos
+sparse_blob_share = 0.05
+
+# pull_request webhook actions that can change the PR head
+webhook_sync_actions = ['opened', 'reopened', 'synchronize']
+
+
+def github_token():
+    """
+    Returns the GitHub PAT stored in the SSM parameter store
+    """
+    return parameter(ssm, github_pat_parameter)
+
+
+# Keep-alive session shared by all GitHub calls and sync workers, paced to
+# the GitHub rate limit left
+github_limiter = GitHubRateLimiter()
+github_session = github_limiter.wrap(
+    instrument_session(requests.Session(), api_metrics),
+    token=github_token if github_pat_parameter else None)
+github_session.mount('https://', requests.adapters.HTTPAdapter(
+    pool_connections=sync_concurrency,
+    pool_maxsize=sync_concurrency
+))
+github = GitHubClient(
+    github_api_url,
+    cache_from_environment(s3, bucket, kms_key_id),
+    session=github_session
+)
+
+# Lists the open PRs of every repository at once, each within its own
+# request budget
+async_github = AsyncGitHubClient(
+    github,
+    budget=github_requests_per_repo,
+    max_workers=sync_concurrency
+)
+
+# Head commit and sync status of every PR, written only through compare-and-
+# set. A syncing claim keeps overlapping polls and workers from syncing the
+# same commit twice, and one older than lease_seconds is taken to have
+# crashed. Without a state table it only covers this process.
+if pr_state_table:
+    pr_state = DynamoDBPRState(dynamodb, pr_state_table)
+else:
+    pr_state = MemoryPRState()
+
+# Multipart uploads require parts of at least 5MB except for the last one
+archive_part_size = 8 * 1024 * 1024
+archive_chunk_size = 1024 * 1024
 
 
-def get_open_pull_requests():
+def get_open_pull_requests(repo):
     """
     Returns JSON of open PRs on given repo
     """
-    pulls_url = '{}/repos/{}/pulls'.format(
-        github_api_url,
-        repo)
-    logger.info('Loading open pull requests from: {}'.format(pulls_url))
-    r = requests.get(pulls_url)
+    pulls_path = 'repos/{}/pulls?state=open&per_page=100'.format(repo)
+    logger.info('Loading open pull requests from: {}'.format(
+        github.url(pulls_path)))
+    return github.get_paginated(pulls_path)
 
-    if r.status_code != 200:
-        logger.error('GH pull URL status code error: {}'.format(
-            r.status_code))
-        raise Exception('GH pull URL status code != 200')
 
-    return r.json()
+def get_all_open_pull_requests():
+    """
+    Returns a list of (repo, PR JSON) pairs of the open PRs of every tracked
+    repo, listed concurrently. Repos whose listing fails are left out until
+    the next run.
+    """
+    results = async_github.run({
+        repo: async_github.get_paginated(
+            repo, 'repos/{}/pulls?state=open&per_page=100'.format(repo))
+        for repo in repos
+    })
+    open_prs = []
+    for repo in repos:
+        if isinstance(results[repo], Exception):
+            logger.error('Unable to list open PRs of {}: {}'.format(
+                repo, results[repo]))
+            continue
+        logger.info('{} has {} open PRs'.format(repo, len(results[repo])))
+        open_prs.extend((repo, pr) for pr in results[repo])
+    return open_prs
 
 
-def object_exists(key):
+def is_pr_synced(record, sha, now):
     """
-    Determines if objet exists in S3 bucket
+    Returns True if the PR record holds sha and its archive was uploaded or
+    is being uploaded under a claim that isn't stale yet
     """
-    try:
-        s3.get_object(Bucket=bucket, Key=key)
-    except s3.exceptions.NoSuchKey:
+    if record is None or record.get('head_sha') != sha:
         return False
-    return True
+    if record['status'] == 'syncing':
+        return now - record.get('claimed_at', 0) < lease_seconds
+    return record['status'] != 'failed'
+
+
+def upload_archive(archive_url, s3_object_key):
+    """
+    Streams the archive at archive_url into S3. Returns its size in bytes.
+    """
+    with github_session.get(archive_url, stream=True) as r:
+        if r.status_code != 200:
+            raise Exception('GH archive URL status code {}'.format(
+                r.status_code))
+        return upload_chunks(
+            r.iter_content(chunk_size=archive_chunk_size),
+            s3_object_key)
 
 
-def is_pr_synced(pr_number, sha):
+def upload_chunks(chunks, s3_object_key):
     """
-    Checks if there's a corresponding S3 object for the given pr_number and sha
-    Assumes that zip files are at pr_number/repo.zip and that they are
-    tagged with "Key":"latest_commit","Value":sha
+    Uploads chunks into a KMS encrypted S3 multipart upload. At most one
+    part is held in memory. The upload is
+    aborted if reading the chunks or any part upload fails. Returns the
+    size of the object in bytes.
     """
-    response = s3.list_objects_v2(Bucket=bucket)
-    repo_zip = '{}/repo.zip'.format(pr_number)
+    upload_id = s3.create_multipart_upload(
+        Bucket=bucket,
+        Key=s3_object_key,
+        ServerSideEncryption='aws:kms',
+        SSEKMSKeyId=kms_key_id
+    )['UploadId']
+    parts = []
+    size = 0
     try:
-        for obj in response['Contents']:
-            if repo_zip == obj['Key']:
-                tags = s3.get_object_tagging(
-                    Bucket=bucket, Key=obj['Key'])['TagSet']
-                for tag in tags:
-                    if tag['Key'] == 'latest_commit' and tag['Value'] == sha:
-                        logger.debug(
-                            'is_pr_synced({},{}) returned True'.format(
-                                pr_number,
-                                sha
-                            ))
-                        return True
-    except Exception as e:
-        logger.error(
-            'is_pr_synced({},{}) Exception: {}'.format(
-                pr_number,
-                sha,
-                e
-            ))
-        return False
-    logger.debug(
-        'is_pr_synced({},{}) returning False'.format(
-            pr_number,
-            sha
+        buffer = bytearray()
+        for chunk in chunks:
+            buffer.extend(chunk)
+            size += len(chunk)
+            if len(buffer) >= archive_part_size:
+                parts.append(upload_part(
+                    s3_object_key, upload_id, len(parts) + 1, buffer))
+                buffer = bytearray()
+        if buffer or parts == []:
+            parts.append(upload_part(
+                s3_object_key, upload_id, len(parts) + 1, buffer))
+        s3.complete_multipart_upload(
+            Bucket=bucket,
+            Key=s3_object_key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': parts}
+        )
+    except Exception:
+        logger.error('Aborting upload to {}'.format(s3_object_key))
+        s3.abort_multipart_upload(
+            Bucket=bucket,
+            Key=s3_object_key,
+            UploadId=upload_id
+        )
+        raise
+    logger.debug('Uploaded {} in {} parts to s3'.format(
+        s3_object_key, len(parts)))
+    return size
+
+
+def sparse_blob_limit():
+    """
+    Returns the most blobs a sparse archive may fetch with the GitHub rate
+    limit left
+    """
+    spare = github_limiter.spare_requests()
+    if spare is None:
+        return max_blobs
+    return min(max_blobs, int(spare * sparse_blob_share))
+
+
+def upload_sparse_archive(repo, pr, s3_object_key):
+    """
+    Uploads an archive of the PR head holding only the directories its
+    builds use. Returns a summary of the archive or None if the full
+    zipball has to be uploaded instead.
+    """
+    base_archive_url = '{}/repos/{}/zipball/{}'.format(
+        github_api_url, repo, pr['base']['sha'])
+    consumers = reverse_module_graph(load_module_graph(
+        s3, bucket, kms_key_id, base_archive_url, pr['base']['sha'],
+        session=github_session))
+    with tempfile.TemporaryFile() as archive:
+        summary = build_sparse_archive(
+            github, repo, pr, consumers, archive, sparse_blob_limit())
+        if summary is None:
+            return None
+        archive.seek(0)
+        summary['archive_bytes'] = upload_chunks(
+            iter(lambda: archive.read(archive_chunk_size), b''),
+            s3_object_key)
+    return summary
+
+
+def upload_part(s3_object_key, upload_id, part_number, data):
+    """
+    Uploads a single part of a multipart upload and returns its part info
+    """
+    response = s3.upload_part(
+        Bucket=bucket,
+        Key=s3_object_key,
+        UploadId=upload_id,
+        PartNumber=part_number,
+        Body=bytes(data)
+    )
+    return {
+        'ETag': response['ETag'],
+        'PartNumber': part_number
+    }
+
+
+def claim_pull_request(repo, pr):
+    """
+    Records that the PR head is being synced, unless it already was or
+    another invocation claimed it first. Returns the claimed record or None.
+    """
+    key = pr_key(repo, pr['number'])
+    now = time.time()
+    record = pr_state.get(key)
+    if is_pr_synced(record, pr['head']['sha'], now):
+        return None
+    claim = pr_state.put(key, dict(
+        record or {},
+        repo=repo,
+        pr_number=pr['number'],
+        head_sha=pr['head']['sha'],
+        archive_key=archive_key(repo, pr['number']),
+        status='syncing',
+        claimed_at=int(now)
+    ), record['version'] if record else None)
+    if claim is None:
+        logger.info('PR {} was claimed by another invocation'.format(key))
+    return claim
+
+
+def finish_sync(claim, status):
+    """
+    Moves a claimed PR record to status unless a newer commit was claimed
+    or pipeline-create got to it in the meantime
+    """
+    update(pr_state, claim['pr_key'], lambda record: {'status': status}
+           if record is not None and record.get('status') == 'syncing' and
+           record['head_sha'] == claim['head_sha'] else None)
+
+
+def sync_pull_request(repo, pr):
+    """
+    Uploads the latest commit of the PR to S3 if its record doesn't hold it
+    yet, claiming the record first so the commit is uploaded only once.
+    Returns a summary of the PR if it was synced, None otherwise.
+    """
+    logger.debug('Checking PR: {}#{}'.format(repo, pr['number']))
+    claim = claim_pull_request(repo, pr)
+    if claim is None:
+        return None
+    try:
+        summary = upload_pull_request(repo, pr)
+    except Exception:
+        finish_sync(claim, 'failed')
+        raise
+    finish_sync(claim, 'synced')
+    return summary
+
+
+def upload_pull_request(repo, pr):
+    """
+    Uploads the latest commit of the PR to S3. Returns a summary of the PR.
+    """
+    branch_name = pr['head']['ref'].replace('refs/heads/', '')
+    archive_url = pr['head']['repo']['archive_url'].replace(
+        '{archive_format}',
+        'zipball').replace(
+        '{/ref}', '/' + branch_name
+    )
+    s3_object_key = archive_key(repo, pr['number'])
+    archive = None
+    if sparse_archives:
+        try:
+            archive = upload_sparse_archive(repo, pr, s3_object_key)
+        except Exception as e:
+            logger.error('Sparse archive of PR {}#{} failed: {}'.format(
+                repo, pr['number'], e))
+        if archive is None:
+            logger.info('Uploading full archive of PR {}#{}'.format(
+                repo, pr['number']))
+    if archive is None:
+        archive = {
+            'archive_bytes': upload_archive(archive_url, s3_object_key)
+        }
+    return {
+        'repo': repo,
+        'number': pr['number'],
+        'title': pr['title'],
+        'submitted_by': pr['user']['login'],
+        'url': pr['url'],
+        'html_url': pr['html_url'],
+        'pr_repo': pr['head']['repo']['full_name'],
+        'archive_url': archive_url,
+        'archive': archive
+    }
+
+
+def log_sparse_savings(synced_prs):
+    """
+    Logs how much of the PR commits the sparse archives left out
+    """
+    sparse = [
+        synced_pr['archive'] for synced_pr in synced_prs
+        if 'tree_bytes' in synced_pr['archive']
+    ]
+    if sparse == []:
+        return
+    tree_bytes = sum(archive['tree_bytes'] for archive in sparse)
+    packaged_bytes = sum(archive['packaged_bytes'] for archive in sparse)
+    logger.info(
+        'Sparse archives of {} PRs packaged {} of {} bytes of source into '
+        '{} bytes of zip, {} bytes left out of the full archives'.format(
+            len(sparse),
+            packaged_bytes,
+            tree_bytes,
+            sum(archive['archive_bytes'] for archive in sparse),
+            tree_bytes - packaged_bytes
         ))
-    return False
 
 
+def get_sync_queue():
+    """
+    Returns the queue out of date PRs are sent through, the SQS queue of
+    the workers or an in-process stand-in when no queue is configured
+    """
+    if sync_queue_url:
+        return SQSQueue(sqs, sync_queue_url)
+    return LocalQueue(worker_handler)
+
+
+def work_item(repo, pr):
+    """
+    Returns the repo and the fields of a PR that syncing it needs, small
+    enough to send many PRs in one queue message. The PR's head repo must
+    still exist.
+    """
+    head_repo = pr['head']['repo']
+    return {
+        'repo': repo,
+        'number': pr['number'],
+        'title': pr['title'],
+        'user': {'login': pr['user']['login']},
+        'url': pr['url'],
+        'html_url': pr['html_url'],
+        'head': {
+            'sha': pr['head']['sha'],
+            'ref': pr['head']['ref'],
+            'repo': {
+                'full_name': head_repo['full_name'],
+                'archive_url': head_repo['archive_url']
+            }
+        },
+        'base': {'sha': pr['base']['sha']}
+    }
+
+
+def load_poll_state():
+    """
+    Returns the time and adaptive interval of the last poll
+    """
+    try:
+        response = s3.get_object(Bucket=bucket, Key=poll_state_key)
+    except s3.exceptions.NoSuchKey:
+        return {'polled_at': 0, 'interval_minutes': poll_interval_minutes}
+    return json.loads(response['Body'].read().decode('utf-8'))
+
+
+def save_poll_state(state):
+    """
+    Stores the time and adaptive interval of this poll for the next one
+    """
+    s3.put_object(
+        Bucket=bucket,
+        Key=poll_state_key,
+        Body=json.dumps(state).encode('utf-8'),
+        ServerSideEncryption='aws:kms',
+        SSEKMSKeyId=kms_key_id
+    )
+
+
+def is_poll_due(state, now):
+    """
+    Returns True if the adaptive interval has passed since the last poll
+    """
+    return now - state['polled_at'] >= \
+        state['interval_minutes'] * 60 - poll_slack_seconds
+
+
+@instrumented_handler(api_metrics, 'poller-create')
 def lambda_handler(event, context):
     """
-    Checks if repo for PRs and syncs open PRs (and commits) into an S3 bucket
+    Coordinator: checks the open PRs of every tracked repo against their
+    records and sends the ones whose latest commit isn't synced yet to the
+    workers in batches of sync_batch_size. With POLL_INTERVAL_MINUTES set,
+    polls back off to MAX_POLL_INTERVAL_MINUTES while no PR changes or the
+    GitHub rate limit runs low; events with force set always poll.
     """
-    open_pr_json = get_open_pull_requests()
+    github_limiter.set_deadline(context)
+    adaptive = poll_interval_minutes > 0
+    if adaptive:
+        poll_state = load_poll_state()
+        if not (event or {}).get('force') and \
+                not is_poll_due(poll_state, time.time()):
+            logger.info('Skipping poll, polling every {:.0f} minutes'.format(
+                poll_state['interval_minutes']))
+            return
+    polled_at = time.time()
+    open_prs = []
+    for repo, pr in get_all_open_pull_requests():
+        # The head repo of a PR from a deleted fork is gone with its code
+        if pr['head']['repo'] is None:
+            logger.info('Skipping PR {}#{}, its head repo was deleted'.format(
+                repo, pr['number']))
+            continue
+        open_prs.append((repo, pr))
+    records = pr_state.get_many(
+        [pr_key(repo, pr['number']) for repo, pr in open_prs])
+    now = time.time()
+    out_of_date = [
+        work_item(repo, pr) for repo, pr in open_prs
+        if not is_pr_synced(
+            records.get(pr_key(repo, pr['number'])), pr['head']['sha'], now)
+    ]
+
+    if out_of_date == []:
+        logger.info('No updates')
+    else:
+        work_batches = batches(out_of_date, sync_batch_size)
+        sent = get_sync_queue().send(work_batches)
+        logger.info('Sent {} of {} batches of out of date PRs: {}'.format(
+            sent, len(work_batches),
+            [pr_key(pr['repo'], pr['number']) for pr in out_of_date]))
+    logger.info('GitHub cache answered {} of {} requests'.format(
+        github.stats['cache_hits'], github.stats['requests']))
+    logger.info('Sync state of {} open PRs read from {} PR records'.format(
+        len(open_prs), len(records)))
+
+    if adaptive:
+        remaining_fraction = github_limiter.remaining_fraction()
+        interval = poll_interval(
+            poll_state['interval_minutes'],
+            poll_interval_minutes,
+            max_poll_interval_minutes,
+            out_of_date != [],
+            remaining_fraction)
+        save_poll_state({
+            'polled_at': polled_at,
+            'interval_minutes': interval,
+            'out_of_date_prs': len(out_of_date),
+            'rate_limit_remaining_fraction': remaining_fraction
+        })
+        logger.info('Next poll in {:.0f} minutes'.format(interval))
+
+
+@instrumented_handler(api_metrics, 'poller-create')
+def worker_handler(event, context):
+    """
+    Worker: syncs the PRs of the batches in an SQS event into the S3
+    bucket, each under its claim. Pushed branches sent by webhooks are
+    synced as their open PRs. Fails if any PR failed so the batch is
+    retried; PRs synced in the meantime are skipped on the retry.
+    """
+    github_limiter.set_deadline(context)
+    prs = []
+    for record in event['Records']:
+        for item in json.loads(record['body']):
+            if 'branch' in item:
+                prs.extend(
+                    work_item(item['repo'], pr)
+                    for pr in get_branch_pull_requests(
+                        item['repo'], item['branch']))
+            else:
+                prs.append(item)
 
     synced_prs = []
-    for pr in open_pr_json:
-        """
-        Check if in S3
-        If not in s3 get zip and place it there
-        """
-        logger.debug('Checking PR: {}'.format(pr['number']))
-        branch_name = pr['head']['ref'].replace('refs/heads/', '')
-        archive_url = pr['head']['repo']['archive_url'].replace(
-            '{archive_format}',
-            'zipball').replace(
-            '{/ref}', '/' + branch_name
-        )
-        headers = {}
-        if not is_pr_synced(pr['number'], pr['head']['sha']):
-            r = requests.get(archive_url, headers=headers)
-            archive_name = '/tmp/repo.zip'
-            s3_object_key = '{}/repo.zip'.format(pr['number'])
-            with open(archive_name, 'wb') as f:
-                f.write(r.content)
-            s3.upload_file(
-                archive_name,
-                bucket,
-                s3_object_key,
-                ExtraArgs={
-                    "ServerSideEncryption": "aws:kms",
-                    "SSEKMSKeyId": kms_key_id
-                }
-            )
-            logger.debug('Copied zip file to s3')
-            s3.put_object_tagging(
-                Bucket=bucket,
-                Key=s3_object_key,
-                Tagging={
-                    'TagSet': [
-                        {
-                            'Key': 'latest_commit',
-                            'Value': pr['head']['sha']
-                        },
-                    ]
-                }
-            )
-            synced_prs.append({
-                'number': pr['number'],
-                'title': pr['title'],
-                'submitted_by': pr['user']['login'],
-                'url': pr['url'],
-                'html_url': pr['html_url'],
-                'pr_repo': pr['head']['repo']['full_name'],
-                'archive_url': pr['head']['repo']['archive_url'].replace(
-                    '{archive_format}',
-                    'zipball').replace(
-                    '{/ref}', '/' + branch_name)
-            })
+    failed_prs = []
+    with ThreadPoolExecutor(max_workers=sync_concurrency) as executor:
+        futures = [
+            (pr_key(pr['repo'], pr['number']),
+             executor.submit(sync_pull_request, pr['repo'], pr))
+            for pr in prs
+        ]
+        for key, future in futures:
+            try:
+                synced_pr = future.result()
+            except Exception as e:
+                logger.error('Failed to sync PR {}: {}'.format(key, e))
+                failed_prs.append(key)
+                continue
+            if synced_pr is not None:
+                synced_prs.append(synced_pr)
+    synced_prs.sort(
+        key=lambda synced_pr: (synced_pr['repo'], synced_pr['number']))
+
     if synced_prs == []:
         logger.info('No updates')
     else:
         logger.info('The following PRs where updated in S3: {}'.format(
             synced_prs))
+    log_sparse_savings(synced_prs)
+    if failed_prs != []:
+        logger.error('The following PRs failed to sync: {}'.format(
+            sorted(failed_prs)))
+        raise Exception('Failed to sync PRs: {}'.format(sorted(failed_prs)))
+
+
+def get_webhook_secret():
+    """
+    Returns the webhook secret stored in the SSM parameter store
+    """
+    return parameter(ssm, webhook_secret_parameter)
+
+
+def is_signature_valid(body, signature):
+    """
+    Returns True if signature is the HMAC SHA256 of body with the webhook
+    secret, as sent by GitHub in the X-Hub-Signature-256 header
+    """
+    if signature is None or not signature.startswith('sha256='):
+        return False
+    expected = hmac.new(
+        get_webhook_secret().encode('utf-8'),
+        body,
+        hashlib.sha256
+    ).hexdigest()
+    return hmac.compare_digest('sha256={}'.format(expected), signature)
+
+
+def get_branch_pull_requests(repo, branch_name):
+    """
+    Returns the open PRs of repo whose head is branch_name of repo itself
+    """
+    return [
+        pr for pr in get_open_pull_requests(repo)
+        if pr['head']['ref'] == branch_name and
+        pr['head']['repo'] is not None and
+        pr['head']['repo']['full_name'] == repo
+    ]
+
+
+def get_webhook_work_items(event_type, payload):
+    """
+    Returns the work items of a pull_request or push webhook payload. A push
+    is sent as its branch, whose open PRs the worker looks up.
+    """
+    repo = payload['repository']['full_name']
+    if event_type == 'pull_request':
+        pr = payload['pull_request']
+        if payload['action'] not in webhook_sync_actions or \
+                pr['head']['repo'] is None:
+            return []
+        return [work_item(repo, pr)]
+    if event_type == 'push':
+        if payload.get('deleted') or \
+                not payload['ref'].startswith('refs/heads/'):
+            return []
+        return [{
+            'repo': repo,
+            'branch': payload['ref'].replace('refs/heads/', '')
+        }]
+    return []
+
+
+def webhook_response(status_code, message):
+    """
+    Returns an API Gateway proxy response
+    """
+    return {
+        'statusCode': status_code,
+        'body': json.dumps({'message': message})
+    }
+
+
+@instrumented_handler(api_metrics, 'poller-create')
+def webhook_handler(event, context):
+    """
+    Checks the signature of a GitHub webhook and sends the PRs it affects to
+    the workers, so deliveries are answered well within GitHub's timeout.
+    lambda_handler keeps running on a schedule to catch missed deliveries
+    """
+    headers = {
+        name.lower(): value
+        for name, value in (event.get('headers') or {}).items()
+    }
+    body = event.get('body') or ''
+    if event.get('isBase64Encoded'):
+        body = base64.b64decode(body)
+    else:
+        body = body.encode('utf-8')
+
+    if not is_signature_valid(body, headers.get('x-hub-signature-256')):
+        logger.error('Invalid webhook signature for delivery: {}'.format(
+            headers.get('x-github-delivery')))
+        return webhook_response(401, 'Invalid signature')
+
+    event_type = headers.get('x-github-event')
+    payload = json.loads(body.decode('utf-8'))
+    if event_type == 'ping':
+        return webhook_response(200, 'pong')
+    repo = payload.get('repository', {}).get('full_name')
+    if repo not in repos:
+        logger.info('Ignoring webhook for repository: {}'.format(repo))
+        return webhook_response(202, 'Repository not tracked')
+
+    items = get_webhook_work_items(event_type, payload)
+    if items == []:
+        logger.info('No updates for {} webhook'.format(event_type))
+        return webhook_response(200, 'No updates')
+    if get_sync_queue().send([items]) == 0:
+        logger.error('Failed to queue {} webhook for delivery: {}'.format(
+            event_type, headers.get('x-github-delivery')))
+        return webhook_response(500, 'Failed to queue sync')
+    logger.info('Queued {} webhook for {}: {}'.format(
+        event_type, repo, items))
+    return webhook_response(202, 'Queued sync')
@@ -11,6 +11,7 @@ resource "aws_lambda_function" "poller_delete" {
   source_code_hash = "${base64sha256(file("${path.module}/.lambda-zip/poller-delete.zip"))}"
   runtime          = "python3.6"
   kms_key_arn      = "${aws_kms_key.pipeline_key.arn}"
+  timeout          = 120
 
   tags {
     Name = "${var.project_name}-poller-delete"
@@ -18,9 +19,13 @@ resource "aws_lambda_function" "poller_delete" {
 
   environment {
     variables = {
-      BUCKET_NAME      = "${aws_s3_bucket.bucket.id}"
-      GITHUB_API_URL   = "${var.github_api_url}"
-      GITHUB_REPO_NAME = "${var.github_repo_name}"
+      BUCKET_NAME              = "${aws_s3_bucket.bucket.id}"
+      DELETE_CONCURRENCY       = "${var.poller_delete_concurrency}"
+      GITHUB_API_URL           = "${var.github_api_url}"
+      GITHUB_PAT_PARAMETER     = "${var.project_name}-terraform-pr-pat"
+      GITHUB_REPO_NAMES        = "${local.github_repo_names}"
+      GITHUB_REQUESTS_PER_REPO = "${var.github_requests_per_repo}"
+      KMS_KEY_ID               = "${aws_kms_key.pipeline_key.key_id}"
     }
   }
 }
@@ -38,6 +43,13 @@ resource "aws_lambda_permission" "poller_delete" {
 resource "null_resource" "poller_delete_dependencies" {
   triggers {
     lambda_function = "${file("${path.module}/poller-delete/poller-delete.py")}"
+    github_client   = "${file("${path.module}/common/github_client.py")}"
+    async_github    = "${file("${path.module}/common/async_github.py")}"
+    repositories    = "${file("${path.module}/common/repositories.py")}"
+    instrumentation = "${file("${path.module}/common/instrumentation.py")}"
+    runtime         = "${file("${path.module}/common/runtime.py")}"
+    rate_limit      = "${file("${path.module}/common/rate_limit.py")}"
+    requirements    = "${file("${path.module}/poller-delete/requirements.txt")}"
   }
 
   provisioner "local-exec" {
@@ -49,13 +61,37 @@ resource "null_resource" "poller_delete_dependencies" {
   }
 
   provisioner "local-exec" {
-    command = "pip install --target=${path.module}/.lambda-zip/poller-delete-resources requests"
+    command = "pip install --target=${path.module}/.lambda-zip/poller-delete-resources -r ${path.module}/poller-delete/requirements.txt"
   }
 
   provisioner "local-exec" {
     command = "cp -R ${path.module}/poller-delete/poller-delete.py ${path.module}/.lambda-zip/poller-delete-resources/."
   }
 
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/github_client.py ${path.module}/.lambda-zip/poller-delete-resources/."
+  }
+
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/async_github.py ${path.module}/.lambda-zip/poller-delete-resources/."
+  }
+
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/repositories.py ${path.module}/.lambda-zip/poller-delete-resources/."
+  }
+
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/instrumentation.py ${path.module}/.lambda-zip/poller-delete-resources/."
+  }
+
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/runtime.py ${path.module}/.lambda-zip/poller-delete-resources/."
+  }
+
+  provisioner "local-exec" {
+    command = "cp -R ${path.module}/common/rate_limit.py ${path.module}/.lambda-zip/poller-delete-resources/."
+  }
+
   provisioner "local-exec" {
     command = "cd ${path.module}/.lambda-zip/poller-delete-resources/ && zip -r ../poller-delete.zip ."
   }
@@ -101,12 +137,25 @@ data "aws_iam_policy_document" "poller_delete" {
       "s3:List*",
       "s3:DeleteObject",
       "s3:GetObject*",
+      "s3:PutObject",
     ]
 
     resources = [
       "${aws_s3_bucket.bucket.arn}*",
     ]
   }
+
+  statement {
+    sid = "SSMAccess"
+
+    actions = [
+      "ssm:GetParameter",
+    ]
+
+    resources = [
+      "arn:aws:ssm:${var.aws_region}:${data.aws_caller_identity.current.account_id}:parameter/${var.project_name}-terraform-pr-pat",
+    ]
+  }
 }
 
 resource "aws_iam_policy" "poller_delete" {
@@ -1,66 +1,160 @@
 import os
-import logging
+from concurrent.futures import ThreadPoolExecutor
 import requests
-import boto3
+from github_client import GitHubClient, cache_from_environment
+from instrumentation import (
+    Metrics, instrument_session, instrumented_handler)
+from runtime import configure_logging, client, env_int, parameter
+from rate_limit import GitHubRateLimiter
+from async_github import AsyncGitHubClient
+from repositories import repository_names, pr_key, parse_pr_key
 
 # Configuring logger
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-logger.handlers[0].setFormatter(logging.Formatter(
-    '%(asctime)s - %(name)s - %(levelname)s - %(message)s\n'
-))
-logging.getLogger('boto3').setLevel(logging.ERROR)
-logging.getLogger('botocore').setLevel(logging.ERROR)
+logger = configure_logging()
 
-# Boto clients
-s3 = boto3.client('s3')
+# API calls, latencies and bytes of the current invocation
+api_metrics = Metrics()
+
+# Boto clients, created on first use and kept across warm invocations
+s3 = client('s3', api_metrics)
+ssm = client('ssm', api_metrics)
 
 # Global vars
 github_api_url = os.environ['GITHUB_API_URL']
-repo = os.environ['GITHUB_REPO_NAME']
+repos = repository_names(os.environ['GITHUB_REPO_NAMES'])
 bucket = os.environ['BUCKET_NAME']
+kms_key_id = os.environ['KMS_KEY_ID']
+delete_concurrency = env_int('DELETE_CONCURRENCY', 1)
+github_requests_per_repo = env_int('GITHUB_REQUESTS_PER_REPO', 50)
+github_pat_parameter = os.environ.get('GITHUB_PAT_PARAMETER')
+
+# S3 caps delete_objects at 1000 keys per request
+delete_chunk_size = 1000
+
+
+def github_token():
+    """
+    Returns the GitHub PAT stored in the SSM parameter store
+    """
+    return parameter(ssm, github_pat_parameter)
+
+
+# Paced to the GitHub rate limit left
+github_limiter = GitHubRateLimiter()
+github = GitHubClient(
+    github_api_url,
+    cache_from_environment(s3, bucket, kms_key_id),
+    session=github_limiter.wrap(
+        instrument_session(requests.Session(), api_metrics),
+        token=github_token if github_pat_parameter else None)
+)
+async_github = AsyncGitHubClient(github, budget=github_requests_per_repo)
+
+
+def get_open_pr_keys():
+    """
+    Returns the set of open PR keys of every tracked repo and the repos
+    whose PRs were listed. Repos whose listing fails are left out so none
+    of their objects are deleted.
+    """
+    results = async_github.run({
+        repo: async_github.get_paginated(
+            repo, 'repos/{}/pulls?state=open&per_page=100'.format(repo))
+        for repo in repos
+    })
+    open_prs = set()
+    listed_repos = set()
+    for repo in repos:
+        if isinstance(results[repo], Exception):
+            logger.error('Unable to list open PRs of {}: {}'.format(
+                repo, results[repo]))
+            continue
+        listed_repos.add(repo)
+        open_prs.update(pr_key(repo, pr['number']) for pr in results[repo])
+    return open_prs, listed_repos
+
+
+def group_objects_by_pr(metrics, listed_repos):
+    """
+    Returns a dict mapping PR keys of the listed repos to the keys stored
+    under their prefix. Caches and pipeline artifacts are not stored under
+    a PR prefix and are skipped.
+    """
+    objects_by_pr = {}
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket):
+        metrics['s3_list_calls'] += 1
+        for resource in page.get('Contents', []):
+            metrics['objects_scanned'] += 1
+            parsed = parse_pr_key(resource['Key'])
+            if parsed is None or parsed[0] not in listed_repos:
+                continue
+            objects_by_pr.setdefault(
+                pr_key(*parsed), []).append(resource['Key'])
+    return objects_by_pr
 
 
-def is_pr_open(pr_number):
+def delete_chunk(keys):
     """
-    Returns True if the pull request's status is open
+    Deletes up to delete_chunk_size keys in a single request
+    Returns the keys that failed to delete
     """
-    pr_url = '{}/repos/{}/pulls/{}'.format(
-        github_api_url,
-        repo,
-        pr_number)
-    logger.debug('Checking if PR is open in this URL: {}'.format(pr_url))
-    if requests.get(pr_url).json()['state'] == 'open':
-        logger.debug('PR open True')
-        return True
-    logger.debug('PR open False')
-    return False
+    response = s3.delete_objects(
+        Bucket=bucket,
+        Delete={
+            'Objects': [{'Key': key} for key in keys],
+            'Quiet': True
+        }
+    )
+    errors = response.get('Errors', [])
+    for error in errors:
+        logger.error('Failed to delete {}: {}'.format(
+            error['Key'], error['Message']))
+    return [error['Key'] for error in errors]
 
 
+@instrumented_handler(api_metrics, 'poller-delete')
 def lambda_handler(event, context):
     """
     Deletes objects in S3 for PRs that are no longer open
     """
+    github_limiter.set_deadline(context)
     logger.debug('Removing resources for PRs no longer open')
-    s3_resources = s3.list_objects_v2(Bucket=bucket)['Contents']
-    objects_to_delete = []
-    for resource in s3_resources:
-        if 'terraform' in resource['Key']:
-            continue
-        if not is_pr_open(resource['Key'].split('/')[0]):
-            objects_to_delete.append({
-                'Key': resource['Key']
-            })
+    metrics = {
+        'objects_scanned': 0,
+        'objects_deleted': 0,
+        's3_list_calls': 0,
+        's3_delete_calls': 0,
+        'github_calls': 0
+    }
+    github_requests = github.stats['requests']
+    open_prs, listed_repos = get_open_pr_keys()
+    metrics['github_calls'] = github.stats['requests'] - github_requests
 
-    if objects_to_delete == []:
+    objects_by_pr = group_objects_by_pr(metrics, listed_repos)
+    closed_prs = sorted(
+        key for key in objects_by_pr if key not in open_prs)
+    keys_to_delete = [
+        key for closed_pr in closed_prs for key in objects_by_pr[closed_pr]
+    ]
+
+    if keys_to_delete == []:
         logger.info('All PRs still open')
     else:
-        s3.delete_objects(
-            Bucket=bucket,
-            Delete={
-                'Objects': objects_to_delete,
-                'Quiet': False
-            }
-        )
-        logger.info('The following objects have been deleted: {}'.format(
-            objects_to_delete))
+        chunks = [
+            keys_to_delete[i:i + delete_chunk_size]
+            for i in range(0, len(keys_to_delete), delete_chunk_size)
+        ]
+        with ThreadPoolExecutor(max_workers=delete_concurrency) as executor:
+            failed_keys = [
+                key for failed in executor.map(delete_chunk, chunks)
+                for key in failed
+            ]
+        metrics['s3_delete_calls'] = len(chunks)
+        metrics['objects_deleted'] = len(keys_to_delete) - len(failed_keys)
+        logger.info('Deleted objects of the following PRs: {}'.format(
+            closed_prs))
+
+    logger.info('poller-delete metrics: {}'.format(metrics))
+    logger.info('GitHub cache answered {} of {} requests'.format(
+        github.stats['cache_hits'], github.stats['requests']))
@@ -23,6 +23,39 @@ cp -R pipeline-create/pipeline-create.py .lambda-zip/pipeline-create-resources/.
 cp -R poller-create/poller-create.py .lambda-zip/poller-create-resources/.
 cp -R poller-delete/poller-delete.py .lambda-zip/poller-delete-resources/.
 
+echo "Copying shared modules"
+cp -R common/changed_files.py .lambda-zip/pipeline-create-resources/.
+cp -R common/module_graph.py .lambda-zip/pipeline-create-resources/.
+cp -R common/supersession.py .lambda-zip/pipeline-create-resources/.
+cp -R common/admission.py .lambda-zip/pipeline-create-resources/.
+cp -R common/build_history.py .lambda-zip/pipeline-create-resources/.
+cp -R common/repositories.py .lambda-zip/pipeline-create-resources/.
+cp -R common/instrumentation.py .lambda-zip/pipeline-create-resources/.
+cp -R common/runtime.py .lambda-zip/pipeline-create-resources/.
+cp -R common/rate_limit.py .lambda-zip/pipeline-create-resources/.
+cp -R common/pr_state.py .lambda-zip/pipeline-create-resources/.
+#cp -R common/repositories.py .lambda-zip/pipeline-delete-resources/.
+#cp -R common/instrumentation.py .lambda-zip/pipeline-delete-resources/.
+#cp -R common/runtime.py .lambda-zip/pipeline-delete-resources/.
+#cp -R common/pr_state.py .lambda-zip/pipeline-delete-resources/.
+cp -R common/github_client.py .lambda-zip/poller-create-resources/.
+cp -R common/changed_files.py .lambda-zip/poller-create-resources/.
+cp -R common/module_graph.py .lambda-zip/poller-create-resources/.
+cp -R common/sparse_archive.py .lambda-zip/poller-create-resources/.
+cp -R common/fanout.py .lambda-zip/poller-create-resources/.
+cp -R common/async_github.py .lambda-zip/poller-create-resources/.
+cp -R common/repositories.py .lambda-zip/poller-create-resources/.
+cp -R common/instrumentation.py .lambda-zip/poller-create-resources/.
+cp -R common/runtime.py .lambda-zip/poller-create-resources/.
+cp -R common/rate_limit.py .lambda-zip/poller-create-resources/.
+cp -R common/pr_state.py .lambda-zip/poller-create-resources/.
+cp -R common/github_client.py .lambda-zip/poller-delete-resources/.
+cp -R common/async_github.py .lambda-zip/poller-delete-resources/.
+cp -R common/repositories.py .lambda-zip/poller-delete-resources/.
+cp -R common/instrumentation.py .lambda-zip/poller-delete-resources/.
+cp -R common/runtime.py .lambda-zip/poller-delete-resources/.
+cp -R common/rate_limit.py .lambda-zip/poller-delete-resources/.
+
 echo "Creating zip files"
 pushd .lambda-zip/pipeline-create-resources/ && zip -r ../pipeline-create.zip .
 popd
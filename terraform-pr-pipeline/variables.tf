@@ -17,6 +17,17 @@ variable "github_api_url" {
 
 variable "github_repo_name" {
   description = "Name of the repository to track pull requests in org/repo format (e.g. cesar-rodriguez/test-repo)"
+  default     = ""
+}
+
+variable "github_repo_names" {
+  description = "Names of further repositories to track pull requests in, in org/repo format"
+  default     = []
+}
+
+variable "github_requests_per_repo" {
+  description = "Maximum number of GitHub requests poller-create and poller-delete make for each repository per run"
+  default     = 50
 }
 
 variable "poller_create_rate" {
@@ -24,11 +35,36 @@ variable "poller_create_rate" {
   default     = 5
 }
 
+variable "poller_create_max_interval" {
+  description = "Longest interval in minutes poller-create backs off to while no pull request changes or the GitHub rate limit runs low"
+  default     = 60
+}
+
+variable "poller_create_concurrency" {
+  description = "Number of pull requests synced to S3 in parallel by each poller-create worker"
+  default     = 4
+}
+
+variable "poller_create_batch_size" {
+  description = "Number of out of date pull requests poller-create sends to a worker at once"
+  default     = 10
+}
+
+variable "poller_create_workers" {
+  description = "Maximum number of poller-create workers syncing pull requests at once"
+  default     = 5
+}
+
 variable "poller_delete_rate" {
   description = "Rate in minutes for polling the GitHub repository to check if PRs are still open"
   default     = 60
 }
 
+variable "poller_delete_concurrency" {
+  description = "Number of 1000 key delete requests sent to S3 in parallel by poller-delete"
+  default     = 1
+}
+
 variable "code_build_image" {
   description = "Docker image to use for CodeBuild container - Use http://amzn.to/2mjCI91 for reference"
   default     = "aws/codebuild/ubuntu-base:14.04"
@@ -38,3 +74,23 @@ variable "terraform_download_url" {
   description = "URL for terraform version to be used for builds"
   default     = "https://releases.hashicorp.com/terraform/0.11.1/terraform_0.11.1_linux_amd64.zip"
 }
+
+variable "shared_codebuild_projects" {
+  description = "Use one set of CodeBuild projects for all pull requests, passing PR specific values as pipeline action environment variables"
+  default     = "false"
+}
+
+variable "plan_parallelism" {
+  description = "Number of test directories the terraform-plan build runs in parallel"
+  default     = 4
+}
+
+variable "max_concurrent_builds" {
+  description = "Maximum number of CodeBuild builds run at once by all PR pipelines, further pipelines are queued"
+  default     = 15
+}
+
+variable "sparse_archives" {
+  description = "Package only the directories the builds use into repo.zip, fetched through the Git trees and blobs APIs, instead of the full zipball"
+  default     = "false"
+}
@@ -0,0 +1,131 @@
+/**
+  Resources for the webhook-ingest lambda function
+  Shares the poller-create bundle and queues PRs for the poller-create
+  workers as GitHub webhooks arrive
+ */
+
+resource "aws_lambda_function" "webhook_ingest" {
+  depends_on       = ["null_resource.poller_create_dependencies"]
+  filename         = ".lambda-zip/poller-create.zip"
+  function_name    = "${var.project_name}-webhook-ingest"
+  role             = "${aws_iam_role.webhook_ingest.arn}"
+  handler          = "poller-create.webhook_handler"
+  source_code_hash = "${base64sha256(file("${path.module}/.lambda-zip/poller-create.zip"))}"
+  runtime          = "python3.6"
+  kms_key_arn      = "${aws_kms_key.pipeline_key.arn}"
+  timeout          = 10
+
+  tags {
+    Name = "${var.project_name}-webhook-ingest"
+  }
+
+  environment {
+    variables = {
+      BUCKET_NAME              = "${aws_s3_bucket.bucket.id}"
+      GITHUB_API_URL           = "${var.github_api_url}"
+      GITHUB_REPO_NAMES        = "${local.github_repo_names}"
+      KMS_KEY_ID               = "${aws_kms_key.pipeline_key.key_id}"
+      SYNC_QUEUE_URL           = "${aws_sqs_queue.poller_create_sync.id}"
+      WEBHOOK_SECRET_PARAMETER = "${var.project_name}-terraform-pr-webhook-secret"
+    }
+  }
+}
+
+// Allows API Gateway to trigger the function
+resource "aws_lambda_permission" "webhook_ingest" {
+  statement_id  = "webhook"
+  action        = "lambda:InvokeFunction"
+  function_name = "${aws_lambda_function.webhook_ingest.function_name}"
+  principal     = "apigateway.amazonaws.com"
+  source_arn    = "${aws_api_gateway_rest_api.webhook.execution_arn}/*/POST/webhook"
+}
+
+// Public endpoint for GitHub webhook deliveries
+resource "aws_api_gateway_rest_api" "webhook" {
+  name        = "${var.project_name}-terraform-pr-webhook"
+  description = "Receives GitHub pull_request and push webhooks"
+}
+
+resource "aws_api_gateway_resource" "webhook" {
+  rest_api_id = "${aws_api_gateway_rest_api.webhook.id}"
+  parent_id   = "${aws_api_gateway_rest_api.webhook.root_resource_id}"
+  path_part   = "webhook"
+}
+
+resource "aws_api_gateway_method" "webhook" {
+  rest_api_id   = "${aws_api_gateway_rest_api.webhook.id}"
+  resource_id   = "${aws_api_gateway_resource.webhook.id}"
+  http_method   = "POST"
+  authorization = "NONE"
+}
+
+resource "aws_api_gateway_integration" "webhook" {
+  rest_api_id             = "${aws_api_gateway_rest_api.webhook.id}"
+  resource_id             = "${aws_api_gateway_resource.webhook.id}"
+  http_method             = "${aws_api_gateway_method.webhook.http_method}"
+  integration_http_method = "POST"
+  type                    = "AWS_PROXY"
+  uri                     = "${aws_lambda_function.webhook_ingest.invoke_arn}"
+}
+
+resource "aws_api_gateway_deployment" "webhook" {
+  depends_on  = ["aws_api_gateway_integration.webhook"]
+  rest_api_id = "${aws_api_gateway_rest_api.webhook.id}"
+  stage_name  = "github"
+}
+
+// AWS IAM role for webhook-ingest function
+resource "aws_iam_role" "webhook_ingest" {
+  name               = "${var.project_name}-webhook-ingest-lambda"
+  assume_role_policy = "${data.aws_iam_policy_document.lambda_assume_role.json}"
+}
+
+data "aws_iam_policy_document" "webhook_ingest" {
+  statement {
+    sid = "CreateLogs"
+
+    actions = [
+      "logs:CreateLogGroup",
+      "logs:CreateLogStream",
+      "logs:PutLogEvents",
+    ]
+
+    resources = [
+      "arn:aws:logs:*:*:log-group:/aws/lambda/${var.project_name}-webhook-ingest:*",
+    ]
+  }
+
+  statement {
+    sid = "sqs"
+
+    actions = [
+      "sqs:SendMessage",
+    ]
+
+    resources = [
+      "${aws_sqs_queue.poller_create_sync.arn}",
+    ]
+  }
+
+  statement {
+    sid = "SSMAccess"
+
+    actions = [
+      "ssm:GetParameter",
+    ]
+
+    resources = [
+      "arn:aws:ssm:${var.aws_region}:${data.aws_caller_identity.current.account_id}:parameter/${var.project_name}-terraform-pr-webhook-secret",
+    ]
+  }
+}
+
+resource "aws_iam_policy" "webhook_ingest" {
+  name   = "${aws_iam_role.webhook_ingest.name}-policy"
+  policy = "${data.aws_iam_policy_document.webhook_ingest.json}"
+}
+
+resource "aws_iam_role_policy_attachment" "webhook_ingest" {
+  role       = "${aws_iam_role.webhook_ingest.name}"
+  policy_arn = "${aws_iam_policy.webhook_ingest.arn}"
+}